@@ -17,7 +17,7 @@ from tempfile import NamedTemporaryFile
 from logging import getLogger
 log = getLogger(__name__)
 
-BUFFER_SIZE = 4096
+BUFFER_SIZE = 64 * 1024
 
 
 def enum(**enums):
@@ -27,31 +27,106 @@ def enum(**enums):
     return type('Enum', (), enums)
 
 
-def copy_to_path(object, path):
+def copy_to_path(object, path, preallocate_size=None):
     """
-    Copy file-like object to path.
+    Copy file-like object to path. If preallocate_size is specified, that
+    many bytes are allocated for path up front (with posix_fallocate where
+    available, otherwise path is just extended) to limit fragmentation.
     """
     output = open(path, 'wb')
+    if preallocate_size:
+        try:
+            _preallocate(output, preallocate_size)
+            _copy(object, output)
+            # Trim allocation if object ended short of preallocate_size.
+            output.truncate(output.tell())
+        finally:
+            output.close()
+    else:
+        _copy_and_close(object, output)
+
+
+def _preallocate(output, size):
+    if _posix_fallocate is not None:
+        try:
+            _posix_fallocate(output.fileno(), 0, size)
+            return
+        except OSError:
+            # Not supported by this file system.
+            pass
+    os.ftruncate(output.fileno(), size)
+
+
+def _libc_posix_fallocate():
+    """
+    posix_fallocate from the C library (os.posix_fallocate is only available
+    from Python 3.3), or None if it cannot be found.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        fallocate = getattr(libc, "posix_fallocate64", None)
+        if fallocate is None and ctypes.sizeof(ctypes.c_long) == 8:
+            # off_t is 64 bits wide.
+            fallocate = getattr(libc, "posix_fallocate", None)
+    except (ImportError, OSError):
+        return None
+    if fallocate is None:
+        return None
+    fallocate.restype = ctypes.c_int
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+    def posix_fallocate(fd, offset, length):
+        # Returns an error number rather than setting errno.
+        result = fallocate(fd, offset, length)
+        if result:
+            raise OSError(result, os.strerror(result))
+    return posix_fallocate
+
+
+_posix_fallocate = getattr(os, "posix_fallocate", None) or _libc_posix_fallocate()
+
+
+def copy_to_path_range(object, path, offset, size=None):
+    """
+    Copy file-like object into path starting at byte offset. path is created
+    if needed (and extended to size bytes if specified) but never truncated,
+    so several ranges of the same file may be written concurrently.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+    output = os.fdopen(fd, 'r+b')
+    try:
+        if size is not None and os.fstat(fd).st_size < size:
+            output.truncate(size)
+        output.seek(offset)
+    except Exception:
+        output.close()
+        raise
     _copy_and_close(object, output)
 
 
 def _copy_and_close(object, output):
     try:
-        while True:
-            buffer = object.read(BUFFER_SIZE)
-            if not buffer:
-                break
-            output.write(buffer)
+        _copy(object, output)
     finally:
         output.close()
 
 
-def copy_to_temp(object):
+def _copy(object, output):
+    while True:
+        buffer = object.read(BUFFER_SIZE)
+        if not buffer:
+            break
+        output.write(buffer)
+
+
+def copy_to_temp(object, dir=None):
     """
-    Copy file-like object to temp file and return
+    Copy file-like object to temp file (in dir if specified) and return
     path.
     """
-    temp_file = NamedTemporaryFile(delete=False)
+    temp_file = NamedTemporaryFile(delete=False, dir=dir)
     _copy_and_close(object, temp_file)
     return temp_file.name
 
@@ -88,6 +88,14 @@
     :undoc-members:
     :show-inheritance:
 
+:mod:`lwr.metrics` Module
+-------------------------
+
+.. automodule:: lwr.metrics
+    :members:
+    :undoc-members:
+    :show-inheritance:
+
 :mod:`lwr.tools` Module
 -----------------------
 
@@ -1,49 +1,227 @@
 
+import os
 from os.path import join, exists
+from contextlib import contextmanager
 from hashlib import sha256
+from re import compile
+from shutil import copyfile
+from stat import S_IRUSR, S_IRGRP, S_IROTH
+import threading
+from time import time
 
+from lwr import metrics
+from lwr.lwr_client.util import file_sha256
 from .persistence import PersistenceStore
 from .util import atomicish_move
+from .util import compare_validators
+from .util import LruIndex
+from .util import REVALIDATED
+from .util import STALE
 from .util import Time
 
+import logging
+log = logging.getLogger(__name__)
+
+SHA256_PATTERN = compile(r"^[0-9a-f]{64}$")
+SHARD_PATTERN = compile(r"^[0-9a-f]{2}$")
+FLAT_LAYOUT = "flat"
+HASHED_LAYOUT = "hashed"
+READ_ONLY = S_IRUSR | S_IRGRP | S_IROTH
+DEFAULT_REAP_INTERVAL = 60
+# Unlinking a blob's last job directory link updates its ctime, the grace
+# period protects blobs being (re)linked concurrently.
+DEFAULT_BLOB_GRACE_SECONDS = 3600
+DEFAULT_BLOB_COLLECTION_INTERVAL = 600
+# Clients told a file is cached upload it (by cache token) shortly after.
+DEFAULT_HIT_PIN_SECONDS = 300
+# Seconds to wait for the background thread to finish on close.
+SHUTDOWN_TIMEOUT = 10
+
 
 class CacheFileMapper(object):
+    """ Map cache tokens to paths, either directly in ``directory`` (the
+    ``flat`` layout) or fanned out over sub-directories named after the
+    first two characters of the token (the ``hashed`` layout).
+    """
 
-    def __init__(self, directory):
+    def __init__(self, directory, layout=None):
         self.directory = directory
+        self.layout = layout or FLAT_LAYOUT
+        if self.layout not in [FLAT_LAYOUT, HASHED_LAYOUT]:
+            raise Exception("Unknown file cache layout %s" % layout)
 
     def get(self, token):
+        if self.layout == HASHED_LAYOUT:
+            return join(self.directory, token[0:2], token)
         return join(self.directory, token)
 
+    def all(self):
+        """ Yield (token, path) for each cached file.
+        """
+        directories = [self.directory]
+        if self.layout == HASHED_LAYOUT:
+            directories = [join(self.directory, name) for name in os.listdir(self.directory) if SHARD_PATTERN.match(name)]
+        for directory in directories:
+            for name in os.listdir(directory):
+                if SHA256_PATTERN.match(name):
+                    yield name, join(directory, name)
+
+    def migrate(self):
+        """ Move files cached in the flat layout to their place in this
+        mapper's layout, returns the number of files moved.
+        """
+        moved = 0
+        if self.layout == FLAT_LAYOUT:
+            return moved
+        for name in os.listdir(self.directory):
+            if SHA256_PATTERN.match(name):
+                destination = self.get(name)
+                _makedirs(os.path.dirname(destination))
+                os.rename(join(self.directory, name), destination)
+                moved += 1
+        return moved
+
+
+class BlobMapper(object):
+    """ Map SHA-256 digests of file contents to paths in a content-addressed
+    store (fanned out over sub-directories named after the first two hex
+    digits of the digest).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, digest):
+        if not SHA256_PATTERN.match(digest or ""):
+            raise Exception("Invalid SHA-256 digest %s" % digest)
+        return join(self.directory, digest[0:2], digest)
+
+    def all(self):
+        if not exists(self.directory):
+            return
+        for sub_directory in os.listdir(self.directory):
+            sub_directory_path = join(self.directory, sub_directory)
+            for name in os.listdir(sub_directory_path):
+                if SHA256_PATTERN.match(name):
+                    yield join(sub_directory_path, name)
+
 
 class Cache(PersistenceStore):
     """
     Maintain a cache of uploaded files.
+
+    In addition to files cached by client IP and path, the cache maintains a
+    content-addressed store of file contents keyed on SHA-256 digest. Stored
+    blobs are (read-only) hard linked into job directories, so a blob's link
+    count serves as its reference count - blobs no longer linked into any
+    job directory for ``blob_grace_seconds`` are removed by
+    ``collect_garbage`` - run every ``blob_collection_interval`` seconds by a
+    background thread.
+
+    Cached files may be validated against their source (see
+    ``cache_required``) and stored in a ``flat`` or ``hashed`` ``layout`` (see
+    ``CacheFileMapper``) - files cached in the flat layout are moved when
+    switching to the hashed layout.
+
+    Cached files are tracked in a ``PersistenceStore`` using the supplied
+    ``persistence_backend`` (``shelve`` or ``sqlite``).
+
+    If ``max_size`` (in bytes) is set, a background thread evicts the least
+    recently used cached files (every ``reap_interval`` seconds, or as soon
+    as the cache exceeds ``max_size``) until the cache is back within budget.
+    Files in use (see ``in_use``), or reported cached by ``cache_required`` in
+    the last ``hit_pin_seconds`` (so still to be read), are never evicted.
     """
 
-    def __init__(self, cache_directory="file_cache"):
-        super(Cache, self).__init__(join(cache_directory, "cache_shelf"))
-        self.file_mapper = CacheFileMapper(cache_directory)
+    def __init__(self, cache_directory="file_cache", blob_grace_seconds=DEFAULT_BLOB_GRACE_SECONDS, persistence_backend=None,
+                 max_size=None, reap_interval=DEFAULT_REAP_INTERVAL, layout=None,
+                 blob_collection_interval=DEFAULT_BLOB_COLLECTION_INTERVAL, hit_pin_seconds=DEFAULT_HIT_PIN_SECONDS):
+        super(Cache, self).__init__(join(cache_directory, "cache_shelf"), backend=persistence_backend)
+        self.file_mapper = CacheFileMapper(cache_directory, layout=layout)
+        migrated = self.file_mapper.migrate()
+        if migrated:
+            log.info("Moved %d cached files into %s layout." % (migrated, layout))
+        self.blob_mapper = BlobMapper(join(cache_directory, "blobs"))
+        self.blob_directory = self.blob_mapper.directory
+        self.blob_grace_seconds = blob_grace_seconds
         self.time = Time
+        if not exists(self.blob_directory):
+            os.makedirs(self.blob_directory)
+        self.max_size = max_size
+        self.lru_index = LruIndex()
+        # Tokens of cached files currently being read, with reader counts.
+        self.in_use_counts = {}
+        # Tokens of recently hit cached files, with the time they may be
+        # evicted after.
+        self.hit_pin_seconds = hit_pin_seconds
+        self.pinned = {}
+        self.index_lock = threading.Lock()
+        self.__index_cached_files()
+        evict_interval = reap_interval if max_size is not None else None
+        self.__reaper = _Reaper(self, evict_interval, blob_collection_interval).start()
 
-    def cache_required(self, ip, path):
+    def close(self):
+        self.__reaper.shutdown()
+        super(Cache, self).close()
+
+    def cache_required(self, ip, path, validator=None):
+        """
+        Returns True if the file should be inserted into the cache, False if
+        it is cached (or being inserted) already. If ``validator`` (see
+        ``lwr.lwr_client.util.source_validator``) describes the source file
+        and the cached copy no longer matches it, the copy is removed and
+        "stale" is returned - the file should be inserted again.
+        """
         token = self.__token(ip, path)
 
+        def check_record(record):
+            if record is None:
+                return self.__record(validator), True
+            comparison = compare_validators(_record_validator(record), validator)
+            if comparison == STALE:
+                # Removed (even if in use, readers with the file open are
+                # unaffected) before anyone else can find the new record.
+                self.__remove_file(token)
+                return self.__record(validator), STALE
+            elif comparison == REVALIDATED:
+                return self.__record(dict(_record_validator(record), **validator)), False
+            return None, False
+
         def get_token():
-            inserted = False
-            if token not in self.shelf:
-                self.shelf[token] = self.time.now()
-                inserted = True
-            return inserted
+            # Checked and updated atomically, so only one client is asked to
+            # insert the file.
+            return self.shelf.update(token, check_record)
 
-        return self._with_lock(get_token)
+        required = self._with_lock(get_token)
+        if required is True:
+            metrics.FILE_CACHE_MISSES.inc()
+        elif required == STALE:
+            metrics.FILE_CACHE_STALE.inc()
+            self.__invalidate(token)
+        else:
+            metrics.FILE_CACHE_HITS.inc()
+            self.__touch(token, pin=True)
+        return required
 
-    def cache_file(self, local_path, ip, path):
+    def cache_file(self, local_path, ip, path, validator=None):
         """
-        Move a file from a temporary staging area into the cache.
+        Move a file from a temporary staging area into the cache, its source
+        may be described by ``validator``.
         """
-        destination = self.__destination(ip, path)
+        token = self.__token(ip, path)
+        destination = self.destination(token)
+        _makedirs(os.path.dirname(destination))
+        if validator:
+            def set_validator():
+                self.shelf[token] = self.__record(validator)
+            self._with_lock(set_validator)
         atomicish_move(local_path, destination)
+        with self.index_lock:
+            self.lru_index.add(token, os.path.getsize(destination))
+            over_budget = self.__over_budget()
+            metrics.FILE_CACHE_BYTES.set(self.lru_index.total_size)
+        if over_budget:
+            self.__reaper.wake()
 
     def file_available(self, ip, path):
         token = self.__token(ip, path)
@@ -51,15 +229,238 @@ class Cache(PersistenceStore):
         return {"token": token, "ready": ready}
 
     def destination(self, token):
+        self.__touch(token)
         return self.file_mapper.get(token)
 
-    def __destination(self, ip, path):
-        token = self.__token(ip, path)
-        return self.destination(token)
+    @contextmanager
+    def in_use(self, token):
+        """ Context yielding the path of cached file ``token``, which will not
+        be evicted before the context exits.
+        """
+        with self.index_lock:
+            self.in_use_counts[token] = self.in_use_counts.get(token, 0) + 1
+        try:
+            yield self.destination(token)
+        finally:
+            with self.index_lock:
+                count = self.in_use_counts.pop(token) - 1
+                if count:
+                    self.in_use_counts[token] = count
+
+    def evict(self):
+        """ Evict least recently used cached files (that are not in use)
+        until the cache is within ``max_size``, returns the number evicted.
+        """
+        evicted = 0
+        while True:
+            # Evicted under the index lock, so a file cannot be put in use
+            # (or touched) while it is being removed.
+            with self.index_lock:
+                if not self.__over_budget():
+                    break
+                now = time()
+                self.pinned = dict((token, until) for token, until in self.pinned.items() if until > now)
+                token = next((token for token in self.lru_index if token not in self.in_use_counts and token not in self.pinned), None)
+                if token is None:
+                    log.warn("File cache exceeds max_size, but all cached files are in use or recently hit.")
+                    break
+                size = self.lru_index.remove(token)
+                self.__remove_cached_file(token)
+                metrics.FILE_CACHE_BYTES.set(self.lru_index.total_size)
+                metrics.FILE_CACHE_EVICTIONS.inc()
+                metrics.FILE_CACHE_EVICTED_BYTES.inc(size)
+            evicted += 1
+        return evicted
+
+    def has_blob(self, digest):
+        return exists(self.blob_mapper.get(digest))
+
+    def store_blob(self, local_path, digest, link_path=None, actual_digest=None):
+        """
+        Move a file (which should be in ``blob_directory``) into the content
+        store, verifying its contents match ``digest``. If ``link_path`` is
+        specified the contents are placed there as well (before becoming
+        visible in the store, so they cannot be garbage collected first).
+        ``actual_digest`` may be supplied if the digest of ``local_path`` is
+        already known (e.g. computed while receiving it).
+        """
+        destination = self.blob_mapper.get(digest)
+        if actual_digest is None:
+            actual_digest = file_sha256(local_path)
+        if actual_digest != digest:
+            os.remove(local_path)
+            raise Exception("Uploaded file digest %s does not match expected %s" % (actual_digest, digest))
+        os.chmod(local_path, READ_ONLY)
+        if link_path:
+            _link_or_copy(local_path, link_path)
+        if exists(destination):
+            os.remove(local_path)
+            return
+        _makedirs(os.path.dirname(destination))
+        atomicish_move(local_path, destination)
+
+    def link_blob(self, digest, path):
+        """
+        Place the stored contents with the supplied digest at path, returns
+        False if no such contents are stored.
+        """
+        blob_path = self.blob_mapper.get(digest)
+        if not exists(blob_path):
+            return False
+        try:
+            _link_or_copy(blob_path, path)
+        except (IOError, OSError):
+            if exists(blob_path):
+                raise
+            # Collected concurrently.
+            return False
+        return True
+
+    def collect_garbage(self):
+        """
+        Remove stored blobs no longer linked into any job directory.
+        """
+        removed = 0
+        now = time()
+        for blob_path in self.blob_mapper.all():
+            try:
+                stat = os.stat(blob_path)
+                # ctime is updated whenever a link is created or removed.
+                if stat.st_nlink <= 1 and now - stat.st_ctime >= self.blob_grace_seconds:
+                    os.remove(blob_path)
+                    removed += 1
+            except OSError:
+                log.exception("Failed to collect blob %s" % blob_path)
+        return removed
+
+    def __record(self, validator):
+        return dict(time=self.time.now(), validator=validator or {})
+
+    def __remove_file(self, token):
+        try:
+            os.remove(self.file_mapper.get(token))
+        except OSError:
+            pass
+
+    def __invalidate(self, token):
+        with self.index_lock:
+            if self.lru_index.remove(token) is not None:
+                metrics.FILE_CACHE_BYTES.set(self.lru_index.total_size)
+
+    def __over_budget(self):
+        return self.max_size is not None and self.lru_index.total_size > self.max_size
+
+    def __touch(self, token, pin=False):
+        with self.index_lock:
+            touched = self.lru_index.touch(token)
+            if pin and self.hit_pin_seconds:
+                self.pinned[token] = time() + self.hit_pin_seconds
+        if touched:
+            try:
+                # Recency survives restarts, see __index_cached_files.
+                os.utime(self.file_mapper.get(token), None)
+            except OSError:
+                pass
+
+    def __remove_cached_file(self, token):
+        # Forget the token first, clients will be asked to upload it again.
+        def forget():
+            if token in self.shelf:
+                del self.shelf[token]
+        self._with_lock(forget)
+        try:
+            os.remove(self.file_mapper.get(token))
+        except OSError:
+            log.exception("Failed to remove cached file for token %s" % token)
+
+    def __index_cached_files(self):
+        cached_files = []
+        for token, path in self.file_mapper.all():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            cached_files.append((stat.st_mtime, token, stat.st_size))
+        for _, token, size in sorted(cached_files):
+            self.lru_index.add(token, size)
+        metrics.FILE_CACHE_BYTES.set(self.lru_index.total_size)
 
     def __token(self, ip, path):
         for_hash = "IP:%s:%s" % (ip, path)
         return sha256(for_hash.encode('UTF-8')).hexdigest()
 
 
+def _record_validator(record):
+    # Records of older LWRs are just the time the file was cached.
+    return record.get("validator", {}) if isinstance(record, dict) else {}
+
+
+class _Reaper(object):
+    """ Thread periodically evicting files from a size bounded cache (every
+    ``evict_interval`` seconds, if set) and collecting unreferenced blobs
+    (every ``collect_interval`` seconds).
+    """
+
+    def __init__(self, cache, evict_interval, collect_interval):
+        self.cache = cache
+        self.evict_interval = evict_interval
+        self.collect_interval = collect_interval
+        self.interval = min(evict_interval or collect_interval, collect_interval)
+        self.event = threading.Event()
+        self.active = True
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(name="lwr_file_cache_reaper", target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def wake(self):
+        self.event.set()
+
+    def shutdown(self):
+        self.active = False
+        self.event.set()
+        self.thread.join(SHUTDOWN_TIMEOUT)
+
+    def _run(self):
+        last_collection = time()
+        while self.active:
+            if self.evict_interval is not None:
+                try:
+                    self.cache.evict()
+                except Exception:
+                    log.exception("Failed to evict files from cache.")
+            if time() - last_collection >= self.collect_interval:
+                last_collection = time()
+                try:
+                    removed = self.cache.collect_garbage()
+                    if removed:
+                        log.info("Removed %d unreferenced blobs from cache." % removed)
+                except Exception:
+                    log.exception("Failed to collect blobs from cache.")
+            self.event.wait(self.interval)
+            self.event.clear()
+
+
+def _makedirs(directory):
+    if not exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created concurrently.
+            pass
+
+
+def _link_or_copy(source, destination):
+    if exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Different file system (or links unsupported), fallback to copy.
+        copyfile(source, destination)
+
+
 __all__ = [Cache]
@@ -1,18 +1,44 @@
 import shelve
+import sqlite3
+import threading
 from threading import Lock
 import traceback
+try:
+    from cPickle import dumps, loads, HIGHEST_PROTOCOL
+except ImportError:
+    from pickle import dumps, loads, HIGHEST_PROTOCOL
+try:
+    from dbm import whichdb
+except ImportError:
+    from whichdb import whichdb
+
+import logging
+log = logging.getLogger(__name__)
+
+SHELVE_BACKEND = "shelve"
+SQLITE_BACKEND = "sqlite"
+DEFAULT_BACKEND = SHELVE_BACKEND
+# Seconds to wait on other writers (e.g. other LWR processes) before giving up.
+SQLITE_BUSY_TIMEOUT = 30
 
 
 class PersistenceStore(object):
+    """ Base class for objects persisting state in a key-value store
+    (``self.shelf``). The ``shelve`` backend keeps this in a shelf file, all
+    access is serialized through ``_with_lock``. The ``sqlite`` backend keeps
+    it in a SQLite database in WAL mode (``<filename>.sqlite``), which
+    supports concurrent readers and crash safe, per key updates - entries
+    of an existing shelf file are migrated to it when it is created.
+    """
 
-    def __init__(self, filename, require_sync=True):
+    def __init__(self, filename, require_sync=True, backend=DEFAULT_BACKEND):
         self.shelf_filename = filename
         self.__require_sync = require_sync
+        self.__backend = backend or DEFAULT_BACKEND
         self.__open_shelf()
-        self.__shelf_lock = Lock()
 
     def __open_shelf(self):
-        self.shelf = shelve.open(self.shelf_filename, writeback=self.__require_sync) if self.shelf_filename else None
+        self.shelf = open_store(self.shelf_filename, self.__backend, self.__require_sync) if self.shelf_filename else None
 
     def close(self):
         self.shelf.close()
@@ -22,7 +48,7 @@ class PersistenceStore(object):
             self.shelf.sync()
 
     def _lock(self):
-        return self.__shelf_lock
+        return self.shelf.lock
 
     def _with_lock(self, func, suppress_exception=True):
         if self.shelf is not None:
@@ -33,3 +59,226 @@ class PersistenceStore(object):
                     traceback.print_exc()
                     if not suppress_exception:
                         raise
+
+
+def open_store(filename, backend=DEFAULT_BACKEND, require_sync=True):
+    if backend == SHELVE_BACKEND:
+        return ShelfStore(filename, writeback=require_sync)
+    elif backend == SQLITE_BACKEND:
+        return SqliteStore("%s.sqlite" % filename, migrate_from=filename)
+    else:
+        raise Exception("Unknown persistence backend %s" % backend)
+
+
+class ShelfStore(object):
+    """ Key-value store backed by a shelf file. Not thread-safe, callers must
+    hold ``lock``.
+    """
+
+    def __init__(self, filename, writeback=True):
+        self.shelf = shelve.open(filename, writeback=writeback)
+        self.lock = Lock()
+
+    def __contains__(self, key):
+        return key in self.shelf
+
+    def __getitem__(self, key):
+        return self.shelf[key]
+
+    def __setitem__(self, key, value):
+        self.shelf[key] = value
+
+    def __delitem__(self, key):
+        del self.shelf[key]
+
+    def get(self, key, default=None):
+        return self.shelf.get(key, default)
+
+    def keys(self):
+        return list(self.shelf.keys())
+
+    def insert_if_absent(self, key, value):
+        """ Store ``value`` under ``key`` unless it is already set, returns
+        True if it was stored.
+        """
+        if key in self.shelf:
+            return False
+        self.shelf[key] = value
+        return True
+
+    def update(self, key, func):
+        """ Atomically update the value under ``key`` - ``func`` is called
+        with the current value (None if unset) and returns a new value (None
+        to leave it as is) and a result, which is returned.
+        """
+        value, result = func(self.shelf.get(key, None))
+        if value is not None:
+            self.shelf[key] = value
+        return result
+
+    def sync(self):
+        self.shelf.sync()
+
+    def close(self):
+        self.shelf.close()
+
+
+class SqliteStore(object):
+    """ Thread-safe key-value store backed by a SQLite database in WAL mode,
+    values are pickled. Each operation is its own transaction, so there is
+    nothing to sync. Each thread uses its own connection.
+
+    >>> import os, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> shelf = shelve.open(os.path.join(directory, "store"))
+    >>> shelf["a"] = 1
+    >>> shelf.close()
+    >>> store = SqliteStore(os.path.join(directory, "store.sqlite"), migrate_from=os.path.join(directory, "store"))
+    >>> store["a"]
+    1
+    >>> store.insert_if_absent("a", 2), store.insert_if_absent("b", 2)
+    (False, True)
+    >>> store.update("b", lambda value: (value + 1, value))
+    2
+    >>> store["b"]
+    3
+    >>> del store["a"]
+    >>> store.keys() == ["b"]
+    True
+    >>> store.close()
+    >>> import shutil
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, path, migrate_from=None):
+        self.path = path
+        # Nothing to serialize, SQLite handles concurrent access.
+        self.lock = _NullLock()
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = Lock()
+        self.__initialize(migrate_from)
+
+    def __contains__(self, key):
+        return self.__select(key) is not None
+
+    def __getitem__(self, key):
+        row = self.__select(key)
+        if row is None:
+            raise KeyError(key)
+        return _loads(row[0])
+
+    def __setitem__(self, key, value):
+        self._execute("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", (key, _dumps(value)))
+
+    def __delitem__(self, key):
+        if not self._execute("DELETE FROM entries WHERE key = ?", (key,)).rowcount:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [row[0] for row in self._execute("SELECT key FROM entries").fetchall()]
+
+    def insert_if_absent(self, key, value):
+        """ Store ``value`` under ``key`` unless it is already set, returns
+        True if it was stored.
+        """
+        cursor = self._execute("INSERT OR IGNORE INTO entries (key, value) VALUES (?, ?)", (key, _dumps(value)))
+        return cursor.rowcount == 1
+
+    def update(self, key, func):
+        """ Atomically update the value under ``key`` - ``func`` is called
+        with the current value (None if unset) and returns a new value (None
+        to leave it as is) and a result, which is returned. Read and write
+        form a single (immediate) transaction, so concurrent updates of the
+        same database - from any thread or process - are serialized.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            value, result = func(_loads(row[0]) if row is not None else None)
+            if value is not None:
+                connection.execute("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", (key, _dumps(value)))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return result
+
+    def sync(self):
+        pass
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def _execute(self, sql, parameters=()):
+        return self._connection().execute(sql, parameters)
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # isolation_level None - statements autocommit unless wrapped in
+            # an explicit transaction.
+            connection = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            # Durable as of the last checkpoint, but never corrupted.
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self.connections_lock:
+                self.connections.append(connection)
+            self.local.connection = connection
+        return connection
+
+    def __select(self, key):
+        return self._execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+
+    def __initialize(self, migrate_from):
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Table creation and migration form a single transaction, so an
+        # interrupted migration is simply repeated.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            created = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'entries'").fetchone()
+            if not created:
+                connection.execute("CREATE TABLE entries (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+                if migrate_from and whichdb(migrate_from):
+                    self.__migrate(connection, migrate_from)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def __migrate(self, connection, shelf_filename):
+        shelf = shelve.open(shelf_filename, flag="r")
+        try:
+            entries = [(key, _dumps(shelf[key])) for key in shelf.keys()]
+        finally:
+            shelf.close()
+        connection.executemany("INSERT OR REPLACE INTO entries (key, value) VALUES (?, ?)", entries)
+        log.info("Migrated %d entries from shelf %s to %s, the shelf may now be removed." % (len(entries), shelf_filename, self.path))
+
+
+class _NullLock(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+def _dumps(value):
+    return sqlite3.Binary(dumps(value, HIGHEST_PROTOCOL))
+
+
+def _loads(value):
+    return loads(bytes(value))
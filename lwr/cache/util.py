@@ -33,3 +33,121 @@ class Time:
     @classmethod
     def now(cls):
         return datetime.utcnow()
+
+
+VALID = "valid"
+REVALIDATED = "revalidated"
+STALE = "stale"
+DIGEST_KEYS = ["sha256", "sampled_sha256"]
+
+
+def compare_validators(cached, source):
+    """ Compare validators (dictionaries describing a file's size, mtime and
+    optionally digests - see ``lwr.lwr_client.util.source_validator``) of a
+    cached file and its source. Returns ``REVALIDATED`` if only the
+    modification time differs and a digest shows the contents are unchanged.
+
+    >>> cached = dict(size="12", mtime="1.0", sampled_sha256="abc")
+    >>> compare_validators(cached, dict(size="12", mtime="1.0"))
+    'valid'
+    >>> compare_validators(cached, dict(size="12", mtime="2.0", sampled_sha256="abc"))
+    'revalidated'
+    >>> compare_validators(cached, dict(size="12", mtime="2.0"))
+    'stale'
+    >>> compare_validators(cached, dict(size="12", mtime="1.0", sampled_sha256="def"))
+    'stale'
+    >>> compare_validators(cached, {})
+    'valid'
+    >>> compare_validators({}, dict(size="12", mtime="1.0"))
+    'stale'
+    """
+    if not source:
+        # Client does not validate its cached files.
+        return VALID
+    if not cached or cached.get("size") != source.get("size"):
+        return STALE
+    same_mtime = cached.get("mtime") == source.get("mtime")
+    for key in DIGEST_KEYS:
+        if key in cached and key in source:
+            if cached[key] != source[key]:
+                return STALE
+            return VALID if same_mtime else REVALIDATED
+    return VALID if same_mtime else STALE
+
+
+class LruIndex(object):
+    """ Sizes of cached entries, ordered from least to most recently used.
+    Not thread-safe.
+
+    >>> index = LruIndex()
+    >>> index.add("a", 10)
+    >>> index.add("b", 20)
+    >>> index.touch("a")
+    True
+    >>> list(index), index.total_size
+    (['b', 'a'], 30)
+    >>> index.remove("b")
+    20
+    >>> index.touch("b")
+    False
+    >>> list(index), index.total_size
+    (['a'], 10)
+    """
+
+    def __init__(self):
+        # Doubly linked list of [previous, next, key, size] links, in order
+        # of use, around a sentinel - plus the link of each key (collections
+        # .OrderedDict is not available on Python 2.6).
+        self.root = root = []
+        root[:] = [root, root, None, None]
+        self.entries = {}
+        self.total_size = 0
+
+    def add(self, key, size):
+        self.remove(key)
+        self.__append(key, size)
+        self.total_size += size
+
+    def touch(self, key):
+        """ Mark entry most recently used, returns False if not indexed.
+        """
+        link = self.entries.get(key, None)
+        if link is None:
+            return False
+        self.__unlink(key)
+        self.__append(key, link[3])
+        return True
+
+    def remove(self, key):
+        if key not in self.entries:
+            return None
+        size = self.__unlink(key)[3]
+        self.total_size -= size
+        return size
+
+    def __append(self, key, size):
+        root = self.root
+        last = root[0]
+        link = [last, root, key, size]
+        last[1] = root[0] = self.entries[key] = link
+
+    def __unlink(self, key):
+        link = self.entries.pop(key)
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+        return link
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __iter__(self):
+        keys = []
+        link = self.root[1]
+        while link is not self.root:
+            keys.append(link[2])
+            link = link[1]
+        return iter(keys)
+
+    def __len__(self):
+        return len(self.entries)
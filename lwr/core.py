@@ -5,6 +5,10 @@ from tempfile import tempdir
 
 from lwr.manager_factory import build_managers
 from lwr.cache import Cache
+from lwr.cache import DEFAULT_REAP_INTERVAL
+from lwr.cache import DEFAULT_BLOB_COLLECTION_INTERVAL
+from lwr.cache import DEFAULT_BLOB_GRACE_SECONDS
+from lwr.cache import DEFAULT_HIT_PIN_SECONDS
 from lwr.tools import ToolBox
 from lwr.tools.authorization import get_authorizer
 from lwr import messaging
@@ -30,7 +34,7 @@ class LwrApp(object):
     def __init__(self, **conf):
         if conf is None:
             conf = {}
-        self.__setup_staging_directory(conf.get("staging_directory", DEFAULT_STAGING_DIRECTORY))
+        self.__setup_staging_directory(conf.get("staging_directory", DEFAULT_STAGING_DIRECTORY), conf.get("staging_directory_layout", None))
         self.__setup_private_key(conf.get("private_key", DEFAULT_PRIVATE_KEY))
         self.__setup_persistence_directory(conf.get("persistence_directory", None))
         self.__setup_tool_config(conf)
@@ -39,7 +43,11 @@ class LwrApp(object):
         self.__setup_job_metrics(conf)
         self.__setup_managers(conf)
         self.__setup_file_cache(conf)
+        self.__setup_file_chunk_size(conf)
+        self.__setup_max_upload_compression_ratio(conf)
+        self.__setup_preallocate_uploads(conf)
         self.__setup_bind_to_message_queue(conf)
+        self.__setup_status_feeds(conf)
 
     def shutdown(self):
         for manager in self.managers.values():
@@ -51,6 +59,9 @@ class LwrApp(object):
         if self.__queue_state:
             self.__queue_state.deactivate()
 
+        if self.file_cache:
+            self.file_cache.close()
+
     def __setup_bind_to_message_queue(self, conf):
         message_queue_url = conf.get("message_queue_url", None)
         queue_state = None
@@ -58,6 +69,13 @@ class LwrApp(object):
             queue_state = messaging.bind_app(self, message_queue_url, conf)
         self.__queue_state = queue_state
 
+    def __setup_status_feeds(self, conf):
+        status_feeds = {}
+        if str(conf.get("status_feed", False)).lower() == "true":
+            max_updates = int(conf.get("status_feed_max_updates", messaging.status_feed.DEFAULT_MAX_UPDATES))
+            status_feeds = messaging.bind_app_to_status_feeds(self, max_updates=max_updates)
+        self.status_feeds = status_feeds
+
     def __setup_tool_config(self, conf):
         """
         Setups toolbox object and authorization mechanism based
@@ -76,8 +94,9 @@ class LwrApp(object):
         self.toolbox = toolbox
         self.authorizer = get_authorizer(toolbox)
 
-    def __setup_staging_directory(self, staging_directory):
+    def __setup_staging_directory(self, staging_directory, layout):
         self.staging_directory = os.path.abspath(staging_directory)
+        self.staging_directory_layout = layout
 
     def __setup_managers(self, conf):
         self.managers = build_managers(self, conf)
@@ -92,7 +111,37 @@ class LwrApp(object):
 
     def __setup_file_cache(self, conf):
         file_cache_dir = conf.get('file_cache_dir', None)
-        self.file_cache = Cache(file_cache_dir) if file_cache_dir else None
+        blob_grace_seconds = int(conf.get('file_cache_blob_grace_seconds', DEFAULT_BLOB_GRACE_SECONDS))
+        blob_collection_interval = float(conf.get('file_cache_blob_collection_interval', DEFAULT_BLOB_COLLECTION_INTERVAL))
+        persistence_backend = conf.get('persistence_backend', None)
+        layout = conf.get('file_cache_layout', None)
+        max_size = conf.get('file_cache_max_size', None)
+        max_size = int(max_size) if max_size else None
+        reap_interval = float(conf.get('file_cache_reap_interval', DEFAULT_REAP_INTERVAL))
+        hit_pin_seconds = float(conf.get('file_cache_hit_pin_seconds', DEFAULT_HIT_PIN_SECONDS))
+        self.file_cache = None
+        if file_cache_dir:
+            self.file_cache = Cache(
+                file_cache_dir,
+                blob_grace_seconds=blob_grace_seconds,
+                persistence_backend=persistence_backend,
+                max_size=max_size,
+                reap_interval=reap_interval,
+                layout=layout,
+                blob_collection_interval=blob_collection_interval,
+                hit_pin_seconds=hit_pin_seconds,
+            )
+
+    def __setup_file_chunk_size(self, conf):
+        file_chunk_size = conf.get('file_chunk_size', None)
+        self.file_chunk_size = int(file_chunk_size) if file_chunk_size else None
+
+    def __setup_max_upload_compression_ratio(self, conf):
+        max_ratio = conf.get('max_upload_compression_ratio', None)
+        self.max_upload_compression_ratio = int(max_ratio) if max_ratio else None
+
+    def __setup_preallocate_uploads(self, conf):
+        self.preallocate_uploads = str(conf.get('preallocate_uploads', False)).lower() == "true"
 
     def __setup_object_store(self, conf):
         if "object_store_config_file" not in conf:
@@ -44,7 +44,10 @@ from .staging.up import submit_job
 from .staging import ClientJobDescription
 from .staging import LwrOutputs
 from .staging import ClientOutputs
+from .staging.metrics import TransferMetrics
 from .client import OutputNotFoundException
+from .client import check_complete_many
+from .listener import StatusListener
 from .manager import build_client_manager
 from .destination import url_to_destination_params
 from .path_mapper import PathMapper
@@ -52,11 +55,14 @@ from .path_mapper import PathMapper
 __all__ = [
     build_client_manager,
     OutputNotFoundException,
+    check_complete_many,
+    StatusListener,
     url_to_destination_params,
     finish_job,
     submit_job,
     ClientJobDescription,
     LwrOutputs,
     ClientOutputs,
+    TransferMetrics,
     PathMapper,
 ]
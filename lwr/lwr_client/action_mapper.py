@@ -11,6 +11,8 @@ from re import compile
 from re import escape
 import galaxy.util
 from galaxy.util.bunch import Bunch
+from .compression import DEFAULT_SKIP_EXTENSIONS
+from .compression import skip_compression
 from .config_util import read_file
 from .util import directory_files
 from .util import unique_path_prefix
@@ -121,6 +123,15 @@ class FileActionMapper(object):
     ] }''')
     >>> unstructured_mapper.action('/old/galaxy/data/dataset_10245.dat', 'unstructured').action_type == u'transfer'
     True
+    >>> compressing_mapper = mapper_for(default_action="transfer", config_contents=r'''{"compression": "gzip", "paths": [ \
+      {"path": "/galaxy/raw", "action": "transfer", "compression": "none"} \
+    ] }''')
+    >>> compressing_mapper.action('/galaxy/data/dataset_1.dat', 'input').compression
+    'gzip'
+    >>> compressing_mapper.action('/galaxy/data/dataset_1.bam', 'input').compression is None
+    True
+    >>> compressing_mapper.action('/galaxy/raw/dataset_1.dat', 'input').compression is None
+    True
     """
 
     def __init__(self, client=None, config=None):
@@ -132,6 +143,11 @@ class FileActionMapper(object):
         self.default_action = config.get("default_action", "transfer")
         self.mappers = mappers_from_dicts(config.get("paths", []))
         self.files_endpoint = config.get("files_endpoint", None)
+        # Compression for transfer actions (gzip, zstd, or none) unless
+        # overridden for a path, files with these extensions are never
+        # compressed.
+        self.compression = config.get("compression", None)
+        self.compression_skip_extensions = config.get("compression_skip_extensions", DEFAULT_SKIP_EXTENSIONS)
 
     def action(self, path, type, mapper=None):
         mapper = self.__find_mapper(path, type, mapper)
@@ -155,6 +171,8 @@ class FileActionMapper(object):
         return dict(
             default_action=self.default_action,
             files_endpoint=self.files_endpoint,
+            compression=self.compression,
+            compression_skip_extensions=self.compression_skip_extensions,
             paths=map(lambda m: m.to_dict(), self.mappers)
         )
 
@@ -166,6 +184,8 @@ class FileActionMapper(object):
             config = dict()
         config["default_action"] = client.default_file_action
         config["files_endpoint"] = client.files_endpoint
+        if "compression" not in config:
+            config["compression"] = getattr(client, "compression", None)
         return config
 
     def __load_action_config(self, path):
@@ -209,6 +229,11 @@ class FileActionMapper(object):
             # TODO: URL encode path.
             url = "%s&path=%s&file_type=%s" % (url_base, action.path, file_type)
             action.url = url
+        elif action.action_type == "transfer":
+            if action.compression is None:
+                action.compression = self.compression
+            if action.compression == "none" or skip_compression(action.path, self.compression_skip_extensions):
+                action.compression = None
 
 REQUIRED_ACTION_KWD = object()
 
@@ -308,9 +333,16 @@ class TransferAction(BaseAction):
     """ This actions indicates that the LWR client should initiate an HTTP
     transfer of the corresponding path to the remote LWR server before
     launching the job. """
+    action_spec = dict(
+        compression=None,
+    )
     action_type = "transfer"
     staging = STAGING_ACTION_LOCAL
 
+    def __init__(self, path, file_lister=None, compression=None):
+        super(TransferAction, self).__init__(path, file_lister=file_lister)
+        self.compression = compression
+
 
 class CopyAction(BaseAction):
     """ This action indicates that the LWR client should execute a file system
@@ -462,6 +494,8 @@ class BasePathMapper(object):
 
 class PrefixPathMapper(BasePathMapper):
     match_type = 'prefix'
+    # Text following the prefix (and a separator) in references to paths.
+    path_pattern = "[^\s,\"\']+"
 
     def __init__(self, config):
         super(PrefixPathMapper, self).__init__(config)
@@ -471,9 +505,14 @@ class PrefixPathMapper(BasePathMapper):
         return path.startswith(self.prefix_path)
 
     def to_pattern(self):
-        pattern_str = "(%s%s[^\s,\"\']+)" % (escape(self.prefix_path), escape(sep))
+        pattern_str = "(%s%s%s)" % (escape(self.prefix_path), escape(sep), self.path_pattern)
         return compile(pattern_str)
 
+    def to_prefix(self):
+        """ Literal prefix of paths matched by ``to_pattern``.
+        """
+        return self.prefix_path + sep
+
     def to_dict(self):
         return self._extend_base_dict(path=self.prefix_path)
 
@@ -0,0 +1,161 @@
+"""
+Tar archives used to transfer many files between the LWR client and server in
+a single request.
+"""
+import os
+import re
+import tarfile
+
+from .util import ensure_directory
+
+BUFFER_SIZE = 64 * 1024
+
+
+def archive_name(output_type, name):
+    """ Name of the member describing output ``name`` in an outputs archive.
+
+    >>> archive_name("work_dir", "dataset_1_files/1.png")
+    'work_dir/dataset_1_files/1.png'
+    """
+    return "%s/%s" % (output_type, name.replace(os.sep, "/"))
+
+
+def tar_stream(members, chunk_size=BUFFER_SIZE):
+    """ Generate the contents of an uncompressed tar archive of ``members``
+    (pairs of archive name and path), files are read ``chunk_size`` bytes at a
+    time so archives of any size are streamed in bounded memory. Paths that
+    are not (or are no longer) regular files are skipped.
+
+    >>> import tempfile
+    >>> from io import BytesIO
+    >>> handle, path = tempfile.mkstemp()
+    >>> _ = os.write(handle, b"Hello World!")
+    >>> os.close(handle)
+    >>> archive = b"".join(tar_stream([("direct/hello.txt", path), ("direct/missing", path + ".missing")]))
+    >>> len(archive) % tarfile.RECORDSIZE
+    0
+    >>> tar = tarfile.open(fileobj=BytesIO(archive))
+    >>> tar.getnames()
+    ['direct/hello.txt']
+    >>> tar.extractfile("direct/hello.txt").read() == b"Hello World!"
+    True
+    >>> os.remove(path)
+    """
+    written = 0
+    for name, path in members:
+        try:
+            input = open(path, "rb")
+        except (IOError, OSError):
+            continue
+        try:
+            stat = os.fstat(input.fileno())
+            if not os.path.isfile(path):
+                continue
+            info = tarfile.TarInfo(name)
+            info.size = stat.st_size
+            info.mtime = stat.st_mtime
+            info.mode = stat.st_mode & 0o777
+            header = info.tobuf(tarfile.PAX_FORMAT, "utf-8")
+            written += len(header)
+            yield header
+            remaining = info.size
+            while remaining > 0:
+                buffer = input.read(min(chunk_size, remaining))
+                if not buffer:
+                    # File shrank while being archived, pad to declared size.
+                    buffer = b"\0" * min(chunk_size, remaining)
+                remaining -= len(buffer)
+                written += len(buffer)
+                yield buffer
+        finally:
+            input.close()
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            written += padding
+            yield b"\0" * padding
+    # Two empty blocks mark the end of the archive, which is then padded to a
+    # whole record.
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    yield b"\0" * end
+
+
+def extract_files(archive_path, destinations):
+    """ Extract regular file members of the tar archive at ``archive_path``
+    named in ``destinations`` (a dictionary of member names to local paths)
+    to the corresponding paths, other members are ignored. Returns the paths
+    extracted to.
+    """
+    destinations = dict((_text(name), path) for name, path in destinations.items())
+    extracted = []
+    tar = tarfile.open(archive_path, "r|", encoding="utf-8")
+    try:
+        for member in tar:
+            name = _text(member.name)
+            path = destinations.get(name, None)
+            if path is None or not member.isfile():
+                continue
+            ensure_directory(path)
+            contents = tar.extractfile(member)
+            with open(path, "wb") as output:
+                while True:
+                    buffer = contents.read(BUFFER_SIZE)
+                    if not buffer:
+                        break
+                    output.write(buffer)
+            extracted.append(path)
+    finally:
+        tar.close()
+    return extracted
+
+
+def extract_members(input, handler):
+    """ Read a tar archive from file-like ``input`` (as a stream) and pass
+    each regular file member to ``handler`` as ``(name, contents)``, where
+    ``contents`` is file-like. Returns a list of the handler's results in
+    archive order.
+
+    Directory members are skipped, an exception is raised for any other kind
+    of member (links, devices, ...) or for names that are absolute or refer
+    to a parent directory - ``handler`` should still verify the paths it
+    writes to.
+
+    >>> from io import BytesIO
+    >>> def archive(name):
+    ...     output = BytesIO()
+    ...     tar = tarfile.open(fileobj=output, mode="w")
+    ...     tar.addfile(tarfile.TarInfo(name), BytesIO())
+    ...     tar.close()
+    ...     return BytesIO(output.getvalue())
+    >>> extract_members(archive("dataset_1_files/1.png"), lambda name, contents: name) == ["dataset_1_files/1.png"]
+    True
+    >>> extract_members(archive("dataset_1_files/../../1.png"), lambda name, contents: name)
+    Traceback (most recent call last):
+    Exception: Unsafe archive member name dataset_1_files/../../1.png
+    """
+    results = []
+    tar = tarfile.open(fileobj=input, mode="r|", encoding="utf-8")
+    try:
+        for member in tar:
+            name = _text(member.name)
+            if member.isdir():
+                continue
+            if not member.isfile():
+                raise Exception("Archive member %s is not a regular file" % name)
+            _verify_member_name(name)
+            results.append(handler(name, tar.extractfile(member)))
+    finally:
+        tar.close()
+    return results
+
+
+def _verify_member_name(name):
+    parts = re.split(r"[/\\]", name)
+    if not name or name.startswith("/") or os.path.isabs(name) or ".." in parts or ":" in parts[0]:
+        raise Exception("Unsafe archive member name %s" % name)
+
+
+def _text(name):
+    if isinstance(name, bytes):
+        name = name.decode("utf-8")
+    return name
@@ -1,13 +1,30 @@
 import os
+import tempfile
+from base64 import b64encode
 from json import dumps
+from json import loads
 
+from .archive import archive_name
+from .archive import extract_files
+from .archive import tar_stream
 from .destination import submit_params
 from .setup_handler import build as build_setup_handler
 from .job_directory import RemoteJobDirectory
 from .decorators import parseJson
+from .decorators import record_retry
 from .decorators import retry
+from .util import byte_ranges
+from .util import chain
+from .util import completed_future
 from .util import copy
+from .util import body_etag
+from .util import content_etag
+from .util import DigestCache
 from .util import ensure_directory
+from .util import FileRecord
+from .util import file_sha256
+from .util import quote_etag
+from .util import source_validator
 from .util import to_base64_json
 
 
@@ -15,6 +32,25 @@ import logging
 log = logging.getLogger(__name__)
 
 CACHE_WAIT_SECONDS = 3
+DEFAULT_CHUNK_COUNT = 4
+# A job's check_complete response no longer changes once it has one of these
+# statuses.
+FINAL_STATUSES = ["complete", "cancelled"]
+
+# Shared so digests of files staged for many jobs are only computed once.
+_digest_cache = DigestCache()
+# Outputs known to have been downloaded in full.
+_complete_outputs = FileRecord()
+
+
+class TransferVerificationException(Exception):
+
+    def __init__(self, path, message):
+        self.path = path
+        self.message = message
+
+    def __str__(self):
+        return "Failed to verify transfer of %s - %s" % (self.path, self.message)
 
 
 class OutputNotFoundException(Exception):
@@ -38,6 +74,7 @@ class BaseJobClient(object):
                 remote_staging_directory=staging_directory,
                 remote_id=job_id,
                 remote_sep=sep,
+                layout=destination_params.get("jobs_directory_layout", None),
             )
         else:
             job_directory = None
@@ -47,6 +84,9 @@ class BaseJobClient(object):
 
         self.default_file_action = self.destination_params.get("default_file_action", "transfer")
         self.action_config_path = self.destination_params.get("file_action_config", None)
+        # Default compression (gzip or zstd) for transfer actions, paths may
+        # override this in file_action_config.
+        self.compression = self.destination_params.get("compression", None)
 
         self.setup_handler = build_setup_handler(self, destination_params)
 
@@ -78,11 +118,35 @@ class JobClient(BaseJobClient):
         connection parameters, either url with dict containing url (and optionally `private_token`).
     job_id : str
         Galaxy job/task id.
+
+    Files larger than the destination parameter `chunk_threshold` (in bytes,
+    unset by default) are split into `chunk_count` byte ranges which are
+    transferred concurrently and then verified by size and checksum.
+
+    If `transfer_scheduler` (a `TransferScheduler`) is supplied, batches of
+    uploads are run by it rather than submitted to the transport together -
+    the destination parameter `transfer_priority` (lower is sooner, 0 by
+    default) orders this job's transfers relative to other jobs'.
     """
 
-    def __init__(self, destination_params, job_id, job_manager_interface):
+    def __init__(self, destination_params, job_id, job_manager_interface, transfer_scheduler=None):
         super(JobClient, self).__init__(destination_params, job_id)
         self.job_manager_interface = job_manager_interface
+        self.transfer_scheduler = transfer_scheduler
+        self.transfer_priority = int(self.destination_params.get("transfer_priority", 0))
+        chunk_threshold = self.destination_params.get("chunk_threshold", None)
+        self.chunk_threshold = int(chunk_threshold) if chunk_threshold else None
+        self.chunk_count = int(self.destination_params.get("chunk_count", DEFAULT_CHUNK_COUNT))
+        batch_upload_threshold = self.destination_params.get("batch_upload_threshold", None)
+        self.batch_upload_threshold = int(batch_upload_threshold) if batch_upload_threshold else None
+        self.deduplicate_inputs = str(self.destination_params.get("deduplicate_inputs", False)).lower() == "true"
+        self.verify_uploads = str(self.destination_params.get("verify_uploads", False)).lower() == "true"
+        self.archive_outputs = str(self.destination_params.get("archive_outputs", False)).lower() == "true"
+        self.archive_extra_inputs = str(self.destination_params.get("archive_extra_inputs", False)).lower() == "true"
+        # Raw final check_complete response, revalidated instead of refetched.
+        self.__final_status_response = None
+        # (etag, value) of this job's last check_complete_many entry.
+        self._many_status = None
 
     def launch(self, command_line, dependencies_description=None, env=[], remote_staging=[], job_config=None):
         """
@@ -95,6 +159,17 @@ class JobClient(BaseJobClient):
         command_line : str
             Command to execute.
         """
+        launch_params = self._launch_params(command_line, dependencies_description, env, remote_staging, job_config)
+        return self._raw_execute("launch", launch_params)
+
+    def launch_async(self, command_line, dependencies_description=None, env=[], remote_staging=[], job_config=None):
+        """
+        Like `launch` but returns a Future.
+        """
+        launch_params = self._launch_params(command_line, dependencies_description, env, remote_staging, job_config)
+        return self._raw_execute_async("launch", launch_params)
+
+    def _launch_params(self, command_line, dependencies_description, env, remote_staging, job_config):
         launch_params = dict(command_line=command_line, job_id=self.job_id)
         submit_params_dict = submit_params(self.destination_params)
         if submit_params_dict:
@@ -111,7 +186,7 @@ class JobClient(BaseJobClient):
             # before queueing.
             setup_params = _setup_params_from_job_config(job_config)
             launch_params["setup_params"] = dumps(setup_params)
-        return self._raw_execute("launch", launch_params)
+        return launch_params
 
     def full_status(self):
         """ Return a dictionary summarizing final state of job.
@@ -130,21 +205,44 @@ class JobClient(BaseJobClient):
         """
         Get check_complete response from the remote server.
         """
-        check_complete_response = self._raw_execute("check_complete", {"job_id": self.job_id})
+        etag = None
+        if self.__final_status_response is not None:
+            etag = quote_etag(body_etag(self.__final_status_response))
+        check_complete_response = self._raw_execute("check_complete", {"job_id": self.job_id}, etag=etag)
+        if check_complete_response is None:
+            # Not modified.
+            return self.__final_status_response
+        if _status(loads(check_complete_response)) in FINAL_STATUSES:
+            self.__final_status_response = check_complete_response
         return check_complete_response
 
     def get_status(self):
-        check_complete_response = self.raw_check_complete()
-        # Older LWR instances won't set status so use 'complete', at some
-        # point drop backward compatibility.
-        status = check_complete_response.get("status", None)
-        if status in ["status", None]:
-            # LEGACY: Bug in certains older LWR instances returned literal
-            # "status".
-            complete = check_complete_response["complete"] == "true"
-            old_status = "complete" if complete else "running"
-            status = old_status
-        return status
+        return _status(self.raw_check_complete())
+
+    @parseJson()
+    def status_updates(self, since=None, timeout=None):
+        """
+        Wait for job state changes published by the remote LWR's status feed
+        after ``since`` (a token returned by a previous call). See
+        ``StatusListener`` for following the feed in the background.
+        """
+        args = {}
+        if since is not None:
+            args["since"] = since
+        if timeout is not None:
+            args["timeout"] = timeout
+        return self._raw_execute("status_updates", args)
+
+    @parseJson()
+    def _check_complete_many(self, job_etags):
+        return self._raw_execute("check_complete_many", {}, data=dumps(job_etags))
+
+    def get_status_async(self):
+        """
+        Like `get_status` but returns a Future (and is not retried).
+        """
+        check_complete_future = self._raw_execute_async("check_complete", {"job_id": self.job_id})
+        return chain(check_complete_future, lambda response: _status(loads(response)))
 
     def clean(self):
         """
@@ -159,7 +257,7 @@ class JobClient(BaseJobClient):
         """
         return self._raw_execute("setup", setup_args)
 
-    def put_file(self, path, input_type, name=None, contents=None, action_type='transfer'):
+    def put_file(self, path, input_type, name=None, contents=None, action_type='transfer', compression=None):
         if not name:
             name = os.path.basename(path)
         args = {"job_id": self.job_id, "name": name, "input_type": input_type}
@@ -167,13 +265,228 @@ class JobClient(BaseJobClient):
         if contents:
             input_path = None
         if action_type == 'transfer':
-            return self._upload_file(args, contents, input_path)
+            linked_response = self.__try_link_stored_input(args, input_path, input_type)
+            if linked_response:
+                return linked_response
+            return self._upload_file(args, contents, input_path, compression=compression)
         elif action_type == 'copy':
             lwr_path = self._raw_execute('input_path', args)
             copy(path, lwr_path)
             return {'path': lwr_path}
 
-    def fetch_output(self, path, name, working_directory, action_type, output_type):
+    def put_file_async(self, path, input_type, name=None, contents=None, action_type='transfer', compression=None):
+        """
+        Like `put_file` but returns a Future. Plain HTTP uploads are
+        multiplexed by interfaces supporting it, other files are staged
+        before returning.
+        """
+        put_request = dict(path=path, input_type=input_type, name=name, contents=contents, action_type=action_type, compression=compression)
+        command = self._put_file_command(**put_request)
+        if command is None or self.__deduplicate(command["input_path"], input_type):
+            return completed_future(self.put_file, **put_request)
+
+        def verified_response(response):
+            response = loads(response)
+            if command["input_path"]:
+                self._verify_upload(command["input_path"], response)
+            return response
+        return chain(self._raw_execute_async(**command), verified_response)
+
+    def batch_put_files(self, put_requests):
+        """
+        Stage many files at once - each element of `put_requests` is a
+        dictionary of keyword arguments to `put_file`. HTTP transfers are
+        submitted to the transport together so they may proceed concurrently.
+
+        If the destination parameter `batch_upload_threshold` is set, files
+        no larger than this (in bytes) are instead sent together inline in a
+        single request to the LWR's batch route. If `archive_extra_inputs` is
+        set, requests marked with `archive` (input extra files) are sent
+        together in a single tar archive.
+
+        Returns a list containing the `put_file` response for each request or
+        the exception raised while transferring it.
+        """
+        put_requests = [dict(put_request) for put_request in put_requests]
+        archive_requested = [put_request.pop("archive", False) for put_request in put_requests]
+        results = [None] * len(put_requests)
+        # (index, command) of each HTTP transfer, by how it is sent.
+        uploads = []
+        inline_uploads = []
+        archive_uploads = []
+        for i, put_request in enumerate(put_requests):
+            command = self._put_file_command(**put_request)
+            if command is None:
+                results[i] = _capture(self.put_file, put_request)
+            elif command["input_path"] and archive_requested[i] and self.archive_extra_inputs:
+                archive_uploads.append((i, command))
+            else:
+                results[i] = self.__try_link_stored_input(command["args"], command["input_path"], put_request["input_type"])
+                if results[i] is None:
+                    (inline_uploads if self.__inline(command) else uploads).append((i, command))
+        uploads.extend(self.__put_archived(archive_uploads, results))
+        uploads.extend(self.__put_inline(inline_uploads, results))
+        self.__put_concurrently(uploads, results)
+        return results
+
+    def __put_archived(self, uploads, results):
+        """ Send `uploads` ((index, command) pairs) in one tar archive, setting
+        their results. Returns the uploads to send individually instead.
+        """
+        if not uploads:
+            return []
+        try:
+            archive_results = self._put_extra_inputs_archive([command for _, command in uploads])
+        except Exception:
+            log.exception("Archive upload failed, uploading files individually.")
+            record_retry()
+            return uploads
+        for (i, command), result in zip(uploads, archive_results):
+            results[i] = self.__verified_upload(command, result)
+        return []
+
+    def __put_inline(self, uploads, results):
+        """ Send `uploads` ((index, command) pairs) inline in one batch
+        request, setting their results. Returns the uploads to send
+        individually (retrying as needed) instead.
+        """
+        if not uploads:
+            return []
+        try:
+            batch_results = self._raw_execute_batch([command for _, command in uploads])
+        except Exception:
+            log.exception("Batch request failed, uploading files individually.")
+            record_retry()
+            return uploads
+        failed = []
+        for (i, command), result in zip(uploads, batch_results):
+            result = self.__verified_upload(command, result)
+            if isinstance(result, Exception):
+                failed.append((i, command))
+            else:
+                results[i] = result
+        return failed
+
+    def __put_concurrently(self, uploads, results):
+        """ Send `uploads` ((index, command) pairs) through the transport
+        together, retrying failed uploads individually, and set their results.
+        """
+        commands = [command for _, command in uploads]
+        for (i, command), result in zip(uploads, self.__execute_uploads(commands)):
+            if not isinstance(result, Exception):
+                try:
+                    result = loads(result)
+                except ValueError as e:
+                    result = e
+            result = self.__verified_upload(command, result)
+            if isinstance(result, Exception):
+                log.debug("Batch upload of %s failed, retrying individually." % command["args"]["name"])
+                record_retry()
+                result = _capture(self.__retry_upload, dict(command=command))
+            results[i] = result
+
+    def batch_fetch_outputs(self, fetch_requests):
+        """
+        Fetch many outputs at once - each element of `fetch_requests` is a
+        dictionary of keyword arguments to `fetch_output`. HTTP downloads are
+        submitted to the transport together so they may proceed concurrently,
+        downloads that fail this way are retried individually.
+
+        If the destination parameter `archive_outputs` is set, these HTTP
+        downloads are instead streamed from the LWR in a single tar archive.
+
+        Returns a list containing, for each request, None if the output was
+        fetched or the exception raised while fetching it.
+        """
+        failures = [None] * len(fetch_requests)
+        commands = []
+        command_indices = []
+        for i, fetch_request in enumerate(fetch_requests):
+            command = self._fetch_output_command(**fetch_request)
+            if command is None:
+                failures[i] = _capture_failure(self.fetch_output, fetch_request)
+            else:
+                ensure_directory(command["output_path"])
+                commands.append(command)
+                command_indices.append(i)
+        if self.archive_outputs and commands:
+            try:
+                archived_paths = set(self._fetch_outputs_archive(commands))
+                for archived_path in archived_paths:
+                    _complete_outputs.add(archived_path)
+            except Exception:
+                log.exception("Failed to download outputs archive, downloading outputs individually.")
+                record_retry()
+                archived_paths = set()
+            # Outputs missing from the archive are fetched individually, so
+            # failures are reported as for any other download.
+            remaining = [(index, remaining_command) for index, remaining_command in zip(command_indices, commands)
+                         if remaining_command["output_path"] not in archived_paths]
+            command_indices = [index for index, _ in remaining]
+            commands = [remaining_command for _, remaining_command in remaining]
+        for i, result in zip(command_indices, self._raw_execute_many(commands)):
+            if isinstance(result, Exception):
+                log.debug("Batch download of %s failed, retrying individually." % fetch_requests[i]["path"])
+                record_retry()
+                failures[i] = _capture_failure(self.fetch_output, fetch_requests[i])
+            else:
+                _complete_outputs.add(fetch_requests[i]["path"])
+        return failures
+
+    def _put_extra_inputs_archive(self, commands):
+        """ Upload the input extra files described by `commands` (upload
+        commands as built by `_put_file_command`) in one tar archive, returns
+        the put response for each.
+        """
+        members = [(command["args"]["name"], command["input_path"]) for command in commands]
+        handle, archive_path = tempfile.mkstemp(prefix="lwr_inputs_", suffix=".tar")
+        try:
+            with os.fdopen(handle, "wb") as archive:
+                for chunk in tar_stream(members):
+                    archive.write(chunk)
+            archive_args = {"job_id": self.job_id}
+            responses = loads(self._raw_execute("upload_extra_inputs_archive", archive_args, input_path=archive_path, compression=self.compression))
+        finally:
+            os.remove(archive_path)
+        if len(responses) != len(members):
+            raise Exception("Archive upload created %d files, expected %d." % (len(responses), len(members)))
+        return responses
+
+    def _fetch_outputs_archive(self, commands):
+        """ Download the outputs described by `commands` (download_output
+        commands as built by `_fetch_output_command`) in one tar archive,
+        returns the paths of the outputs it contained.
+        """
+        request = {}
+        destinations = {}
+        for command in commands:
+            args = command["args"]
+            request.setdefault(args["output_type"], []).append(args["name"])
+            destinations[archive_name(args["output_type"], args["name"])] = command["output_path"]
+        handle, archive_path = tempfile.mkstemp(prefix="lwr_outputs_", suffix=".tar")
+        os.close(handle)
+        try:
+            self._raw_execute("download_outputs_archive", {"job_id": self.job_id}, data=dumps(request),
+                              output_path=archive_path, compression=self.compression)
+            return extract_files(archive_path, destinations)
+        finally:
+            os.remove(archive_path)
+
+    def fetch_output_async(self, path, name, working_directory, action_type, output_type, compression=None):
+        """
+        Like `fetch_output` but returns a Future (and is not retried). Plain
+        HTTP downloads are multiplexed by interfaces supporting it, other
+        outputs are fetched before returning.
+        """
+        fetch_request = dict(path=path, name=name, working_directory=working_directory,
+                             action_type=action_type, output_type=output_type, compression=compression)
+        command = self._fetch_output_command(**fetch_request)
+        if command is None:
+            return completed_future(self.fetch_output, **fetch_request)
+        ensure_directory(command["output_path"])
+        return chain(self._raw_execute_async(**command), lambda response: _complete_outputs.add(path))
+
+    def fetch_output(self, path, name, working_directory, action_type, output_type, compression=None):
         """
         Fetch (transfer, copy, etc...) an output from the remote LWR server.
 
@@ -191,18 +504,174 @@ class JobClient(BaseJobClient):
             an option in this case LWR is asked for location - this will only be
             used if targetting an older LWR server that didn't return statuses
             allowing this to be inferred.
+        compression : str
+            Encoding (gzip or zstd) to request the transfer be compressed
+            with, if any.
         """
         if output_type == 'legacy':
             self._fetch_output_legacy(path, working_directory, action_type=action_type)
         elif output_type == 'output_workdir':
-            self._fetch_work_dir_output(name, working_directory, path, action_type=action_type)
+            self._fetch_work_dir_output(name, working_directory, path, action_type=action_type, compression=compression)
         elif output_type == 'output':
-            self._fetch_output(path=path, name=name, action_type=action_type)
+            self._fetch_output(path=path, name=name, action_type=action_type, compression=compression)
         else:
             raise Exception("Unknown output_type %s" % output_type)
 
-    def _raw_execute(self, command, args={}, data=None, input_path=None, output_path=None):
-        return self.job_manager_interface.execute(command, args, data, input_path, output_path)
+    def _raw_execute(self, command, args={}, data=None, input_path=None, output_path=None,
+                     resume=False, byte_range=None, compression=None, etag=None):
+        return self.job_manager_interface.execute(command, args, data, input_path, output_path,
+                                                  resume=resume, byte_range=byte_range, compression=compression, etag=etag)
+
+    def _raw_execute_async(self, command, args={}, data=None, input_path=None, output_path=None,
+                           resume=False, byte_range=None, compression=None, etag=None):
+        return self.job_manager_interface.execute_async(command, args=args, data=data, input_path=input_path, output_path=output_path,
+                                                        resume=resume, byte_range=byte_range, compression=compression, etag=etag)
+
+    def _raw_execute_many(self, commands):
+        if not commands:
+            return []
+        return self.job_manager_interface.execute_many(commands)
+
+    def __execute_uploads(self, commands):
+        """ As `_raw_execute_many`, but through the transfer scheduler if
+        there is one.
+        """
+        if self.transfer_scheduler is None:
+            return self._raw_execute_many(commands)
+        futures = []
+        for command in commands:
+            input_path = command.get("input_path", None)
+            futures.append(self.transfer_scheduler.submit(
+                _capture,
+                (self._raw_execute, command),
+                destination=self.destination_params.get("url", None),
+                size=os.path.getsize(input_path) if input_path else len(command.get("data", None) or ""),
+                priority=self.transfer_priority,
+            ))
+        return [future.result() for future in futures]
+
+    def _raw_execute_batch(self, commands):
+        """ Execute commands (as for `_raw_execute_many`) in one request to the
+        LWR's batch route, sending their data or input_path contents inline.
+        Returns the parsed result of each command or an exception describing
+        why it failed - raises an exception if the batch request itself fails.
+        """
+        batch = []
+        for command in commands:
+            batch.append(dict(
+                command=command["command"],
+                args=command.get("args", {}),
+                body=_inline_body(command),
+            ))
+        responses = loads(self._raw_execute("batch", {}, data=dumps(batch)))
+        results = []
+        for command, response in zip(commands, responses):
+            if response["ok"]:
+                results.append(response["result"])
+            else:
+                message = "Batched command %s failed - %s" % (command["command"], response["error"])
+                results.append(Exception(message))
+        return results
+
+    def __deduplicate(self, input_path, input_type):
+        return self.deduplicate_inputs and input_path and input_type == "input"
+
+    def __try_link_stored_input(self, args, input_path, input_type):
+        """ As `__link_stored_input` if inputs are deduplicated, but returns
+        None (so the file is uploaded as usual) if that fails.
+        """
+        if not self.__deduplicate(input_path, input_type):
+            return None
+        linked_response = _capture(self.__link_stored_input, dict(args=args, input_path=input_path))
+        if isinstance(linked_response, Exception):
+            log.warn("Failed to link stored contents of %s, uploading it - %s" % (input_path, linked_response))
+            return None
+        return linked_response
+
+    def __link_stored_input(self, args, input_path):
+        """ Ask the LWR to link already stored contents matching input_path
+        into place, returns the put response if it did. Otherwise sets sha256
+        in args so the LWR stores the upload for future jobs.
+        """
+        sha256 = _digest_cache.sha256(input_path)
+        link_args = dict(job_id=self.job_id, name=args["name"], input_type="input", sha256=sha256)
+        response = loads(self._raw_execute("link_stored_input", link_args))
+        if response["linked"]:
+            return {"path": response["path"]}
+        args["sha256"] = sha256
+        return None
+
+    def __verified_upload(self, command, response):
+        """ Return put response for command, or the exception raised verifying
+        the upload.
+        """
+        if isinstance(response, Exception) or not command.get("input_path", None):
+            return response
+        try:
+            self._verify_upload(command["input_path"], response)
+        except Exception as e:
+            return e
+        return response
+
+    def _verify_upload(self, input_path, response):
+        # Older LWR servers don't include size and sha256 in upload responses.
+        if self.verify_uploads and "sha256" in response:
+            _verify_transfer(input_path, response)
+
+    def __inline(self, command):
+        if self.batch_upload_threshold is None or command.get("compression", None):
+            return False
+        input_path = command.get("input_path", None)
+        return input_path is None or os.path.getsize(input_path) <= self.batch_upload_threshold
+
+    def _put_file_command(self, path, input_type, name=None, contents=None, action_type='transfer', compression=None):
+        """ Describe HTTP transfer corresponding to `put_file` call as a
+        command for `_raw_execute_many` (or None if not an HTTP transfer).
+        """
+        if action_type != 'transfer':
+            return None
+        input_path = None if contents else path
+        if input_path and self._chunked(os.path.getsize(input_path)):
+            return None
+        if not name:
+            name = os.path.basename(path)
+        args = {"job_id": self.job_id, "name": name, "input_type": input_type}
+        command = self._upload_file_action(args)
+        return dict(command=command, args=args, data=contents, input_path=input_path, compression=compression)
+
+    def _fetch_output_command(self, path, name, working_directory, action_type, output_type, compression=None):
+        """ Describe HTTP download corresponding to `fetch_output` call as a
+        command for `_raw_execute_many` (or None if not an HTTP download).
+        """
+        if action_type != 'transfer' or self.chunk_threshold is not None:
+            # Output sizes aren't known up front, download individually so
+            # large outputs can be chunked.
+            return None
+        if output_type == 'output_workdir':
+            remote_output_type = "work_dir"
+        elif output_type == 'output':
+            remote_output_type = "direct"
+            if not name:
+                name = os.path.basename(path)
+        else:
+            return None
+        output_params = {
+            "name": name,
+            "job_id": self.job_id,
+            "output_type": remote_output_type
+        }
+        etag = self._output_etag(path)
+        return dict(command="download_output", args=output_params, output_path=path, compression=compression, etag=etag, resume=not etag)
+
+    def _output_etag(self, path):
+        """ Entity tag of an output already downloaded in full to ``path``
+        (e.g. by an earlier attempt to finish the job), the LWR only resends
+        the output if its contents differ. Other files at ``path`` (e.g. left
+        by an interrupted download) are resumed instead, so aren't hashed.
+        """
+        if path not in _complete_outputs or not os.path.getsize(path):
+            return None
+        return quote_etag(content_etag(_digest_cache.sha256(path)))
 
     # Deprecated
     def _fetch_output_legacy(self, path, working_directory, action_type='transfer'):
@@ -220,33 +689,70 @@ class JobClient(BaseJobClient):
 
         self.__populate_output_path(name, path, output_type, action_type)
 
-    def _fetch_output(self, path, name=None, check_exists_remotely=False, action_type='transfer'):
+    def _fetch_output(self, path, name=None, check_exists_remotely=False, action_type='transfer', compression=None):
         if not name:
             # Extra files will send in the path.
             name = os.path.basename(path)
 
         output_type = "direct"  # Task/from_work_dir outputs now handled with fetch_work_dir_output
-        self.__populate_output_path(name, path, output_type, action_type)
+        self.__populate_output_path(name, path, output_type, action_type, compression=compression)
 
-    def _fetch_work_dir_output(self, name, working_directory, output_path, action_type='transfer'):
+    def _fetch_work_dir_output(self, name, working_directory, output_path, action_type='transfer', compression=None):
         ensure_directory(output_path)
         if action_type == 'transfer':
-            self.__raw_download_output(name, self.job_id, "work_dir", output_path)
+            self.__raw_download_output(name, self.job_id, "work_dir", output_path, compression=compression)
         else:  # Even if action is none - LWR has a different work_dir so this needs to be copied.
             lwr_path = self._output_path(name, self.job_id, 'work_dir')['path']
             copy(lwr_path, output_path)
 
-    def __populate_output_path(self, name, output_path, output_type, action_type):
+    def __populate_output_path(self, name, output_path, output_type, action_type, compression=None):
         ensure_directory(output_path)
         if action_type == 'transfer':
-            self.__raw_download_output(name, self.job_id, output_type, output_path)
+            self.__raw_download_output(name, self.job_id, output_type, output_path, compression=compression)
         elif action_type == 'copy':
             lwr_path = self._output_path(name, self.job_id, output_type)['path']
             copy(lwr_path, output_path)
 
+    def _chunked(self, size):
+        return self.chunk_threshold is not None and size > self.chunk_threshold
+
+    def _upload_file(self, args, contents, input_path, compression=None):
+        if input_path and self._chunked(os.path.getsize(input_path)):
+            return self.__upload_file_chunks(args, input_path)
+        response = self.__upload_file(args, contents, input_path, compression)
+        if input_path:
+            self._verify_upload(input_path, response)
+        return response
+
     @parseJson()
-    def _upload_file(self, args, contents, input_path):
-        return self._raw_execute(self._upload_file_action(args), args, contents, input_path)
+    def __upload_file(self, args, contents, input_path, compression):
+        return self._raw_execute(self._upload_file_action(args), args, contents, input_path, compression=compression)
+
+    def __upload_file_chunks(self, args, input_path):
+        size = os.path.getsize(input_path)
+        commands = []
+        for byte_range in byte_ranges(size, self.chunk_count):
+            chunk_args = dict(args, offset=byte_range[0], size=size)
+            commands.append(dict(command="upload_file_chunk", args=chunk_args, input_path=input_path, byte_range=byte_range))
+        for command, result in zip(commands, self._raw_execute_many(commands)):
+            if isinstance(result, Exception):
+                log.debug("Chunked upload of %s at offset %d failed, retrying." % (input_path, command["byte_range"][0]))
+                record_retry()
+                self.__upload_file_chunk(command)
+        response = loads(self._raw_execute("complete_chunked_upload", dict(args, size=size)))
+        _verify_transfer(input_path, response)
+        return {"path": response["path"]}
+
+    @retry()
+    def __retry_upload(self, command):
+        response = self.__verified_upload(command, loads(self._raw_execute(**command)))
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    @retry()
+    def __upload_file_chunk(self, command):
+        self._raw_execute(**command)
 
     def _upload_file_action(self, args):
         # Hack for backward compatibility, instead of using new upload_file
@@ -277,14 +783,58 @@ class JobClient(BaseJobClient):
                                   "job_id": self.job_id,
                                   "output_type": output_type})
 
-    @retry()
-    def __raw_download_output(self, name, job_id, output_type, output_path):
+    def __raw_download_output(self, name, job_id, output_type, output_path, compression=None):
         output_params = {
             "name": name,
             "job_id": self.job_id,
             "output_type": output_type
         }
-        self._raw_execute("download_output", output_params, output_path=output_path)
+        if self.chunk_threshold is not None:
+            size = self._output_info(output_params)["size"]
+            if self._chunked(size):
+                self.__download_output_chunks(output_params, output_path, size)
+                _complete_outputs.add(output_path)
+                return
+        etag = self._output_etag(output_path)
+        if etag:
+            self.__conditional_download_output(output_params, output_path, compression, etag)
+        else:
+            # Resume from any bytes already written to output_path by an
+            # earlier (interrupted or retried) attempt.
+            self.__resume_download_output(output_params, output_path, compression)
+        _complete_outputs.add(output_path)
+
+    def __download_output_chunks(self, output_params, output_path, size):
+        # Pre-allocate output_path so ranges can be written at their offsets.
+        with open(output_path, 'wb') as output:
+            output.truncate(size)
+        commands = []
+        for byte_range in byte_ranges(size, self.chunk_count):
+            commands.append(dict(command="download_output", args=output_params.copy(), output_path=output_path, byte_range=byte_range))
+        for command, result in zip(commands, self._raw_execute_many(commands)):
+            if isinstance(result, Exception):
+                log.debug("Chunked download of %s at offset %d failed, retrying." % (output_path, command["byte_range"][0]))
+                record_retry()
+                self.__download_output_chunk(command)
+        _verify_transfer(output_path, self._output_info(output_params, checksum=True))
+
+    @retry()
+    def __download_output_chunk(self, command):
+        self._raw_execute(**command)
+
+    @parseJson()
+    def _output_info(self, output_params, checksum=False):
+        return self._raw_execute("output_info", dict(output_params, checksum=checksum))
+
+    @retry()
+    def __resume_download_output(self, output_params, output_path, compression):
+        # Transports only request compression while output_path is empty,
+        # resumed ranges are sent uncompressed.
+        self._raw_execute("download_output", output_params, output_path=output_path, resume=True, compression=compression)
+
+    @retry()
+    def __conditional_download_output(self, output_params, output_path, compression, etag):
+        self._raw_execute("download_output", output_params, output_path=output_path, compression=compression, etag=etag)
 
 
 class BaseMessageJobClient(BaseJobClient):
@@ -377,46 +927,165 @@ class MessageCLIJobClient(BaseMessageJobClient):
 class InputCachingJobClient(JobClient):
     """
     Beta client that cache's staged files to prevent duplication.
+
+    Cached copies are validated against the size and modification time of
+    the local file, and (if the destination parameter `cache_digest` is
+    `sampled` or `full`) a digest of its contents - the file is transferred
+    again if the LWR reports its copy is stale.
     """
 
-    def __init__(self, destination_params, job_id, job_manager_interface, client_cacher):
-        super(InputCachingJobClient, self).__init__(destination_params, job_id, job_manager_interface)
+    def __init__(self, destination_params, job_id, job_manager_interface, client_cacher, transfer_scheduler=None):
+        super(InputCachingJobClient, self).__init__(destination_params, job_id, job_manager_interface, transfer_scheduler=transfer_scheduler)
         self.client_cacher = client_cacher
+        self.cache_digest = self.destination_params.get("cache_digest", None)
 
     @parseJson()
-    def _upload_file(self, args, contents, input_path):
+    def _upload_file(self, args, contents, input_path, compression=None):
+        # Cached files are transferred once by the client cacher and then
+        # copied server side, compression is not used.
         action = self._upload_file_action(args)
         if contents:
             input_path = None
             return self._raw_execute(action, args, contents, input_path)
         else:
-            event_holder = self.client_cacher.acquire_event(input_path)
-            cache_required = self.cache_required(input_path)
-            if cache_required:
-                self.client_cacher.queue_transfer(self, input_path)
-            while not event_holder.failed:
-                available = self.file_available(input_path)
-                if available['ready']:
-                    token = available['token']
-                    args["cache_token"] = token
-                    return self._raw_execute(action, args)
-                event_holder.event.wait(30)
-            if event_holder.failed:
-                raise Exception("Failed to transfer file %s" % input_path)
+            event_holder = None
+            if self.cache_required(input_path):
+                event_holder = self.client_cacher.queue_transfer(self, input_path)
+            args["cache_token"] = self.client_cacher.wait_until_available(self, input_path, event_holder)
+            return self._raw_execute(action, args)
+
+    def batch_put_files(self, put_requests):
+        # Transfers are coordinated through the client cacher, just stage
+        # files one at a time (and never in archives).
+        results = []
+        for put_request in put_requests:
+            put_request = dict(put_request)
+            put_request.pop("archive", None)
+            results.append(_capture(self.put_file, put_request))
+        return results
 
     @parseJson()
     def cache_required(self, path):
-        return self._raw_execute("cache_required", {"path": path})
+        """ Returns True if the file at `path` should be inserted into the
+        LWR's cache, "stale" if the cached copy no longer matches it (and so
+        should be inserted again) and False otherwise.
+        """
+        return self._raw_execute("cache_required", self.__cache_args(path))
 
     @parseJson()
     def cache_insert(self, path):
-        return self._raw_execute("cache_insert", {"path": path}, None, path)
+        return self._raw_execute("cache_insert", self.__cache_args(path), None, path)
+
+    def __cache_args(self, path):
+        args = source_validator(path, digest=self.cache_digest, digest_cache=_digest_cache)
+        args["path"] = path
+        return args
 
     @parseJson()
     def file_available(self, path):
         return self._raw_execute("file_available", {"path": path})
 
 
+def check_complete_many(clients):
+    """ Check the status of the jobs of many clients. Jobs of clients
+    targeting the same LWR job manager (i.e. sharing a job manager interface)
+    are checked together in one request - full status is only returned for
+    complete and cancelled jobs, other jobs just include their status. Jobs
+    are checked one at a time if the LWR does not support this. Entries that
+    haven't changed since the client's previous check are not resent.
+
+    Returns a list containing, for each client, its (possibly abbreviated)
+    check_complete response or the exception raised checking it.
+    """
+    results = [None] * len(clients)
+    groups = {}
+    for i, client in enumerate(clients):
+        job_manager_interface = getattr(client, "job_manager_interface", None)
+        if job_manager_interface is None or not hasattr(client, "_check_complete_many"):
+            results[i] = _capture(client.full_status, {})
+            continue
+        groups.setdefault(id(job_manager_interface), []).append(i)
+    for indices in groups.values():
+        group_clients = [clients[i] for i in indices]
+        try:
+            job_etags = dict((client.job_id, client._many_status and client._many_status[0]) for client in group_clients)
+            statuses = group_clients[0]._check_complete_many(job_etags)
+        except Exception:
+            log.debug("Failed to check status of jobs together, checking individually.")
+            statuses = {}
+        for i, client in zip(indices, group_clients):
+            job_status = _many_status(client, statuses.get(client.job_id, None))
+            if job_status is None or "error" in job_status:
+                job_status = _capture(client.full_status, {})
+            results[i] = job_status
+    return results
+
+
+def _many_status(client, job_status):
+    """ Resolve a check_complete_many entry for client against (and record
+    it as) the client's last entry.
+    """
+    if job_status is None:
+        return None
+    if job_status.get("unchanged", False):
+        last = client._many_status
+        return dict(last[1]) if last else None
+    etag = job_status.pop("etag", None)
+    if etag is not None:
+        client._many_status = (etag, job_status)
+        job_status = dict(job_status)
+    return job_status
+
+
+def _capture(func, kwds):
+    """ Call func with kwds returning the result or the exception raised.
+    """
+    try:
+        return func(**kwds)
+    except Exception as e:
+        return e
+
+
+def _capture_failure(func, kwds):
+    result = _capture(func, kwds)
+    return result if isinstance(result, Exception) else None
+
+
+def _status(check_complete_response):
+    # Older LWR instances won't set status so use 'complete', at some
+    # point drop backward compatibility.
+    status = check_complete_response.get("status", None)
+    if status in ["status", None]:
+        # LEGACY: Bug in certains older LWR instances returned literal
+        # "status".
+        complete = check_complete_response["complete"] == "true"
+        old_status = "complete" if complete else "running"
+        status = old_status
+    return status
+
+
+def _inline_body(command):
+    data = command.get("data", None)
+    input_path = command.get("input_path", None)
+    if data is not None:
+        body = data.encode("utf-8")
+    elif input_path is not None:
+        with open(input_path, "rb") as f:
+            body = f.read()
+    else:
+        return None
+    return b64encode(body).decode("ascii")
+
+
+def _verify_transfer(local_path, remote_info):
+    size = os.path.getsize(local_path)
+    if size != remote_info["size"]:
+        message = "local size %d, remote size %d" % (size, remote_info["size"])
+        raise TransferVerificationException(local_path, message)
+    if file_sha256(local_path) != remote_info["sha256"]:
+        raise TransferVerificationException(local_path, "checksum mismatch")
+
+
 def _setup_params_from_job_config(job_config):
     job_id = job_config.get("job_id", None)
     tool_id = job_config.get("tool_id", None)
@@ -0,0 +1,332 @@
+"""
+Stream compression used to (optionally) shrink files staged between the LWR
+client and server. gzip is always available, zstd is used when the
+``zstandard`` module is installed.
+"""
+import zlib
+from os.path import basename
+from tempfile import NamedTemporaryFile
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+# Formats that are already compressed, never worth compressing again.
+DEFAULT_SKIP_EXTENSIONS = [
+    ".bam", ".cram", ".bai", ".gz", ".bgz", ".tgz", ".bz2", ".xz", ".zip",
+    ".zst", ".sra", ".png", ".jpg", ".jpeg", ".gif", ".pdf", ".h5",
+]
+BUFFER_SIZE = 64 * 1024
+# zstandard can't bound the output of a decompress call, so input is fed to
+# it in small pieces instead.
+ZSTD_INPUT_SIZE = 1024
+# Decoded bodies may always reach this size, whatever their compression ratio.
+MIN_RATIO_CHECK_SIZE = 1024 * 1024
+# Encodings LWR servers (keyed on scheme and host) advertised accepting for
+# uploads, in response to uploads they rejected.
+_accepted_upload_encodings = {}
+
+
+def available_encodings():
+    """ Encodings this Python can read and write, most preferred first.
+    """
+    encodings = [GZIP]
+    if zstandard is not None:
+        encodings.insert(0, ZSTD)
+    return encodings
+
+
+def resolve_encoding(encoding):
+    """ Map a requested compression setting onto one available here (or
+    None if compression is disabled).
+
+    >>> resolve_encoding(None) is None
+    True
+    >>> resolve_encoding("none") is None
+    True
+    >>> resolve_encoding("gzip")
+    'gzip'
+    >>> resolve_encoding("zstd") in available_encodings()
+    True
+    """
+    if not encoding or encoding == "none":
+        return None
+    if encoding not in available_encodings():
+        if encoding != ZSTD:
+            raise Exception("Unknown compression encoding %s" % encoding)
+        # Fall back to gzip if zstandard isn't installed.
+        encoding = GZIP
+    return encoding
+
+
+def upload_encoding(encoding, url):
+    """ As ``resolve_encoding``, for an upload to ``url`` - limited to the
+    encodings its server advertised accepting (see
+    ``record_accepted_encodings``).
+
+    >>> record_accepted_encodings("http://lwr1:8913/upload?job_id=1", "gzip")
+    >>> upload_encoding("zstd", "http://lwr1:8913/upload")
+    'gzip'
+    >>> record_accepted_encodings("http://lwr2:8913/upload", None)
+    >>> upload_encoding("gzip", "http://lwr2:8913/upload") is None
+    True
+    >>> upload_encoding("gzip", "http://lwr3:8913/upload")
+    'gzip'
+    """
+    encoding = resolve_encoding(encoding)
+    accepted = _accepted_upload_encodings.get(_server(url), None)
+    if encoding and accepted is not None and encoding not in accepted:
+        encoding = best_encoding(", ".join(accepted))
+    return encoding
+
+
+def record_accepted_encodings(url, accept_encoding):
+    """ Record the encodings the server of ``url`` accepts for uploads, as
+    advertised by the ``Accept-Encoding`` header of a ``415 Unsupported
+    Media Type`` response (identity only if it sent none).
+    """
+    _accepted_upload_encodings[_server(url)] = _accepted(accept_encoding)
+
+
+def _server(url):
+    parts = urlsplit(url)
+    return (parts.scheme, parts.netloc)
+
+
+def skip_compression(path, skip_extensions=DEFAULT_SKIP_EXTENSIONS):
+    """
+
+    >>> skip_compression("/data/dataset_1.bam")
+    True
+    >>> skip_compression("/data/reads.fastq.GZ")
+    True
+    >>> skip_compression("/data/dataset_1.dat")
+    False
+    """
+    name = basename(path).lower()
+    return any(name.endswith(extension) for extension in skip_extensions)
+
+
+def best_encoding(accept_encoding, encodings=None):
+    """ Pick the encoding to respond with given an ``Accept-Encoding`` header.
+
+    >>> best_encoding("gzip, deflate")
+    'gzip'
+    >>> best_encoding("gzip;q=0") is None
+    True
+    >>> best_encoding("br") is None
+    True
+    >>> best_encoding(None) is None
+    True
+    """
+    if encodings is None:
+        encodings = available_encodings()
+    accepted = _accepted(accept_encoding)
+    for encoding in encodings:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def _accepted(accept_encoding):
+    accepted = []
+    for part in (accept_encoding or "").split(","):
+        pieces = part.strip().split(";")
+        name = pieces[0].strip().lower()
+        quality = 1.0
+        for param in pieces[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.append(name)
+    return accepted
+
+
+def content_encoding(header_value):
+    """ Normalize a ``Content-Encoding`` header value, None if the content
+    isn't encoded.
+
+    >>> content_encoding(" GZIP ")
+    'gzip'
+    >>> content_encoding("identity") is None
+    True
+    >>> content_encoding(None) is None
+    True
+    """
+    encoding = (header_value or "").strip().lower()
+    if encoding in ["", "identity"]:
+        return None
+    return encoding
+
+
+def compressor(encoding):
+    if encoding == GZIP:
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor().compressobj()
+    raise Exception("Unsupported compression encoding %s" % encoding)
+
+
+def decompressor(encoding):
+    """ Decompressor for ``encoding`` - ``decompress(data, max_length)``
+    returns (about) at most ``max_length`` bytes, keeping any input it didn't
+    consume to be decompressed by later calls (while ``needs_input`` is
+    False).
+    """
+    if encoding == GZIP:
+        return _ZlibDecompressor()
+    elif encoding == ZSTD and zstandard is not None:
+        return _ZstdDecompressor()
+    raise Exception("Unsupported compression encoding %s" % encoding)
+
+
+class _ZlibDecompressor(object):
+
+    def __init__(self):
+        self.decompressobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    @property
+    def needs_input(self):
+        return not self.decompressobj.unconsumed_tail
+
+    def decompress(self, data, max_length=0):
+        return self.decompressobj.decompress(self.decompressobj.unconsumed_tail + data, max_length)
+
+    def flush(self):
+        return self.decompressobj.flush()
+
+
+class _ZstdDecompressor(object):
+    # zstandard decompressobj lacks a consistent flush() across versions, and
+    # can't bound its output.
+
+    def __init__(self):
+        self.decompressobj = zstandard.ZstdDecompressor().decompressobj()
+        self.tail = b""
+
+    @property
+    def needs_input(self):
+        return not self.tail
+
+    def decompress(self, data, max_length=0):
+        data = self.tail + data
+        if max_length:
+            data, self.tail = data[:ZSTD_INPUT_SIZE], data[ZSTD_INPUT_SIZE:]
+        else:
+            self.tail = b""
+        return self.decompressobj.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+def compress_to_temp(path, encoding):
+    """ Compress file at path into a new temporary file and return its path,
+    the caller is responsible for deleting it.
+    """
+    c = compressor(encoding)
+    with open(path, 'rb') as input:
+        output = NamedTemporaryFile(delete=False, prefix="lwr_compressed_")
+        try:
+            while True:
+                buffer = input.read(BUFFER_SIZE)
+                if not buffer:
+                    break
+                output.write(c.compress(buffer))
+            output.write(c.flush())
+        finally:
+            output.close()
+    return output.name
+
+
+class DecompressionLimitExceeded(Exception):
+    pass
+
+
+class DecompressingReader(object):
+    """ File-like object decompressing the contents of file-like ``input``.
+    If ``max_ratio`` is set, an exception is raised once the decoded
+    contents exceed that many times the size of the compressed contents read
+    (and ``MIN_RATIO_CHECK_SIZE``).
+
+    >>> from io import BytesIO
+    >>> c = compressor(GZIP)
+    >>> compressed = c.compress(b"Hello World!") + c.flush()
+    >>> reader = DecompressingReader(BytesIO(compressed), GZIP)
+    >>> reader.read(5) == b"Hello"
+    True
+    >>> reader.read() == b" World!"
+    True
+    >>> reader.read() == b""
+    True
+    >>> c = compressor(GZIP)
+    >>> bomb = c.compress(b"a" * (4 * MIN_RATIO_CHECK_SIZE)) + c.flush()
+    >>> reader = DecompressingReader(BytesIO(bomb), GZIP, max_ratio=100)
+    >>> reader.read()
+    Traceback (most recent call last):
+    DecompressionLimitExceeded: Decompressed content exceeds 100 times its compressed size.
+    """
+
+    def __init__(self, input, encoding, max_ratio=None):
+        self.input = input
+        self.decompressor = decompressor(encoding)
+        self.max_ratio = max_ratio
+        self.buffer = b""
+        self.eof = False
+        self.read_bytes = 0
+        self.decoded_bytes = 0
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = b""
+            if self.decompressor.needs_input:
+                data = self.input.read(BUFFER_SIZE)
+                if not data:
+                    self.__decoded(self.decompressor.flush())
+                    self.eof = True
+                    break
+                self.read_bytes += len(data)
+            # Bounded, so memory use doesn't depend on the compression ratio.
+            self.__decoded(self.decompressor.decompress(data, BUFFER_SIZE))
+        if size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+    def __decoded(self, data):
+        self.decoded_bytes += len(data)
+        if self.max_ratio and self.decoded_bytes > max(MIN_RATIO_CHECK_SIZE, self.read_bytes * self.max_ratio):
+            raise DecompressionLimitExceeded("Decompressed content exceeds %d times its compressed size." % self.max_ratio)
+        self.buffer += data
+
+    def close(self):
+        close = getattr(self.input, "close", None)
+        if close:
+            close()
+
+
+class DecompressingWriter(object):
+    """ File-like object decompressing data written to it into ``output``.
+    """
+
+    def __init__(self, output, encoding):
+        self.output = output
+        self.decompressor = decompressor(encoding)
+
+    def write(self, data):
+        self.output.write(self.decompressor.decompress(data))
+
+    def close(self):
+        self.output.write(self.decompressor.flush())
+        self.output.close()
@@ -1,9 +1,22 @@
 import time
 import json
+import threading
 
 MAX_RETRY_COUNT = 5
 RETRY_SLEEP_TIME = 0.1
 
+_retries = threading.local()
+
+
+def retry_count():
+    """ Number of requests retried by the current thread so far.
+    """
+    return getattr(_retries, "count", 0)
+
+
+def record_retry():
+    _retries.count = retry_count() + 1
+
 
 class parseJson(object):
 
@@ -29,6 +42,7 @@ class retry(object):
                     if count >= max_count:
                         raise
                     else:
+                        record_retry()
                         time.sleep(RETRY_SLEEP_TIME)
                         continue
 
@@ -1,5 +1,6 @@
 from abc import ABCMeta
 from abc import abstractmethod
+import os
 try:
     from StringIO import StringIO as BytesIO
 except ImportError:
@@ -13,6 +14,12 @@ try:
 except ImportError:
     from urllib.parse import urlencode
 
+from .util import DigestCache
+from .util import RangeReader
+from .util import completed_future
+from .util import content_etag
+from .util import quote_etag
+
 
 class LwrInteface(object):
     """
@@ -24,13 +31,45 @@ class LwrInteface(object):
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    def execute(self, command, args={}, data=None, input_path=None, output_path=None):
+    def execute(self, command, args={}, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
         """
         Execute the correspond command against configured LWR job manager. Arguments are
         method parameters and data or input_path describe essentially POST bodies. If command
-        results in a file, resulting path should be specified as output_path.
+        results in a file, resulting path should be specified as output_path. If resume is
+        True, implementations may continue a partial download already present at
+        output_path instead of starting over. If byte_range (an (offset, length) tuple)
+        is specified only that portion of input_path is sent, or only that portion of
+        the resulting file is written into the existing output_path at offset. If
+        compression (gzip or zstd) is set, the transfer of input_path or output_path
+        may be compressed with that encoding. If etag (a quoted entity tag) is
+        specified the request is conditional - if the result still matches it
+        None is returned and output_path is left untouched.
         """
 
+    def execute_many(self, commands, max_in_flight=None):
+        """
+        Execute a batch of commands, each a dictionary of keyword arguments to
+        ``execute``. Returns a list containing the result of each command or
+        the exception raised while executing it. Implementations may execute
+        commands concurrently, this default executes them one at a time.
+        """
+        results = []
+        for command in commands:
+            try:
+                result = self.execute(**command)
+            except Exception as e:
+                result = e
+            results.append(result)
+        return results
+
+    def execute_async(self, command, **kwds):
+        """
+        Like ``execute`` but returns a ``Future`` for the result. Implementations
+        may multiplex many such commands, this default executes the command
+        immediately.
+        """
+        return completed_future(self.execute, command, **kwds)
+
 
 class HttpLwrInterface(LwrInteface):
 
@@ -45,11 +84,37 @@ class HttpLwrInterface(LwrInteface):
         self.remote_host = remote_host
         self.private_key = destination_params.get("private_token", None)
 
-    def execute(self, command, args={}, data=None, input_path=None, output_path=None):
+    def execute(self, command, args={}, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
         url = self.__build_url(command, args)
-        response = self.transport.execute(url, data=data, input_path=input_path, output_path=output_path)
+        response = self.transport.execute(url, data=data, input_path=input_path, output_path=output_path,
+                                          resume=resume, byte_range=byte_range, compression=compression, etag=etag)
         return response
 
+    def execute_many(self, commands, max_in_flight=None):
+        requests = []
+        for command in commands:
+            url = self.__build_url(command["command"], command.get("args", {}))
+            requests.append(dict(
+                url=url,
+                data=command.get("data", None),
+                input_path=command.get("input_path", None),
+                output_path=command.get("output_path", None),
+                resume=command.get("resume", False),
+                byte_range=command.get("byte_range", None),
+                compression=command.get("compression", None),
+                etag=command.get("etag", None),
+            ))
+        return self.transport.execute_many(requests, max_in_flight=max_in_flight)
+
+    def execute_async(self, command, args={}, data=None, input_path=None, output_path=None,
+                      resume=False, byte_range=None, compression=None, etag=None):
+        if not hasattr(self.transport, "execute_async"):
+            return super(HttpLwrInterface, self).execute_async(command, args=args, data=data, input_path=input_path, output_path=output_path,
+                                                               resume=resume, byte_range=byte_range, compression=compression, etag=etag)
+        url = self.__build_url(command, args)
+        return self.transport.execute_async(url, data=data, input_path=input_path, output_path=output_path,
+                                            resume=resume, byte_range=byte_range, compression=compression, etag=etag)
+
     def __build_url(self, command, args):
         if self.private_key:
             args["private_key"] = self.private_key
@@ -59,12 +124,31 @@ class HttpLwrInterface(LwrInteface):
         return url
 
 
+class AsyncHttpLwrInterface(HttpLwrInterface):
+    """
+    Variant of ``HttpLwrInterface`` executing all commands through the
+    transport's event loop (see ``PycurlTransport.execute_async``), so
+    blocking calls made from many threads share a small number of
+    connections. ``execute`` and ``execute_many`` remain synchronous facades.
+    """
+
+    def execute(self, command, args={}, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
+        future = self.execute_async(command, args=args, data=data, input_path=input_path, output_path=output_path,
+                                    resume=resume, byte_range=byte_range, compression=compression, etag=etag)
+        return future.result()
+
+    def execute_many(self, commands, max_in_flight=None):
+        futures = [self.execute_async(**command) for command in commands]
+        return [future.exception() or future.result() for future in futures]
+
+
 class LocalLwrInterface(LwrInteface):
 
     def __init__(self, destination_params, job_manager=None, file_cache=None, object_store=None):
         self.job_manager = job_manager
         self.file_cache = file_cache
         self.object_store = object_store
+        self.__digest_cache = DigestCache()
 
     def __app_args(self):
         # Arguments that would be specified from LwrApp if running
@@ -76,26 +160,53 @@ class LocalLwrInterface(LwrInteface):
             'ip': None
         }
 
-    def execute(self, command, args={}, data=None, input_path=None, output_path=None):
+    def execute(self, command, args={}, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
         # If data set, should be unicode (on Python 2) or str (on Python 3).
+        # Compression is ignored, resumed copies continue from the end of
+        # output_path.
+        # Only file results are conditional (on a content etag).
         from lwr.web import routes
         from lwr.web.framework import build_func_args
         controller = getattr(routes, command)
         action = controller.func
-        body_args = dict(body=self.__build_body(data, input_path))
-        args = build_func_args(action, args.copy(), self.__app_args(), body_args)
+        app_args = self.__app_args()
+        body_args = dict(body=self.__build_body(data, input_path, byte_range), app_args=app_args)
+        args = build_func_args(action, app_args, body_args, args.copy())
         result = action(**args)
-        if controller.response_type != 'file':
+        if controller.response_type == 'stream':
+            with open(output_path, 'wb') as output:
+                for chunk in result:
+                    output.write(chunk)
+        elif controller.response_type != 'file':
             return controller.body(result)
         else:
             # TODO: Add to Galaxy.
             from galaxy.util import copy_to_path
-            with open(result, 'rb') as result_file:
-                copy_to_path(result_file, output_path)
+            from galaxy.util import copy_to_path_range
+            resume_offset = 0
+            if resume and os.path.exists(output_path):
+                resume_offset = os.path.getsize(output_path)
+            if resume_offset and not byte_range:
+                byte_range = (resume_offset, max(0, os.path.getsize(result) - resume_offset))
+            if byte_range:
+                offset, length = byte_range
+                result_file = RangeReader(result, offset, length)
+                try:
+                    copy_to_path_range(result_file, output_path, offset)
+                finally:
+                    result_file.close()
+            elif not (etag and etag == self.__content_etag(result)):
+                with open(result, 'rb') as result_file:
+                    copy_to_path(result_file, output_path)
+
+    def __content_etag(self, path):
+        return quote_etag(content_etag(self.__digest_cache.sha256(path)))
 
-    def __build_body(self, data, input_path):
+    def __build_body(self, data, input_path, byte_range=None):
         if data is not None:
             return BytesIO(data.encode('utf-8'))
+        elif input_path is not None and byte_range:
+            return RangeReader(input_path, *byte_range)
         elif input_path is not None:
             return open(input_path, 'rb')
         else:
@@ -2,10 +2,12 @@
 """
 import os.path
 from collections import deque
+from hashlib import md5
 import posixpath
 
 from .util import PathHelper
 from galaxy.util import in_directory
+from galaxy.util.directory_hash import directory_hash_id
 
 from logging import getLogger
 log = getLogger(__name__)
@@ -23,16 +25,46 @@ TYPES_TO_METHOD = dict(
     output_workdir="working_directory",
 )
 
+# Job directories directly in the staging directory.
+FLAT_LAYOUT = "flat"
+# Job directories fanned out over nested sub-directories.
+HASHED_LAYOUT = "hashed"
+
+
+def job_directory_parts(job_id, layout=None):
+    """ Path components (relative to the staging directory) of the directory
+    for job ``job_id`` in the given layout. Numeric ids are fanned out as
+    Galaxy fans out datasets (at most 1000 entries per directory), other ids
+    (e.g. UUIDs) over two levels named after the ids' hash.
+
+    >>> job_directory_parts("1234")
+    ['1234']
+    >>> job_directory_parts("1234", layout="hashed")
+    ['001', '1234']
+    >>> job_directory_parts("d3d9446802a44259755d38e6d163e820", layout="hashed")
+    ['8d', '8e', 'd3d9446802a44259755d38e6d163e820']
+    """
+    if not layout or layout == FLAT_LAYOUT:
+        return [job_id]
+    elif layout == HASHED_LAYOUT:
+        if job_id.isdigit():
+            return directory_hash_id(job_id) + [job_id]
+        digest = md5(job_id.encode("utf-8")).hexdigest()
+        return [digest[0:2], digest[2:4], job_id]
+    else:
+        raise Exception("Unknown job directory layout %s" % layout)
+
 
 class RemoteJobDirectory(object):
     """ Representation of a (potentially) remote LWR-style staging directory.
+    ``layout`` must match the LWR's ``staging_directory_layout``.
     """
 
-    def __init__(self, remote_staging_directory, remote_id, remote_sep):
+    def __init__(self, remote_staging_directory, remote_id, remote_sep, layout=None):
         self.path_helper = PathHelper(remote_sep)
         self.job_directory = self.path_helper.remote_join(
             remote_staging_directory,
-            remote_id
+            *job_directory_parts(remote_id, layout)
         )
 
     def working_directory(self):
@@ -0,0 +1,73 @@
+""" Follow job state changes published by an LWR over HTTP (requires the
+LWR's ``status_feed`` option) instead of polling each job's status.
+"""
+import threading
+import time
+
+from logging import getLogger
+log = getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRY_INTERVAL = 5
+
+
+class StatusListener(object):
+    """ Long-polls the ``status_updates`` route of the LWR targeted by
+    ``client`` in a background thread, passing each state change (a
+    dictionary like a ``check_complete`` response) to ``callback``.
+
+    If updates are missed - the LWR restarted or the listener fell too far
+    behind - ``missed_callback`` is called (with no arguments) and should check
+    the status of outstanding jobs directly.
+    """
+
+    def __init__(self, client, callback, missed_callback=None, timeout=DEFAULT_TIMEOUT, retry_interval=DEFAULT_RETRY_INTERVAL):
+        self.client = client
+        self.callback = callback
+        self.missed_callback = missed_callback
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        # Set once following the feed, state changes from then on are seen.
+        self.started = threading.Event()
+        self.active = True
+        self.thread = None
+
+    def start(self):
+        thread = threading.Thread(name="lwr_client_status_listener", target=self._run)
+        thread.daemon = True
+        thread.start()
+        self.thread = thread
+        return self
+
+    def shutdown(self):
+        """ Stop following the feed, the background thread exits once its
+        current poll returns.
+        """
+        self.active = False
+
+    def _run(self):
+        since = None
+        while self.active:
+            try:
+                response = self.client.status_updates(since, timeout=self.timeout)
+            except Exception:
+                log.exception("Failed to fetch LWR status updates, retrying.")
+                time.sleep(self.retry_interval)
+                continue
+            if response["missed"] and since is not None:
+                self.__handle(self.missed_callback)
+            since = response["since"]
+            self.started.set()
+            for update in response["updates"]:
+                if not self.active:
+                    break
+                self.__handle(self.callback, update)
+        log.debug("Leaving LWR client status listener thread, no additional LWR updates will be processed.")
+
+    def __handle(self, callback, *args):
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception:
+            log.exception("Failure processing job status update.")
@@ -1,19 +1,23 @@
 import threading
-try:
-    from Queue import Queue
-except ImportError:
-    from queue import Queue
+import time
 from os import getenv
+from os.path import getsize
 
 from .client import JobClient
 from .client import InputCachingJobClient
 from .client import MessageJobClient
 from .client import MessageCLIJobClient
+from .interface import AsyncHttpLwrInterface
 from .interface import HttpLwrInterface
 from .interface import LocalLwrInterface
+from .listener import StatusListener
 from .object_client import ObjectStoreClient
+from .scheduler import DEFAULT_TRANSFER_THREADS
+from .scheduler import TransferScheduler
+from .staging.metrics import record_cache_wait
 from .transport import get_transport
 from .util import TransferEventManager
+from .util import filter_destination_params
 from .destination import url_to_destination_params
 from .amqp_exchange_factory import get_exchange
 
@@ -21,7 +25,11 @@ from .amqp_exchange_factory import get_exchange
 from logging import getLogger
 log = getLogger(__name__)
 
-DEFAULT_TRANSFER_THREADS = 2
+# Seconds between checks for files inserted into an LWR's cache by another
+# process, doubling after each check up to the maximum.
+DEFAULT_CACHE_PROBE_INITIAL_DELAY = 0.1
+DEFAULT_CACHE_PROBE_MAX_DELAY = 10
+TRANSPORT_PARAM_PREFIX = "transport_"
 
 
 def build_client_manager(**kwargs):
@@ -42,23 +50,54 @@ class ClientManager(object):
         if 'job_manager' in kwds:
             self.job_manager_interface_class = LocalLwrInterface
             self.job_manager_interface_args = dict(job_manager=kwds['job_manager'], file_cache=kwds['file_cache'])
+            self.transport = None
         else:
             self.job_manager_interface_class = HttpLwrInterface
             transport_type = kwds.get('transport', None)
-            transport = get_transport(transport_type)
+            transport_params = _transport_params(kwds)
+            transport = get_transport(transport_type, transport_params=transport_params)
+            if str(kwds.get('async_requests', False)).lower() == "true":
+                # Multiplex requests from all clients through the transport's
+                # event loop.
+                self.job_manager_interface_class = AsyncHttpLwrInterface
             self.job_manager_interface_args = dict(transport=transport)
+            self.transport = transport
+        self.transfer_scheduler = None
+        if str(kwds.get('schedule_transfers', False)).lower() == "true":
+            # Job input uploads share the scheduler with cache inserts.
+            self.transfer_scheduler = _build_transfer_scheduler(kwds)
         cache = kwds.get('cache', None)
         if cache is None:
             cache = _environ_default_int('LWR_CACHE_TRANSFERS')
         if cache:
             log.info("Setting LWR client class to caching variant.")
-            self.client_cacher = ClientCacher(**kwds)
+            self.client_cacher = ClientCacher(transfer_scheduler=self.transfer_scheduler, **kwds)
             self.client_class = InputCachingJobClient
             self.extra_client_kwds = {"client_cacher": self.client_cacher}
         else:
             log.info("Setting LWR client class to standard, non-caching variant.")
             self.client_class = JobClient
             self.extra_client_kwds = {}
+        if self.transfer_scheduler:
+            self.extra_client_kwds["transfer_scheduler"] = self.transfer_scheduler
+        self.status_listeners = {}
+        self.status_listener_lock = threading.Lock()
+
+    def ensure_has_status_listener(self, destination_params, callback, missed_callback=None):
+        """ Follow job state changes of the LWR targeted by
+        ``destination_params`` (see ``StatusListener``), one listener is
+        started per LWR URL - the callbacks of the first call for that URL are
+        used.
+        """
+        destination_params = _parse_destination_params(destination_params)
+        url = destination_params.get("url")
+        with self.status_listener_lock:
+            listener = self.status_listeners.get(url, None)
+            if listener is None:
+                client = self.get_client(destination_params, None)
+                listener = StatusListener(client, callback, missed_callback=missed_callback).start()
+                self.status_listeners[url] = listener
+        return listener
 
     def get_client(self, destination_params, job_id, **kwargs):
         destination_params = _parse_destination_params(destination_params)
@@ -69,7 +108,12 @@ class ClientManager(object):
         return self.client_class(destination_params, job_id, job_manager_interface, **self.extra_client_kwds)
 
     def shutdown(self):
-        pass
+        for listener in self.status_listeners.values():
+            listener.shutdown()
+        if hasattr(self.transport, "shutdown"):
+            self.transport.shutdown()
+        if self.transfer_scheduler:
+            self.transfer_scheduler.shutdown()
 
 
 try:
@@ -147,7 +191,8 @@ class ObjectStoreClientManager(object):
         else:
             self.interface_class = HttpLwrInterface
             transport_type = kwds.get('transport', None)
-            transport = get_transport(transport_type)
+            transport_params = _transport_params(kwds)
+            transport = get_transport(transport_type, transport_params=transport_params)
             self.interface_args = dict(transport=transport)
         self.extra_client_kwds = {}
 
@@ -159,48 +204,99 @@ class ObjectStoreClientManager(object):
 
 
 class ClientCacher(object):
+    """ Inserts files into LWR caches using a ``TransferScheduler`` (shared
+    with job input uploads if ``transfer_scheduler`` is supplied).
+    Threads waiting on a file are notified as soon as this process's
+    transfer of it completes, files inserted by other processes are
+    checked for with exponential backoff.
+    """
 
-    def __init__(self, **kwds):
+    def __init__(self, transfer_scheduler=None, **kwds):
         self.event_manager = TransferEventManager()
-        default_transfer_threads = _environ_default_int('LWR_CACHE_THREADS', DEFAULT_TRANSFER_THREADS)
-        num_transfer_threads = int(kwds.get('transfer_threads', default_transfer_threads))
-        self.__init_transfer_threads(num_transfer_threads)
+        self.probe_initial_delay = float(kwds.get('cache_probe_initial_delay', DEFAULT_CACHE_PROBE_INITIAL_DELAY))
+        self.probe_max_delay = float(kwds.get('cache_probe_max_delay', DEFAULT_CACHE_PROBE_MAX_DELAY))
+        self.transfer_scheduler = transfer_scheduler or _build_transfer_scheduler(kwds)
+        self.num_transfer_threads = self.transfer_scheduler.num_threads
 
     def queue_transfer(self, client, path):
-        self.transfer_queue.put((client, path))
+        """ Queue insertion of ``path`` into the cache of ``client``'s LWR,
+        returns an ``EventHolder`` released once the transfer completes.
+        """
+        event_holder = self.event_manager.start_transfer(path)
+        self.transfer_scheduler.submit(
+            self.__perform_transfer,
+            (client, path, event_holder),
+            destination=_transfer_destination(client),
+            size=_file_size(path),
+            priority=getattr(client, "transfer_priority", 0),
+        )
+        return event_holder
 
     def acquire_event(self, input_path):
         return self.event_manager.acquire_event(input_path)
 
-    def _transfer_worker(self):
-        while True:
-            transfer_info = self.transfer_queue.get()
-            try:
-                self.__perform_transfer(transfer_info)
-            except BaseException as e:
-                log.warn("Transfer failed.")
-                log.exception(e)
-                pass
-            self.transfer_queue.task_done()
-
-    def __perform_transfer(self, transfer_info):
-        (client, path) = transfer_info
-        event_holder = self.event_manager.acquire_event(path, force_clear=True)
+    def wait_until_available(self, client, path, event_holder=None):
+        """ Block until ``path`` is available in the cache of ``client``'s
+        LWR, returns its cache token. Time spent waiting is recorded (see
+        ``lwr.lwr_client.staging.metrics.cache_wait_time``).
+        """
+        start = time.time()
+        delay = self.probe_initial_delay
+        try:
+            while True:
+                available = client.file_available(path)
+                if available['ready']:
+                    return available['token']
+                # Holding a reference keeps the outcome of the transfer
+                # tracked until this thread sees it.
+                event_holder = self.event_manager.current_event(path) or event_holder
+                if event_holder is not None and event_holder.failed:
+                    raise Exception("Failed to transfer file %s" % path)
+                if event_holder is not None and event_holder.pending:
+                    # Transferred by this process, woken once complete.
+                    event_holder.event.wait(self.probe_max_delay)
+                else:
+                    # Inserted by another process.
+                    time.sleep(delay)
+                    delay = min(delay * 2, self.probe_max_delay)
+        finally:
+            record_cache_wait(time.time() - start)
+
+    def __perform_transfer(self, client, path, event_holder):
         failed = True
         try:
             client.cache_insert(path)
             failed = False
+        except Exception:
+            log.exception("Transfer failed.")
         finally:
             event_holder.failed = failed
             event_holder.release()
 
-    def __init_transfer_threads(self, num_transfer_threads):
-        self.num_transfer_threads = num_transfer_threads
-        self.transfer_queue = Queue()
-        for i in range(num_transfer_threads):
-            t = threading.Thread(target=self._transfer_worker)
-            t.daemon = True
-            t.start()
+
+def _build_transfer_scheduler(kwds):
+    default_transfer_threads = _environ_default_int('LWR_CACHE_THREADS', DEFAULT_TRANSFER_THREADS)
+    max_per_destination = kwds.get('max_transfers_per_destination', None)
+    bandwidth = kwds.get('transfer_bandwidth', None)
+    burst = kwds.get('transfer_burst', None)
+    return TransferScheduler(
+        threads=int(kwds.get('transfer_threads', default_transfer_threads)),
+        max_per_destination=int(max_per_destination) if max_per_destination else None,
+        bandwidth=float(bandwidth) if bandwidth else None,
+        burst=float(burst) if burst else None,
+        small_first=str(kwds.get('small_transfers_first', True)).lower() == "true",
+    )
+
+
+def _transfer_destination(client):
+    return (getattr(client, "destination_params", None) or {}).get("url", None)
+
+
+def _file_size(path):
+    try:
+        return getsize(path)
+    except OSError:
+        return 0
 
 
 def _parse_destination_params(destination_params):
@@ -213,6 +309,11 @@ def _parse_destination_params(destination_params):
     return destination_params
 
 
+def _transport_params(kwds):
+    # e.g. transport_pool_size=8 => PycurlTransport(pool_size=8)
+    return filter_destination_params(kwds, TRANSPORT_PARAM_PREFIX)
+
+
 def _environ_default_int(variable, default="0"):
     val = getenv(variable, default)
     int_val = int(default)
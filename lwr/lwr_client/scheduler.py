@@ -0,0 +1,215 @@
+""" Shared scheduling of client transfers (inserts into LWR caches and, if
+enabled, job input uploads) - transfers are run by a fixed pool of threads
+in priority order, optionally capped per LWR and paced to a bandwidth
+budget.
+"""
+from bisect import insort
+from itertools import count
+import threading
+import time
+
+from .util import Future
+
+from logging import getLogger
+log = getLogger(__name__)
+
+DEFAULT_TRANSFER_THREADS = 2
+# Transfers of the same priority are ordered by size class (then submission
+# order) - so small files are not queued behind large ones.
+SIZE_CLASSES = (1024 * 1024, 100 * 1024 * 1024)
+
+
+class TransferScheduler(object):
+    """ Runs submitted transfers on a pool of ``threads`` threads.
+
+    Pending transfers are started lowest ``priority`` first, then (if
+    ``small_first``) smallest size class first, then in submission order. At
+    most ``max_per_destination`` transfers to the same destination (e.g. LWR
+    URL) run at once. If ``bandwidth`` (bytes per second) is set, transfers
+    wait for their size to be available in a token bucket holding up to
+    ``burst`` bytes (defaulting to one second's worth) before starting.
+
+    >>> scheduler = TransferScheduler(threads=1)
+    >>> scheduler.submit(lambda x: x * 2, (21,), destination="http://lwr/", size=10).result()
+    42
+    >>> statistics = scheduler.statistics()
+    >>> statistics["completed"], statistics["queued"], statistics["transferred_bytes"]
+    (1, 0, 10)
+    >>> scheduler.shutdown()
+    """
+
+    def __init__(self, threads=DEFAULT_TRANSFER_THREADS, max_per_destination=None, bandwidth=None, burst=None, small_first=True):
+        self.num_threads = threads
+        self.max_per_destination = max_per_destination
+        self.bucket = TokenBucket(bandwidth, burst) if bandwidth else None
+        self.small_first = small_first
+        self.condition = threading.Condition()
+        # Sorted (key, transfer) pairs, keys are unique.
+        self.pending = []
+        self.active = {}
+        self.sequence = count()
+        self.running = True
+        self.stats = dict(
+            submitted=0,
+            completed=0,
+            failed=0,
+            transferred_bytes=0,
+            total_wait_time=0.0,
+            max_wait_time=0.0,
+            throttled_time=0.0,
+        )
+        for i in range(threads):
+            t = threading.Thread(name="lwr_client_transfer_%d" % i, target=self._work)
+            t.daemon = True
+            t.start()
+
+    def submit(self, func, args=(), destination=None, size=0, priority=0):
+        """ Queue call of ``func(*args)``, transferring ``size`` bytes to or
+        from ``destination``. Returns a ``Future`` for its result.
+        """
+        transfer = _Transfer(func, args, destination, size or 0)
+        key = (priority, self.__size_class(transfer.size), next(self.sequence))
+        with self.condition:
+            if not self.running:
+                raise Exception("Transfer scheduler has been shutdown.")
+            insort(self.pending, (key, transfer))
+            self.stats["submitted"] += 1
+            self.condition.notify()
+        return transfer.future
+
+    def statistics(self):
+        """ Describe current queue depth and active transfers (by
+        destination) along with totals since startup - times are in
+        seconds.
+        """
+        with self.condition:
+            statistics = dict(self.stats)
+            statistics["queued"] = len(self.pending)
+            statistics["queued_bytes"] = sum(transfer.size for _, transfer in self.pending)
+            statistics["active"] = sum(self.active.values())
+            statistics["active_by_destination"] = dict(self.active)
+        started = statistics["completed"] + statistics["failed"] + statistics["active"]
+        statistics["mean_wait_time"] = statistics["total_wait_time"] / started if started else 0.0
+        return statistics
+
+    def shutdown(self):
+        """ Stop the transfer threads once their current transfers complete,
+        transfers not yet started fail.
+        """
+        with self.condition:
+            self.running = False
+            pending = self.pending
+            self.pending = []
+            self.condition.notify_all()
+        for _, transfer in pending:
+            transfer.future.set_exception(Exception("Transfer scheduler has been shutdown."))
+
+    def _work(self):
+        while True:
+            with self.condition:
+                transfer = self.__next_transfer()
+                while transfer is None:
+                    if not self.running:
+                        return
+                    self.condition.wait()
+                    transfer = self.__next_transfer()
+            self.__run(transfer)
+
+    def __run(self, transfer):
+        failed = True
+        try:
+            if self.bucket:
+                throttled_time = self.bucket.consume(transfer.size)
+                if throttled_time:
+                    with self.condition:
+                        self.stats["throttled_time"] += throttled_time
+            result = transfer.func(*transfer.args)
+            failed = False
+        except Exception as e:
+            log.debug("Scheduled transfer failed: %s" % e)
+            transfer.future.set_exception(e)
+        finally:
+            with self.condition:
+                self.active[transfer.destination] -= 1
+                if not self.active[transfer.destination]:
+                    del self.active[transfer.destination]
+                if failed:
+                    self.stats["failed"] += 1
+                else:
+                    self.stats["completed"] += 1
+                    self.stats["transferred_bytes"] += transfer.size
+                # Transfers held back by the destination cap may now start.
+                self.condition.notify_all()
+        if not failed:
+            transfer.future.set_result(result)
+
+    def __next_transfer(self):
+        # Called holding the condition.
+        for index, (_, transfer) in enumerate(self.pending):
+            active = self.active.get(transfer.destination, 0)
+            if self.max_per_destination and active >= self.max_per_destination:
+                continue
+            del self.pending[index]
+            self.active[transfer.destination] = active + 1
+            wait_time = time.time() - transfer.submitted
+            self.stats["total_wait_time"] += wait_time
+            self.stats["max_wait_time"] = max(self.stats["max_wait_time"], wait_time)
+            return transfer
+        return None
+
+    def __size_class(self, size):
+        if not self.small_first:
+            return 0
+        return len([limit for limit in SIZE_CLASSES if size > limit])
+
+
+class TokenBucket(object):
+    """ Paces consumption of ``rate`` tokens (bytes) per second, allowing
+    bursts of up to ``capacity`` tokens. Consuming more tokens than are
+    available waits until they would have accumulated, so large transfers
+    are paced as a whole.
+
+    >>> now = [0.0]
+    >>> waits = []
+    >>> bucket = TokenBucket(100, clock=lambda: now[0], sleep=waits.append)
+    >>> bucket.consume(50), bucket.consume(50), bucket.consume(200)
+    (0, 0, 2.0)
+    >>> now[0] = 4.0
+    >>> bucket.consume(100)
+    0
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.time, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        """ Take ``amount`` tokens, waiting until they are available. Returns
+        the number of seconds waited.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Tokens may go negative, later callers wait for the debt too.
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            self.sleep(delay)
+        return delay
+
+
+class _Transfer(object):
+
+    def __init__(self, func, args, destination, size):
+        self.func = func
+        self.args = args
+        self.destination = destination
+        self.size = size
+        self.submitted = time.time()
+        self.future = Future()
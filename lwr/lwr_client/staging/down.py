@@ -4,6 +4,8 @@ from re import compile
 from contextlib import contextmanager
 
 from ..staging import COMMAND_VERSION_FILENAME
+from ..staging.metrics import TransferMetrics
+from ..staging.metrics import download_record
 from ..action_mapper import FileActionMapper
 
 
@@ -17,13 +19,15 @@ log = getLogger(__name__)
 COPY_FROM_WORKING_DIRECTORY_PATTERN = compile(r"primary_.*|galaxy.json|metadata_.*|dataset_\d+\.dat|__instrument_.*|dataset_\d+_files.+")
 
 
-def finish_job(client, cleanup_job, job_completed_normally, client_outputs, lwr_outputs):
+def finish_job(client, cleanup_job, job_completed_normally, client_outputs, lwr_outputs, transfer_metrics=None):
     """ Responsible for downloading results from remote server and cleaning up
-    LWR staging directory (if needed.)
+    LWR staging directory (if needed.) If ``transfer_metrics`` (a
+    ``TransferMetrics`` object) is supplied, a record of each output collected
+    is added to it.
     """
     collection_failure_exceptions = []
     if job_completed_normally:
-        output_collector = ClientOutputCollector(client)
+        output_collector = ClientOutputCollector(client, transfer_metrics=transfer_metrics)
         action_mapper = FileActionMapper(client)
         results_stager = ResultsCollector(output_collector, action_mapper, client_outputs, lwr_outputs)
         collection_failure_exceptions = results_stager.collect()
@@ -33,24 +37,57 @@ def finish_job(client, cleanup_job, job_completed_normally, client_outputs, lwr_
 
 class ClientOutputCollector(object):
 
-    def __init__(self, client):
+    def __init__(self, client, transfer_metrics=None):
         self.client = client
+        # If client can fetch outputs in batches, queue up fetches until
+        # flush is called.
+        self.batch_fetches = hasattr(client, "batch_fetch_outputs")
+        self.pending_fetches = []
+        self.pending_records = []
+        self.transfer_metrics = transfer_metrics or TransferMetrics()
 
     def collect_output(self, results_collector, output_type, action, name):
+        record = download_record(action.path, output_type, action.action_type)
         # This output should have been handled by the LWR.
         if not action.staging_action_local:
+            if action.staging_needed:
+                self.transfer_metrics.record(record)
             return False
 
         working_directory = results_collector.client_outputs.working_directory
-        self.client.fetch_output(
+        fetch_request = dict(
             path=action.path,
             name=name,
             working_directory=working_directory,
             output_type=output_type,
             action_type=action.action_type
         )
+        compression = getattr(action, "compression", None)
+        if compression:
+            fetch_request["compression"] = compression
+        if self.batch_fetches:
+            self.pending_fetches.append(fetch_request)
+            self.pending_records.append(record)
+        else:
+            with self.transfer_metrics.timed(record):
+                self.client.fetch_output(**fetch_request)
         return True
 
+    def flush(self, exception_tracker):
+        pending_fetches = self.pending_fetches
+        pending_records = self.pending_records
+        self.pending_fetches = []
+        self.pending_records = []
+        if not pending_fetches:
+            return
+        with self.transfer_metrics.timed(*pending_records):
+            failures = self.client.batch_fetch_outputs(pending_fetches)
+            for record, failure in zip(pending_records, failures):
+                record.exception = failure
+        for failure in failures:
+            if failure is not None:
+                exception_tracker.track(failure)
+
 
 class ResultsCollector(object):
 
@@ -61,7 +98,8 @@ class ResultsCollector(object):
         self.lwr_outputs = lwr_outputs
         self.downloaded_working_directory_files = []
         self.exception_tracker = DownloadExceptionTracker()
-        self.output_files = client_outputs.output_files
+        # Copied, so finish_job may be retried with the same client_outputs.
+        self.output_files = list(client_outputs.output_files)
         self.working_directory_contents = lwr_outputs.working_directory_contents or []
 
     def collect(self):
@@ -69,6 +107,7 @@ class ResultsCollector(object):
         self.__collect_outputs()
         self.__collect_version_file()
         self.__collect_other_working_directory_files()
+        self.__flush_collected_outputs()
         return self.exception_tracker.collection_failure_exceptions
 
     def __collect_working_directory_outputs(self):
@@ -118,6 +157,11 @@ class ResultsCollector(object):
                 if self._attempt_collect_output(output_type='output_workdir', path=output_file, name=name):
                     self.downloaded_working_directory_files.append(name)
 
+    def __flush_collected_outputs(self):
+        # Output collectors may queue up outputs and transfer them together.
+        with self.exception_tracker():
+            self.output_collector.flush(self.exception_tracker)
+
     def _attempt_collect_output(self, output_type, path, name=None):
         # path is final path on galaxy server (client)
         # name is the 'name' of the file on the LWR server (possible a relative)
@@ -148,7 +192,10 @@ class DownloadExceptionTracker(object):
         try:
             yield
         except Exception as e:
-            self.collection_failure_exceptions.append(e)
+            self.track(e)
+
+    def track(self, exception):
+        self.collection_failure_exceptions.append(exception)
 
 
 def __clean(collection_failure_exceptions, cleanup_job, client):
@@ -0,0 +1,227 @@
+""" Instrumentation describing how the files of a job were staged.
+
+Pass a ``TransferMetrics`` object to ``submit_job`` and/or ``finish_job`` to
+collect a ``TransferRecord`` for each file staged - the metrics object can
+summarize these per job and pass each record to callbacks (e.g. to feed an
+external monitoring system) as it is collected.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from ..decorators import retry_count
+
+from logging import getLogger
+log = getLogger(__name__)
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+_cache_waits = threading.local()
+
+
+def cache_wait_time():
+    """ Seconds the current thread has spent waiting on files to become
+    available in the LWR's cache so far.
+    """
+    return getattr(_cache_waits, "seconds", 0.0)
+
+
+def record_cache_wait(seconds):
+    _cache_waits.seconds = cache_wait_time() + seconds
+
+
+class TransferRecord(object):
+    """ Describes the staging of a single file.
+
+    ``wall_time`` and ``retries`` are only measured for files transferred by
+    the client (i.e. not for remote staging actions) - files transferred in the
+    same batch share the wall time and retries of that batch. ``cache_wait``
+    is the part of the wall time spent waiting on the file to become
+    available in the LWR's cache (if transfers are cached).
+
+    >>> record = TransferRecord("/data/1.dat", "input", "transfer", UPLOAD, bytes=2048, wall_time=2.0)
+    >>> record.throughput
+    1024.0
+    >>> record.failed
+    False
+    >>> TransferRecord("/data/1.dat", "input", "remote_transfer", UPLOAD).throughput is None
+    True
+    """
+
+    def __init__(self, path, path_type, action_type, direction, bytes=None, wall_time=None, retries=0, batch=None, exception=None, cache_wait=0.0):
+        self.path = path
+        self.path_type = path_type
+        self.action_type = action_type
+        self.direction = direction
+        self.bytes = bytes
+        self.wall_time = wall_time
+        self.retries = retries
+        self.batch = batch
+        self.exception = exception
+        self.cache_wait = cache_wait
+
+    @property
+    def throughput(self):
+        """ Bytes per second, None if not measured.
+        """
+        if self.bytes is None or not self.wall_time:
+            return None
+        return self.bytes / float(self.wall_time)
+
+    @property
+    def failed(self):
+        return self.exception is not None
+
+    def to_dict(self):
+        return dict(
+            path=self.path,
+            path_type=self.path_type,
+            action_type=self.action_type,
+            direction=self.direction,
+            bytes=self.bytes,
+            wall_time=self.wall_time,
+            throughput=self.throughput,
+            retries=self.retries,
+            cache_wait=self.cache_wait,
+            failed=self.failed,
+        )
+
+
+class TransferMetrics(object):
+    """ Collects ``TransferRecord`` objects for a job.
+
+    >>> metrics = TransferMetrics()
+    >>> recorded = []
+    >>> metrics.add_callback(recorded.append)
+    >>> metrics.record(TransferRecord("/data/1.dat", "input", "transfer", UPLOAD, bytes=10, wall_time=1.0))
+    >>> metrics.record(TransferRecord("/data/2.dat", "input", "transfer", UPLOAD, bytes=30, wall_time=1.0, retries=1))
+    >>> len(recorded)
+    2
+    >>> summary = metrics.summary()
+    >>> summary["files"], summary["bytes"], summary["retries"], summary["throughput"]
+    (2, 40, 1, 20.0)
+    >>> [group["action_type"] for group in summary["groups"]]
+    ['transfer']
+    """
+
+    def __init__(self, callbacks=[]):
+        self.records = []
+        self.callbacks = list(callbacks)
+        self.__batch_count = 0
+
+    def add_callback(self, callback):
+        """ Register callable to be passed each ``TransferRecord`` as it is
+        collected.
+        """
+        self.callbacks.append(callback)
+
+    def record(self, record):
+        self.records.append(record)
+        for callback in self.callbacks:
+            try:
+                callback(record)
+            except Exception:
+                log.exception("Transfer metrics callback failed.")
+
+    @contextmanager
+    def timed(self, *records):
+        """ Measure the wall time and retries of the transfer(s) performed in
+        the body of this context and then record ``records``. If several
+        records are supplied they are assumed to be transferred together in a
+        batch.
+        """
+        batch = None
+        if len(records) > 1:
+            self.__batch_count += 1
+            batch = self.__batch_count
+        start_retries = retry_count()
+        start_cache_wait = cache_wait_time()
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            for record in records:
+                if record.exception is None:
+                    record.exception = e
+            raise
+        finally:
+            wall_time = time.time() - start
+            retries = retry_count() - start_retries
+            cache_wait = cache_wait_time() - start_cache_wait
+            for record in records:
+                record.wall_time = wall_time
+                record.retries = retries
+                record.cache_wait = cache_wait
+                record.batch = batch
+                if record.bytes is None and record.direction == DOWNLOAD and not record.failed:
+                    record.bytes = _file_size(record.path)
+                self.record(record)
+
+    def summary(self):
+        """ Summarize collected records as a dictionary, totals are broken
+        down into ``groups`` by direction, path type and action type.
+        """
+        summary = _summarize(self.records)
+        groups = {}
+        for record in self.records:
+            key = (record.direction, record.path_type, record.action_type)
+            groups.setdefault(key, []).append(record)
+        summary["groups"] = []
+        for key in sorted(groups.keys()):
+            group = _summarize(groups[key])
+            group.update(dict(zip(("direction", "path_type", "action_type"), key)))
+            summary["groups"].append(group)
+        return summary
+
+
+def upload_record(path, path_type, action_type, contents=None):
+    if contents is not None:
+        bytes = len(contents.encode("utf-8"))
+    else:
+        bytes = _file_size(path)
+    return TransferRecord(path, path_type, action_type, UPLOAD, bytes=bytes)
+
+
+def download_record(path, path_type, action_type):
+    return TransferRecord(path, path_type, action_type, DOWNLOAD)
+
+
+def _summarize(records):
+    bytes = 0
+    measured_bytes = 0
+    wall_time = 0.0
+    retries = 0
+    cache_wait = 0.0
+    counted_batches = set()
+    for record in records:
+        bytes += record.bytes or 0
+        if record.wall_time is None:
+            continue
+        measured_bytes += record.bytes or 0
+        if record.batch is not None:
+            if record.batch in counted_batches:
+                continue
+            counted_batches.add(record.batch)
+        wall_time += record.wall_time
+        retries += record.retries
+        cache_wait += record.cache_wait
+    return dict(
+        files=len(records),
+        failures=len([record for record in records if record.failed]),
+        bytes=bytes,
+        wall_time=wall_time,
+        throughput=(measured_bytes / wall_time) if wall_time else None,
+        retries=retries,
+        cache_wait=cache_wait,
+    )
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+__all__ = [TransferMetrics, TransferRecord]
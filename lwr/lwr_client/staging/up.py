@@ -2,13 +2,16 @@ from os.path import abspath, basename, join, exists
 from os.path import dirname
 from os.path import relpath
 from os import listdir, sep
-from re import findall
+from re import compile, escape, findall
 from io import open
 
 from ..staging import COMMAND_VERSION_FILENAME
+from ..staging.metrics import TransferMetrics
+from ..staging.metrics import upload_record
 from ..action_mapper import FileActionMapper
 from ..action_mapper import path_type
 from ..action_mapper import MessageAction
+from ..action_mapper import PrefixPathMapper
 from ..util import PathHelper
 from ..util import directory_files
 
@@ -16,10 +19,13 @@ from logging import getLogger
 log = getLogger(__name__)
 
 
-def submit_job(client, client_job_description, job_config=None):
+def submit_job(client, client_job_description, job_config=None, transfer_metrics=None):
     """
+    Stage the files of the described job and then launch it. If
+    ``transfer_metrics`` (a ``TransferMetrics`` object) is supplied, a record
+    of each file staged is added to it.
     """
-    file_stager = FileStager(client, client_job_description, job_config)
+    file_stager = FileStager(client, client_job_description, job_config, transfer_metrics=transfer_metrics)
     rebuilt_command_line = file_stager.get_command_line()
     job_id = file_stager.job_id
     launch_kwds = dict(
@@ -55,9 +61,11 @@ class FileStager(object):
         LWR client object.
     client_job_description : client_job_description
         Description of client view of job to stage and execute remotely.
+    transfer_metrics : TransferMetrics
+        Optional collector of records describing files staged.
     """
 
-    def __init__(self, client, client_job_description, job_config):
+    def __init__(self, client, client_job_description, job_config, transfer_metrics=None):
         """
         """
         self.client = client
@@ -81,16 +89,19 @@ class FileStager(object):
 
         self.__handle_setup(job_config)
 
-        self.transfer_tracker = TransferTracker(client, self.path_helper, self.action_mapper, self.job_inputs, rewrite_paths=self.rewrite_paths)
+        self.transfer_tracker = TransferTracker(client, self.path_helper, self.action_mapper, self.job_inputs,
+                                                rewrite_paths=self.rewrite_paths, transfer_metrics=transfer_metrics)
 
         self.__initialize_referenced_tool_files()
         if self.rewrite_paths:
             self.__initialize_referenced_arbitrary_files()
+            self.__initialize_referenced_input_files()
 
         self.__upload_tool_files()
         self.__upload_input_files()
         self.__upload_working_directory_files()
         self.__upload_arbitrary_files()
+        self.transfer_tracker.flush()
 
         if self.rewrite_paths:
             self.__initialize_output_file_renames()
@@ -101,6 +112,7 @@ class FileStager(object):
         self.__handle_rewrites()
 
         self.__upload_rewritten_config_files()
+        self.transfer_tracker.flush()
 
     def __handle_setup(self, job_config):
         if not job_config:
@@ -134,11 +146,20 @@ class FileStager(object):
 
     def __initialize_referenced_arbitrary_files(self):
         referenced_arbitrary_path_mappers = dict()
-        for mapper in self.action_mapper.unstructured_mappers():
-            mapper_pattern = mapper.to_pattern()
+        mappers = list(self.action_mapper.unstructured_mappers())
+        # References below all prefix mappers' paths are found in one pass
+        # over the job inputs, other mappers' patterns are searched for.
+        prefix_references = self.job_inputs.find_prefix_references(
+            [mapper.to_prefix() for mapper in mappers if hasattr(mapper, "to_prefix")],
+            PrefixPathMapper.path_pattern,
+        )
+        for mapper in mappers:
             # TODO: Make more sophisticated, allow parent directories,
             # grabbing sibbling files based on patterns, etc...
-            paths = self.job_inputs.find_pattern_references(mapper_pattern)
+            if hasattr(mapper, "to_prefix"):
+                paths = prefix_references[_text(mapper.to_prefix())]
+            else:
+                paths = self.job_inputs.find_pattern_references(mapper.to_pattern())
             for path in paths:
                 if path not in referenced_arbitrary_path_mappers:
                     referenced_arbitrary_path_mappers[path] = mapper
@@ -147,6 +168,15 @@ class FileStager(object):
             unstructured_map = action.unstructured_map(self.path_helper)
             self.arbitrary_files.update(unstructured_map)
 
+    def __initialize_referenced_input_files(self):
+        # Find all referenced inputs in one pass over the job inputs, rather
+        # than one per input.
+        paths = []
+        for input_file in self.input_files:
+            paths.append(input_file)
+            paths.append(_extra_files_path(input_file))
+        self.job_inputs.index_paths(paths)
+
     def __upload_tool_files(self):
         for referenced_tool_file in self.referenced_tool_files:
             self.transfer_tracker.handle_transfer(referenced_tool_file, path_type.TOOL)
@@ -170,12 +200,12 @@ class FileStager(object):
                 log.debug(message)
 
     def __upload_input_extra_files(self, input_file):
-        files_path = "%s_files" % input_file[0:-len(".dat")]
+        files_path = _extra_files_path(input_file)
         if exists(files_path) and self.__stage_input(files_path):
             for extra_file_name in directory_files(files_path):
                 extra_file_path = join(files_path, extra_file_name)
                 remote_name = self.path_helper.remote_name(relpath(extra_file_path, dirname(files_path)))
-                self.transfer_tracker.handle_transfer(extra_file_path, path_type.INPUT, name=remote_name)
+                self.transfer_tracker.handle_transfer(extra_file_path, path_type.INPUT, name=remote_name, archive=True)
 
     def __upload_working_directory_files(self):
         # Task manager stages files into working directory, these need to be
@@ -270,6 +300,11 @@ class JobInputs(object):
     True
     >>> inputs.path_referenced('/path/to/notinput')
     False
+    >>> inputs.path_referenced('/path/to/inpu.')
+    False
+    >>> inputs.index_paths(['/path/to/input', '/path/to/input_files', '/the'])
+    >>> inputs.path_referenced('/path/to/input'), inputs.path_referenced('/path/to/input_files')
+    (True, False)
     >>> tf.close()
     """
 
@@ -279,6 +314,8 @@ class JobInputs(object):
         for config_file in config_files or []:
             config_contents = _read(config_file)
             self.config_files[config_file] = config_contents
+        # Whether paths are referenced, cleared when inputs are rewritten.
+        self.referenced_paths = {}
 
     def find_pattern_references(self, pattern):
         referenced_files = set()
@@ -298,17 +335,35 @@ class JobInputs(object):
             Full path to directory to search.
 
         """
-        pattern = r"(%s%s\S+)" % (directory, sep)
-        return self.find_pattern_references(pattern)
+        prefix = _text(directory) + sep
+        return self.find_prefix_references([prefix])[prefix]
+
+    def find_prefix_references(self, prefixes, path_pattern=r"\S+"):
+        """
+        Return a dictionary mapping each of `prefixes` to the list of paths
+        starting with it (and continuing as `path_pattern` matches) in job
+        inputs - found in a single pass over the job inputs.
+        """
+        references = PathReferenceIndex(prefixes).find_prefixed(self.__items(), path_pattern)
+        return dict((prefix, list(paths)) for prefix, paths in references.items())
+
+    def index_paths(self, paths):
+        """
+        Determine which of `paths` are referenced in a single pass over the
+        job inputs, so `path_referenced` answers for them without searching
+        again.
+        """
+        paths = [path for path in paths if path not in self.referenced_paths]
+        if not paths:
+            return
+        found = PathReferenceIndex(paths).find(self.__items())
+        for path in paths:
+            self.referenced_paths[path] = _text(path) in found
 
     def path_referenced(self, path):
-        pattern = r"%s" % path
-        found = False
-        for input_contents in self.__items():
-            if findall(pattern, input_contents):
-                found = True
-                break
-        return found
+        if path not in self.referenced_paths:
+            self.index_paths([path])
+        return self.referenced_paths[path]
 
     def rewrite_paths(self, local_path, remote_path):
         """
@@ -316,6 +371,7 @@ class JobInputs(object):
         """
         self.__rewrite_command_line(local_path, remote_path)
         self.__rewrite_config_files(local_path, remote_path)
+        self.referenced_paths = {}
 
     def __rewrite_command_line(self, local_path, remote_path):
         self.command_line = self.command_line.replace(local_path, remote_path)
@@ -330,9 +386,103 @@ class JobInputs(object):
         return items
 
 
+class PathReferenceIndex(object):
+    """
+    Prefix trie of paths, used to find which of them occur (anywhere, as
+    literal text) in a set of texts. Positions a path could start at are
+    located with a regular expression, then the trie is walked from each -
+    so texts are scanned once however many paths are searched for.
+
+    >>> index = PathReferenceIndex(["/data/1.dat", "/data/1.dat_files", "/data/2.dat", "/data/1"])
+    >>> index.find([u"cat /data/1.dat > /data/3.dat", u"x=/data/2.dat"]) == set([u"/data/1", u"/data/1.dat", u"/data/2.dat"])
+    True
+    >>> index.find([u"/data/1xdat /data/"]) == set([u"/data/1"])
+    True
+    >>> index = PathReferenceIndex(["/a/b/", "/a/bc/"])
+    >>> found = index.find_prefixed([u"/a/b/1 /a/bc/2 /a/b/ /a/b/3,/a/bd/4"], r"[^\s,]+")
+    >>> found[u"/a/b/"] == set([u"/a/b/1", u"/a/b/3"]), found[u"/a/bc/"] == set([u"/a/bc/2"])
+    (True, True)
+    """
+
+    def __init__(self, paths):
+        self.root = {}
+        self.paths = set()
+        for path in paths:
+            path = _text(path)
+            if not path:
+                continue
+            node = self.root
+            for char in path:
+                node = node.setdefault(char, {})
+            node[None] = path
+            self.paths.add(path)
+        self.starts = compile(u"|".join(escape(char) for char in self.root)) if self.root else None
+
+    def find(self, texts):
+        """ Return the set of indexed paths occurring in any of `texts`.
+        """
+        found = set()
+        if self.starts is None:
+            return found
+        for text in texts:
+            text = _text(text)
+            length = len(text)
+            for match in self.starts.finditer(text):
+                node = self.root
+                position = match.start()
+                while position < length:
+                    node = node.get(text[position], None)
+                    if node is None:
+                        break
+                    if None in node:
+                        found.add(node[None])
+                    position += 1
+                if len(found) == len(self.paths):
+                    return found
+        return found
+
+    def find_prefixed(self, texts, path_pattern=r"\S+"):
+        """ Return a dictionary mapping each indexed path to the set of
+        (longer) paths starting with it in `texts` - each occurrence of an
+        indexed path followed by text matching `path_pattern`. As with
+        ``re.findall``, occurrences overlapping an earlier occurrence of the
+        same indexed path are skipped.
+        """
+        found = dict((path, set()) for path in self.paths)
+        if self.starts is None:
+            return found
+        rest = compile(path_pattern)
+        for text in texts:
+            text = _text(text)
+            length = len(text)
+            # End of the last reference found to each indexed path.
+            ends = {}
+            for match in self.starts.finditer(text):
+                node = self.root
+                start = position = match.start()
+                while position < length:
+                    node = node.get(text[position], None)
+                    if node is None:
+                        break
+                    position += 1
+                    prefix = node.get(None, None)
+                    if prefix is None or start < ends.get(prefix, 0):
+                        continue
+                    rest_match = rest.match(text, position)
+                    if rest_match and rest_match.end() > position:
+                        found[prefix].add(text[start:rest_match.end()])
+                        ends[prefix] = rest_match.end()
+        return found
+
+
 class TransferTracker(object):
+    """ Dispatches staging actions for job files and records the resulting
+    path rewrites. If the client supports it, files transferred by the
+    client are queued and sent as a batch when ``flush`` is called (rewrites
+    for these files are registered at that point).
+    """
 
-    def __init__(self, client, path_helper, action_mapper, job_inputs, rewrite_paths):
+    def __init__(self, client, path_helper, action_mapper, job_inputs, rewrite_paths, transfer_metrics=None):
         self.client = client
         self.path_helper = path_helper
         self.action_mapper = action_mapper
@@ -341,14 +491,29 @@ class TransferTracker(object):
         self.rewrite_paths = rewrite_paths
         self.file_renames = {}
         self.remote_staging_actions = []
+        self.batch_transfers = hasattr(client, "batch_put_files")
+        self.pending_transfers = []
+        self.transfer_metrics = transfer_metrics or TransferMetrics()
 
-    def handle_transfer(self, path, type, name=None, contents=None):
+    def handle_transfer(self, path, type, name=None, contents=None, archive=False):
+        # archive marks files (e.g. input extra files) the client may send
+        # together in a single archive.
         action = self.__action_for_transfer(path, type, contents)
 
         if action.staging_needed:
             local_action = action.staging_action_local
+            register = self.rewrite_paths or type == 'tool'  # Even if inputs not rewritten, tool must be.
+            record = upload_record(path, type, action.action_type, contents=contents)
             if local_action:
-                response = self.client.put_file(path, type, name=name, contents=contents)
+                put_kwds = self.__put_kwds(action, name, contents)
+                if self.batch_transfers:
+                    put_request = dict(path=path, input_type=type, **put_kwds)
+                    if archive:
+                        put_request["archive"] = True
+                    self.pending_transfers.append((put_request, register, record))
+                    return
+                with self.transfer_metrics.timed(record):
+                    response = self.client.put_file(path, type, **put_kwds)
                 get_path = lambda: response['path']
             else:
                 job_directory = self.client.job_directory
@@ -356,8 +521,8 @@ class TransferTracker(object):
                 if not name:
                     name = basename(path)
                 self.__add_remote_staging_input(action, name, type)
+                self.transfer_metrics.record(record)
                 get_path = lambda: job_directory.calculate_path(name, type)
-            register = self.rewrite_paths or type == 'tool'  # Even if inputs not rewritten, tool must be.
             if register:
                 self.register_rewrite(path, get_path(), type, force=True)
         elif self.rewrite_paths:
@@ -367,6 +532,38 @@ class TransferTracker(object):
 
         # else: # No action for this file
 
+    def __put_kwds(self, action, name, contents):
+        put_kwds = dict(name=name, contents=contents)
+        compression = getattr(action, "compression", None)
+        if compression:
+            put_kwds["compression"] = compression
+        return put_kwds
+
+    def flush(self):
+        """ Transfer queued files and register their rewrites.
+        """
+        pending_transfers = self.pending_transfers
+        self.pending_transfers = []
+        if not pending_transfers:
+            return
+        put_requests = [put_request for (put_request, _, _) in pending_transfers]
+        records = [record for (_, _, record) in pending_transfers]
+        with self.transfer_metrics.timed(*records):
+            responses = self.client.batch_put_files(put_requests)
+            for record, response in zip(records, responses):
+                if isinstance(response, Exception):
+                    record.exception = response
+        failed_paths = []
+        for (put_request, register, _), response in zip(pending_transfers, responses):
+            path = put_request["path"]
+            if isinstance(response, Exception):
+                log.warn("Failed to transfer file %s: %s" % (path, response))
+                failed_paths.append(path)
+            elif register:
+                self.register_rewrite(path, response['path'], put_request["input_type"], force=True)
+        if failed_paths:
+            raise Exception("Failed to transfer files %s" % failed_paths)
+
     def __add_remote_staging_input(self, action, name, type):
         input_dict = dict(
             name=name,
@@ -405,6 +602,16 @@ class TransferTracker(object):
         return self.action_mapper.action(path, type)
 
 
+def _extra_files_path(input_file):
+    return "%s_files" % input_file[0:-len(".dat")]
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
 def _read(path):
     """
     Utility method to quickly read small files (config files and tool
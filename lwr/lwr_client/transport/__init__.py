@@ -3,12 +3,13 @@ from .curl import PycurlTransport
 import os
 
 
-def get_transport(transport_type=None, os_module=os):
+def get_transport(transport_type=None, os_module=os, transport_params=None):
     transport_type = __get_transport_type(transport_type, os_module)
+    transport_params = transport_params or {}
     if transport_type == 'urllib':
         transport = Urllib2Transport()
     else:
-        transport = PycurlTransport()
+        transport = PycurlTransport(**transport_params)
     return transport
 
 
@@ -1,57 +1,718 @@
+from __future__ import with_statement
 try:
     from cStringIO import StringIO
 except ImportError:
     from io import StringIO
 try:
     from pycurl import Curl
+    from pycurl import CurlShare
+    from pycurl import CurlMulti
+    import pycurl
 except ImportError:
     pass
+try:
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlsplit
+from collections import deque
+from contextlib import contextmanager
+from os.path import exists
 from os.path import getsize
+from os import unlink
+from threading import Lock
+from threading import Thread
+import time
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+from ..compression import compress_to_temp
+from ..compression import content_encoding
+from ..compression import record_accepted_encodings
+from ..compression import resolve_encoding
+from ..compression import upload_encoding
+from ..compression import DecompressingWriter
+from ..util import Future
+from ..util import RangeReader
+
+import logging
+log = logging.getLogger(__name__)
 
 
 PYCURL_UNAVAILABLE_MESSAGE = \
     "You are attempting to use the Pycurl version of the LWR client but pycurl is unavailable."
 
+# Number of idle curl handles (and so open keep-alive connections) retained
+# per LWR destination.
+DEFAULT_POOL_SIZE = 4
+# Maximum number of concurrent transfers for execute_many.
+DEFAULT_MAX_IN_FLIGHT = 8
+SELECT_TIMEOUT = 1.0
+# Shorter, so requests submitted while transfers are active start promptly.
+EVENT_LOOP_SELECT_TIMEOUT = 0.05
+# Responses whose bodies are written to output paths.
+SUCCESS_STATUS_CODES = (200, 206)
+
 
 class PycurlTransport(object):
 
-    def execute(self, url, data=None, input_path=None, output_path=None):
-        buf = _open_output(output_path)
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.curl_pool = CurlPool(pool_size=pool_size)
+        self.max_in_flight = int(max_in_flight)
+        self.event_loop = CurlEventLoop(self.curl_pool, max_in_flight=self.max_in_flight)
+
+    def execute(self, url, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
+        request = dict(url=url, data=data, input_path=input_path, output_path=output_path,
+                       resume=resume, byte_range=byte_range, compression=compression, etag=etag)
+        while True:
+            transfer = CurlTransfer(**request)
+            try:
+                with self.curl_pool.curl(url) as c:
+                    transfer.setup(c)
+                    c.perform()
+                    transfer.check_response(c)
+                return transfer.response()
+            except CurlTransferException as e:
+                request = transfer.fallback_request(e)
+                if request is None:
+                    raise
+            finally:
+                transfer.close()
+
+    def execute_async(self, url, **kwds):
+        """ Submit request (arguments as for ``execute``) to this transport's
+        event loop, returns a ``Future`` for the response. Requests submitted
+        from any number of threads are multiplexed by a single thread over
+        the pooled connections.
+        """
+        return self.event_loop.submit(dict(url=url, **kwds))
+
+    def execute_many(self, requests, max_in_flight=None):
+        """ Execute many requests (dictionaries with the same keys as the
+        arguments to ``execute``) concurrently using a ``CurlMulti`` object,
+        keeping at most ``max_in_flight`` transfers active at once.
+
+        Returns a list of results in the same order as ``requests`` - each
+        result is either the response (as ``execute`` would return it) or the
+        exception that caused that particular request to fail.
+        """
+        max_in_flight = int(max_in_flight or self.max_in_flight)
+        results = [None] * len(requests)
+        pending = deque(enumerate(requests))
+        active = {}
+        preparing = []
+        multi = _new_curl_multi_object()
         try:
-            c = _new_curl_object()
-            c.setopt(c.URL, url.encode('ascii'))
-            c.setopt(c.WRITEFUNCTION, buf.write)
-            if input_path:
-                c.setopt(c.UPLOAD, 1)
-                c.setopt(c.READFUNCTION, open(input_path, 'rb').read)
-                filesize = getsize(input_path)
-                c.setopt(c.INFILESIZE, filesize)
-            if data:
-                c.setopt(c.POST, 1)
-                if type(data).__name__ == 'unicode':
-                    data = data.encode('UTF-8')
-                c.setopt(c.POSTFIELDS, data)
-            c.perform()
-            if not output_path:
-                return buf.getvalue()
+            while pending or active or preparing:
+                while pending and len(active) + len(preparing) < max_in_flight:
+                    index, request = pending.popleft()
+                    error = _start_transfer(self.curl_pool, multi, active, preparing, index, request)
+                    if error is not None:
+                        results[index] = error
+                for index, result in _finished_transfers(self.curl_pool, multi, active, preparing):
+                    results[index] = result
+                _wait(multi, active, preparing, SELECT_TIMEOUT)
+        finally:
+            _abort_transfers(self.curl_pool, multi, active, preparing)
+            multi.close()
+        return results
+
+    def shutdown(self):
+        self.event_loop.stop()
+
+
+class CurlEventLoop(object):
+    """ Drive transfers submitted from any thread through a single
+    ``CurlMulti`` object on a (lazily started) background thread, keeping at
+    most ``max_in_flight`` transfers active at once.
+    """
+
+    def __init__(self, curl_pool, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        self.curl_pool = curl_pool
+        self.max_in_flight = max_in_flight
+        self.queue = Queue()
+        self.thread = None
+        self.lock = Lock()
+
+    def submit(self, request):
+        future = Future()
+        self.queue.put((request, future))
+        with self.lock:
+            if self.thread is None:
+                thread = Thread(target=self.__run, name="lwr_client_curl_event_loop")
+                thread.daemon = True
+                thread.start()
+                self.thread = thread
+        return future
+
+    def stop(self):
+        """ Stop the loop once requests already submitted are complete.
+        """
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread = None
+
+    def __run(self):
+        pending = deque()
+        active = {}
+        preparing = []
+        stopping = False
+        multi = _new_curl_multi_object()
+        try:
+            while pending or active or preparing or not stopping:
+                stopping = self.__receive(pending, block=not (pending or active or preparing)) or stopping
+                while pending and len(active) + len(preparing) < self.max_in_flight:
+                    request, future = pending.popleft()
+                    error = _start_transfer(self.curl_pool, multi, active, preparing, future, request)
+                    if error is not None:
+                        future.set_exception(error)
+                for future, result in _finished_transfers(self.curl_pool, multi, active, preparing):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+                _wait(multi, active, preparing, EVENT_LOOP_SELECT_TIMEOUT)
+        except Exception as e:
+            log.exception("Curl event loop failed.")
+            for _, future in pending:
+                future.set_exception(e)
         finally:
-            buf.close()
+            unfinished = [future for future, _ in active.values()] + [future for future, _, _ in preparing]
+            for future in unfinished:
+                if not future.done():
+                    future.set_exception(Exception("Curl event loop stopped."))
+            _abort_transfers(self.curl_pool, multi, active, preparing)
+            multi.close()
+
+    def __receive(self, pending, block):
+        """ Move newly submitted requests into pending, returns True if the
+        loop has been asked to stop.
+        """
+        stop = False
+        while True:
+            try:
+                item = self.queue.get(block=block)
+            except Empty:
+                break
+            block = False
+            if item is None:
+                stop = True
+            else:
+                pending.append(item)
+        return stop
+
+
+def _start_transfer(curl_pool, multi, active, preparing, key, request):
+    """ Setup a curl handle for request (transfer arguments, or a prepared
+    ``CurlTransfer``) and add it to multi, returns the exception raised if
+    that fails. Transfers needing preparation (compression) are instead
+    prepared on a background thread and added to ``preparing``, so the
+    thread driving multi isn't blocked - see ``_prepared_transfers``.
+    """
+    transfer = request if isinstance(request, CurlTransfer) else CurlTransfer(**request)
+    if transfer.needs_preparation:
+        preparing.append((key, transfer, _prepare_in_background(transfer)))
+        return None
+    try:
+        c = curl_pool.acquire(transfer.url)
+    except Exception as e:
+        transfer.close()
+        return e
+    try:
+        transfer.setup(c)
+    except Exception as e:
+        curl_pool.release(transfer.url, c, reuse=False)
+        transfer.close()
+        return e
+    multi.add_handle(c)
+    active[c] = (key, transfer)
+
+
+def _prepare_in_background(transfer):
+    future = Future()
+
+    def prepare():
+        try:
+            transfer.prepare()
+            future.set_result(transfer)
+        except Exception as e:
+            future.set_exception(e)
+
+    thread = Thread(target=prepare, name="lwr_client_curl_prepare")
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def _prepared_transfers(curl_pool, multi, active, preparing):
+    """ Start transfers whose preparation is complete, returns (key,
+    exception) for each that failed.
+    """
+    failed = []
+    for item in list(preparing):
+        key, transfer, future = item
+        if not future.done():
+            continue
+        preparing.remove(item)
+        error = future.exception() or _start_transfer(curl_pool, multi, active, preparing, key, transfer)
+        if error is not None:
+            transfer.close()
+            failed.append((key, error))
+    return failed
+
+
+def _wait(multi, active, preparing, timeout):
+    if active:
+        multi.select(timeout)
+    elif preparing:
+        time.sleep(min(timeout, EVENT_LOOP_SELECT_TIMEOUT))
+
+
+def _finished_transfers(curl_pool, multi, active, preparing):
+    """ Perform pending work on multi and return (key, result) for each
+    transfer completed.
+    """
+    finished = _prepared_transfers(curl_pool, multi, active, preparing)
+    while True:
+        ret, num_handles = multi.perform()
+        if ret != pycurl.E_CALL_MULTI_PERFORM:
+            break
+    while True:
+        num_queued, ok_list, err_list = multi.info_read()
+        for c in ok_list:
+            key, transfer = active.pop(c)
+            multi.remove_handle(c)
+            retry = None
+            try:
+                transfer.check_response(c)
+                result = transfer.response()
+            except Exception as e:
+                result = e
+                retry = transfer.fallback_request(e)
+            finally:
+                transfer.close()
+            curl_pool.release(transfer.url, c)
+            if retry is not None:
+                error = _start_transfer(curl_pool, multi, active, preparing, key, retry)
+                if error is None:
+                    continue
+                result = error
+            finished.append((key, result))
+        for c, errno, message in err_list:
+            key, transfer = active.pop(c)
+            multi.remove_handle(c)
+            transfer.close()
+            curl_pool.release(transfer.url, c, reuse=False)
+            finished.append((key, CurlTransferException(transfer.url, message)))
+        if num_queued == 0:
+            break
+    return finished
+
+
+def _abort_transfers(curl_pool, multi, active, preparing):
+    for c, (key, transfer) in list(active.items()):
+        multi.remove_handle(c)
+        transfer.close()
+        curl_pool.release(transfer.url, c, reuse=False)
+    active.clear()
+    for key, transfer, future in preparing:
+        # Cleaned up once prepared.
+        future.add_done_callback(lambda future, transfer=transfer: transfer.close())
+    del preparing[:]
+
+
+class CurlTransfer(object):
+    """ State (output buffer, open input file) associated with a single
+    request executed through a curl handle. If ``byte_range`` (an
+    ``(offset, length)`` tuple) is specified only that portion of
+    ``input_path`` is sent or only that portion of the remote file is
+    requested and written into ``output_path`` at ``offset``. If
+    ``compression`` is set, ``input_path`` is sent compressed and a compressed
+    response is accepted (and decoded) for ``output_path`` - ranged transfers
+    are never compressed. If ``etag`` is set the request is conditional, a
+    ``304 Not Modified`` response leaves ``output_path`` untouched and yields
+    a None response.
+    """
+
+    def __init__(self, url, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
+        self.request = dict(url=url, data=data, input_path=input_path, output_path=output_path,
+                            resume=resume, byte_range=byte_range, compression=compression, etag=etag)
+        self.url = url
+        self.data = data
+        self.input_path = input_path
+        self.output_path = output_path
+        self.resume_offset = _resume_offset(output_path) if resume else 0
+        self.byte_range = byte_range
+        self.compression = None
+        if not (self.resume_offset or byte_range):
+            if input_path:
+                self.compression = upload_encoding(compression, url)
+            else:
+                self.compression = resolve_encoding(compression)
+        self.accept_encoding = None
+        self.etag = None
+        if not (self.resume_offset or byte_range):
+            self.etag = etag
+        self.not_modified = False
+        self.compressed_path = None
+        self.buf = None
+        self.input = None
+
+    @property
+    def needs_preparation(self):
+        return bool(self.input_path and self.compression and not self.byte_range and self.compressed_path is None)
+
+    def prepare(self):
+        """ Compress ``input_path`` if needed - this is slow, so callers
+        multiplexing transfers do this on another thread before ``setup``.
+        """
+        if self.needs_preparation:
+            self.compressed_path = compress_to_temp(self.input_path, self.compression)
+
+    def fallback_request(self, exception):
+        """ Arguments to retry this request with if ``exception`` is the
+        server rejecting its compressed body (None otherwise) - as
+        advertised by the server if it doesn't support the encoding, else
+        uncompressed.
+        """
+        status_code = getattr(exception, "status_code", None)
+        if not (self.input_path and self.compression) or status_code not in [413, 415]:
+            return None
+        compression = None
+        if status_code == 415:
+            record_accepted_encodings(self.url, self.accept_encoding)
+            requested_compression = self.request["compression"]
+            if upload_encoding(requested_compression, self.url) != self.compression:
+                compression = requested_compression
+        return dict(self.request, compression=compression)
+
+    def setup(self, c):
+        headers = []
+        if self.etag:
+            headers.append("If-None-Match: %s" % self.etag)
+        self.__setup_output(c, headers)
+        c.setopt(c.URL, self.url.encode('ascii'))
+        c.setopt(c.WRITEFUNCTION, self.buf.write)
+        if self.input_path:
+            self.__setup_input(c, headers)
+        if headers:
+            c.setopt(c.HTTPHEADER, headers)
+        data = self.data
+        if data:
+            c.setopt(c.POST, 1)
+            if type(data).__name__ == 'unicode':
+                data = data.encode('UTF-8')
+            c.setopt(c.POSTFIELDS, data)
+
+    def __setup_output(self, c, headers):
+        if (self.compression or self.etag) and self.output_path:
+            # Opens output_path only once the body arrives, so it is not
+            # truncated if the response is Not Modified.
+            self.buf = DecodingOutput(self.output_path)
+            c.setopt(c.HEADERFUNCTION, self.buf.header)
+            if self.compression:
+                headers.append("Accept-Encoding: %s" % self.compression)
+        elif self.byte_range and self.output_path:
+            offset, length = self.byte_range
+            self.buf = RangeOutput(self.output_path, offset)
+            c.setopt(c.RANGE, "%d-%d" % (offset, offset + length - 1))
+            c.setopt(c.HEADERFUNCTION, self.buf.header)
+        elif self.output_path:
+            # Error bodies are never written, so a retried resumable
+            # download doesn't append to one.
+            self.buf = ResumableOutput(self.output_path)
+            if self.resume_offset:
+                c.setopt(c.RANGE, "%d-" % self.resume_offset)
+            c.setopt(c.HEADERFUNCTION, self.buf.header)
+        else:
+            self.buf = _open_output(self.output_path)
+
+    def __setup_input(self, c, headers):
+        if self.byte_range:
+            offset, filesize = self.byte_range
+            self.input = RangeReader(self.input_path, offset, filesize)
+        elif self.compression:
+            self.prepare()
+            self.input = open(self.compressed_path, 'rb')
+            filesize = getsize(self.compressed_path)
+            headers.append("Content-Encoding: %s" % self.compression)
+            if not self.output_path:
+                c.setopt(c.HEADERFUNCTION, self.__header)
+        else:
+            self.input = open(self.input_path, 'rb')
+            filesize = getsize(self.input_path)
+        c.setopt(c.UPLOAD, 1)
+        c.setopt(c.READFUNCTION, self.input.read)
+        c.setopt(c.INFILESIZE, filesize)
+
+    def check_response(self, c):
+        status_code = c.getinfo(c.RESPONSE_CODE)
+        if self.byte_range and self.output_path and status_code != 206:
+            raise CurlTransferException(self.url, "Expected partial content, got HTTP status code %d" % status_code, status_code=status_code)
+        if isinstance(self.buf, ResumableOutput):
+            self.buf.finish(status_code)
+        if self.resume_offset and status_code == 416:
+            # Requested range starts at or beyond the end of the remote file,
+            # previous attempt already downloaded everything.
+            return
+        if status_code >= 400:
+            raise CurlTransferException(self.url, "HTTP status code %d" % status_code, status_code=status_code)
+        self.not_modified = bool(self.etag) and status_code == 304
+
+    def response(self):
+        if not self.output_path and not self.not_modified:
+            return self.buf.getvalue()
+
+    def __header(self, line):
+        name, _, value = line.decode("iso-8859-1").partition(":")
+        if name.strip().lower() == "accept-encoding":
+            self.accept_encoding = value.strip()
+
+    def close(self):
+        if self.input:
+            self.input.close()
+            self.input = None
+        if self.compressed_path:
+            unlink(self.compressed_path)
+            self.compressed_path = None
+        if self.buf:
+            self.buf.close()
+            self.buf = None
+
+
+class DecodingOutput(object):
+    """ File-like target for a download that may be compressed, the body is
+    decoded according to the response's ``Content-Encoding`` header.
+    ``output_path`` is only written for successful responses, so it is left
+    untouched by ``304 Not Modified`` and error responses.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.encoding = None
+        self.status_code = None
+        self.output = None
+
+    def header(self, line):
+        line = line.decode("iso-8859-1")
+        if line.startswith("HTTP/"):
+            # New response (e.g. after 100 Continue), reset.
+            self.encoding = None
+            self.status_code = int(line.split()[1])
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "content-encoding":
+            self.encoding = content_encoding(value)
+
+    def write(self, data):
+        if self.status_code not in SUCCESS_STATUS_CODES:
+            return
+        if self.output is None:
+            self.output = open(self.output_path, 'wb')
+            if self.encoding:
+                self.output = DecompressingWriter(self.output, self.encoding)
+        self.output.write(data)
+
+    def close(self):
+        if self.output is None:
+            if self.status_code not in SUCCESS_STATUS_CODES:
+                return
+            # Empty body, still create output_path.
+            self.output = open(self.output_path, 'wb')
+        self.output.close()
+        self.output = None
+
+
+class ResumableOutput(object):
+    """ File-like target for a download to ``output_path``, possibly resuming
+    a partial file with a ``Range`` request. Appends if the server responds
+    with partial content, replaces the file if it sends the whole thing, and
+    ignores error bodies. The status code is tracked from the response headers since
+    curl handles cannot be queried while a transfer is in progress.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.output = None
+        self.status_code = None
+        self.opened = False
+
+    def header(self, line):
+        if line.startswith(b"HTTP/"):
+            # Last status line wins (e.g. after 100 Continue).
+            self.status_code = int(line.split()[1])
+
+    def write(self, data):
+        if not self.opened:
+            self.opened = True
+            if self.status_code == 206:
+                self.output = open(self.output_path, 'ab')
+            elif self.status_code == 200:
+                self.output = open(self.output_path, 'wb')
+        if self.output:
+            self.output.write(data)
+
+    def finish(self, status_code):
+        if self.output is None and status_code == 200:
+            # Empty response body for whole file - truncate partial file.
+            open(self.output_path, 'wb').close()
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+
+class RangeOutput(object):
+    """ File-like target writing a ranged download into ``output_path`` at
+    ``offset``. The body is discarded (aborting the transfer) unless the
+    server actually responds with partial content.
+    """
+
+    def __init__(self, output_path, offset):
+        self.output_path = output_path
+        self.offset = offset
+        self.output = None
+        self.status_code = None
+
+    def header(self, line):
+        if line.startswith(b"HTTP/"):
+            self.status_code = int(line.split()[1])
+
+    def write(self, data):
+        if self.output is None:
+            if self.status_code != 206:
+                return 0
+            self.output = open(self.output_path, 'r+b')
+            self.output.seek(self.offset)
+        self.output.write(data)
+
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+
+class CurlTransferException(Exception):
+
+    def __init__(self, url, message, status_code=None):
+        # Don't include query parameters - these may contain private token.
+        self.url = url.split("?")[0]
+        self.message = message
+        self.status_code = status_code
+
+    def __str__(self):
+        return "Failed to transfer %s - %s" % (self.url, self.message)
+
+
+class CurlPool(object):
+    """ Thread-safe pool of reusable curl handles keyed on destination
+    (scheme, host, and port). Reusing a handle lets libcurl reuse its
+    keep-alive connection, and all handles share a DNS and TLS session cache
+    via a ``CurlShare`` object. A handle is only ever used by one thread at a
+    time, at most ``pool_size`` idle handles are kept per destination.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE):
+        self.pool_size = int(pool_size)
+        self.__idle_handles = {}
+        self.__lock = Lock()
+        self.__share = None
+
+    @contextmanager
+    def curl(self, url):
+        c = self.acquire(url)
+        try:
+            yield c
+        except CurlTransferException as e:
+            # Transfers completing with an HTTP error status leave the
+            # connection usable, others (e.g. pycurl errors) may not.
+            self.release(url, c, reuse=e.status_code is not None)
+            raise
+        except BaseException:
+            # Connection state is unknown after a failure, don't reuse it.
+            self.release(url, c, reuse=False)
+            raise
+        else:
+            self.release(url, c)
+
+    def acquire(self, url):
+        return self.__acquire(_destination_key(url))
+
+    def release(self, url, c, reuse=True):
+        if reuse:
+            self.__release(_destination_key(url), c)
+        else:
+            c.close()
+
+    def close(self):
+        with self.__lock:
+            idle_handles = self.__idle_handles
+            self.__idle_handles = {}
+        for handles in idle_handles.values():
+            for c in handles:
+                c.close()
+
+    def idle_count(self, url):
+        with self.__lock:
+            return len(self.__idle_handles.get(_destination_key(url), []))
+
+    def __acquire(self, key):
+        c = None
+        with self.__lock:
+            handles = self.__idle_handles.get(key, None)
+            if handles:
+                c = handles.pop()
+        if c is None:
+            c = _new_curl_object()
+            c.setopt(c.SHARE, self.__get_share())
+        else:
+            # Clears per-request options but keeps the connection cache and
+            # share object.
+            c.reset()
+        if hasattr(c, "TCP_KEEPALIVE"):
+            c.setopt(c.TCP_KEEPALIVE, 1)
+        return c
+
+    def __release(self, key, c):
+        with self.__lock:
+            handles = self.__idle_handles.setdefault(key, deque())
+            if len(handles) < self.pool_size:
+                handles.append(c)
+                c = None
+        if c is not None:
+            c.close()
+
+    def __get_share(self):
+        with self.__lock:
+            if self.__share is None:
+                share = CurlShare()
+                share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+                share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+                self.__share = share
+            return self.__share
+
+
+# Pool used by module level functions (e.g. remote_transfer actions executed
+# on the LWR server).
+_default_curl_pool = CurlPool()
 
 
 def post_file(url, path):
-    c = _new_curl_object()
-    c.setopt(c.URL, url.encode('ascii'))
-    c.setopt(c.HTTPPOST, [("file", (c.FORM_FILE, path.encode('ascii')))])
-    c.perform()
+    with _default_curl_pool.curl(url) as c:
+        c.setopt(c.URL, url.encode('ascii'))
+        c.setopt(c.HTTPPOST, [("file", (c.FORM_FILE, path.encode('ascii')))])
+        c.perform()
 
 
 def get_file(url, path):
     buf = _open_output(path)
     try:
-        c = _new_curl_object()
-        c.setopt(c.URL, url.encode('ascii'))
-        c.setopt(c.WRITEFUNCTION, buf.write)
-        c.perform()
+        with _default_curl_pool.curl(url) as c:
+            c.setopt(c.URL, url.encode('ascii'))
+            c.setopt(c.WRITEFUNCTION, buf.write)
+            c.perform()
     finally:
         buf.close()
 
@@ -60,10 +721,35 @@ def _open_output(output_path):
     return open(output_path, 'wb') if output_path else StringIO()
 
 
+def _resume_offset(output_path):
+    if output_path and exists(output_path):
+        return getsize(output_path)
+    return 0
+
+
+def _destination_key(url):
+    """
+
+    >>> _destination_key("http://localhost:8913/setup?job_id=1")
+    ('http', 'localhost:8913')
+    >>> _destination_key("https://example.com/managers/long/launch")
+    ('https', 'example.com')
+    """
+    parts = urlsplit(url)
+    return (parts.scheme, parts.netloc)
+
+
 def _new_curl_object():
     try:
         return Curl()
     except NameError:
         raise ImportError(PYCURL_UNAVAILABLE_MESSAGE)
 
-___all__ = [PycurlTransport, post_file, get_file]
+
+def _new_curl_multi_object():
+    try:
+        return CurlMulti()
+    except NameError:
+        raise ImportError(PYCURL_UNAVAILABLE_MESSAGE)
+
+___all__ = [PycurlTransport, CurlPool, CurlTransferException, post_file, get_file]
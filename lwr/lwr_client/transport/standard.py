@@ -2,8 +2,17 @@
 LWR HTTP Client layer based on Python Standard Library (urllib2)
 """
 from __future__ import with_statement
+from os.path import exists
 from os.path import getsize
+from os import unlink
 import mmap
+from ..compression import compress_to_temp
+from ..compression import content_encoding
+from ..compression import record_accepted_encodings
+from ..compression import resolve_encoding
+from ..compression import upload_encoding
+from ..compression import DecompressingWriter
+from ..util import RangeReader
 try:
     from urllib2 import urlopen
 except ImportError:
@@ -12,6 +21,10 @@ try:
     from urllib2 import Request
 except ImportError:
     from urllib.request import Request
+try:
+    from urllib2 import HTTPError
+except ImportError:
+    from urllib.error import HTTPError
 
 
 class Urllib2Transport(object):
@@ -19,27 +32,148 @@ class Urllib2Transport(object):
     def _url_open(self, request, data):
         return urlopen(request, data)
 
-    def execute(self, url, data=None, input_path=None, output_path=None):
-        request = Request(url=url, data=data)
+    def execute(self, url, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
+        resume_offset = 0
+        if resume and output_path and exists(output_path):
+            resume_offset = getsize(output_path)
+        requested_compression = compression
+        compression = _transfer_encoding(compression, url, input_path, ranged=bool(resume_offset or byte_range))
+        request = _build_request(url, data, input_path, output_path, resume_offset, byte_range, compression, etag)
         input = None
+        compressed_path = None
+        body = data
+        fallback_compression = False
         try:
+            if input_path and compression:
+                compressed_path = compress_to_temp(input_path, compression)
+                request.add_header("Content-Encoding", compression)
             if input_path:
-                if getsize(input_path):
-                    input = open(input_path, 'rb')
-                    data = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
-                else:
-                    data = b""
-            response = self._url_open(request, data)
+                input, body = _open_upload(compressed_path or input_path, byte_range)
+            response = self._url_open(request, body)
+        except HTTPError as e:
+            if (resume_offset and e.code == 416) or (etag and e.code == 304):
+                # Requested range starts at or beyond the end of the remote
+                # file (previous attempt already downloaded everything) or not
+                # modified, output_path (if any) is left untouched.
+                return None
+            fallback_compression = _fallback_compression(e, url, input_path, compression, requested_compression)
+            if fallback_compression is False:
+                raise
         finally:
-            if input:
-                input.close()
+            _close_upload(input, compressed_path)
+        if fallback_compression is not False:
+            return self.execute(url, data=data, input_path=input_path, output_path=output_path,
+                                resume=resume, byte_range=byte_range, compression=fallback_compression, etag=etag)
         if output_path:
-            with open(output_path, 'wb') as output:
-                while True:
-                    buffer = response.read(1024)
-                    if not buffer:
-                        break
-                    output.write(buffer)
+            _write_response(response, url, output_path, resume_offset, byte_range)
             return response
         else:
             return response.read()
+
+    def execute_many(self, requests, max_in_flight=None):
+        """ Sequential implementation of batch request API, see
+        ``PycurlTransport.execute_many``.
+        """
+        results = []
+        for request in requests:
+            try:
+                result = self.execute(**request)
+            except Exception as e:
+                result = e
+            results.append(result)
+        return results
+
+
+def _transfer_encoding(compression, url, input_path, ranged):
+    # Ranged transfers are never compressed.
+    if ranged:
+        compression = None
+    if input_path:
+        return upload_encoding(compression, url)
+    return resolve_encoding(compression)
+
+
+def _build_request(url, data, input_path, output_path, resume_offset, byte_range, compression, etag):
+    request = Request(url=url, data=data)
+    if compression and output_path:
+        request.add_header("Accept-Encoding", compression)
+    if etag and not (resume_offset or byte_range):
+        request.add_header("If-None-Match", etag)
+    if resume_offset:
+        request.add_header("Range", "bytes=%d-" % resume_offset)
+    if byte_range and output_path:
+        offset, length = byte_range
+        request.add_header("Range", "bytes=%d-%d" % (offset, offset + length - 1))
+    if byte_range and input_path:
+        request.add_header("Content-Length", str(byte_range[1]))
+    return request
+
+
+def _open_upload(upload_path, byte_range):
+    """ Returns the file to close after uploading upload_path (or byte_range
+    of it) and the body to send.
+    """
+    if byte_range:
+        offset, length = byte_range
+        input = RangeReader(upload_path, offset, length)
+        return input, input
+    if not getsize(upload_path):
+        return None, b""
+    input = open(upload_path, 'rb')
+    return input, mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _close_upload(input, compressed_path):
+    if input:
+        input.close()
+    if compressed_path:
+        unlink(compressed_path)
+
+
+def _write_response(response, url, output_path, resume_offset, byte_range):
+    mode = 'wb'
+    if resume_offset and _status_code(response) == 206:
+        mode = 'ab'
+    if byte_range:
+        if _status_code(response) != 206:
+            raise Exception("Failed to fetch byte range of %s, server did not respond with partial content." % url.split("?")[0])
+        mode = 'r+b'
+    output = open(output_path, mode)
+    if byte_range:
+        output.seek(byte_range[0])
+    encoding = _content_encoding(response)
+    if encoding:
+        output = DecompressingWriter(output, encoding)
+    try:
+        while True:
+            buffer = response.read(1024)
+            if not buffer:
+                break
+            output.write(buffer)
+    finally:
+        output.close()
+
+
+def _fallback_compression(error, url, input_path, compression, requested_compression):
+    """ Compression to retry an upload with if the server rejected its
+    compressed body (False if it shouldn't be retried).
+    """
+    if not (input_path and compression) or error.code not in [413, 415]:
+        return False
+    if error.code == 415:
+        record_accepted_encodings(url, error.headers.get("Accept-Encoding", None))
+        if upload_encoding(requested_compression, url) != compression:
+            return requested_compression
+    # Too large once decompressed (or the server is inconsistent), send
+    # uncompressed.
+    return None
+
+
+def _content_encoding(response):
+    info = getattr(response, "info", None)
+    return content_encoding(info().get("Content-Encoding", None) if info else None)
+
+
+def _status_code(response):
+    get_code = getattr(response, "getcode", None)
+    return get_code() if get_code else None
@@ -10,6 +10,8 @@ import shutil
 import json
 import base64
 
+BUFFER_SIZE = 64 * 1024
+
 
 def unique_path_prefix(path):
     m = hashlib.md5()
@@ -65,6 +67,228 @@ def directory_files(directory):
     return contents
 
 
+def file_sha256(path):
+    """ Compute hex SHA-256 digest of file at path. """
+    m = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            buffer = f.read(BUFFER_SIZE)
+            if not buffer:
+                break
+            m.update(buffer)
+    return m.hexdigest()
+
+
+def sampled_sha256(path, samples=8, sample_size=BUFFER_SIZE):
+    """ SHA-256 digest of a file's size and ``samples`` blocks of
+    ``sample_size`` bytes spread evenly through it - cheap to compute for
+    large files, but only detects changes within the sampled blocks (or to
+    the size). Small files are hashed in full.
+    """
+    size = os.path.getsize(path)
+    m = hashlib.sha256()
+    m.update(str(size).encode("ascii"))
+    with open(path, "rb") as f:
+        if size <= samples * sample_size:
+            offsets = [0]
+            sample_size = size
+        else:
+            step = (size - sample_size) // (samples - 1)
+            offsets = [i * step for i in range(samples)]
+        for offset in offsets:
+            f.seek(offset)
+            m.update(f.read(sample_size))
+    return m.hexdigest()
+
+
+def source_validator(path, digest=None, digest_cache=None):
+    """ Describe the file at ``path`` so a copy cached by the LWR can be
+    validated against it. ``digest`` may be ``sampled`` or ``full`` to
+    include a digest of the file's contents in addition to its size and
+    modification time.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> f = NamedTemporaryFile(delete=False)
+    >>> f.write(b"Hello World!")
+    >>> f.close()
+    >>> validator = source_validator(f.name, digest="sampled")
+    >>> sorted(validator.keys()), validator["size"]
+    (['mtime', 'sampled_sha256', 'size'], '12')
+    >>> source_validator(f.name, digest="full")["sha256"] == file_sha256(f.name)
+    True
+    >>> os.remove(f.name)
+    """
+    stat = os.stat(path)
+    validator = dict(size=str(stat.st_size), mtime="%.6f" % stat.st_mtime)
+    if digest == "full":
+        validator["sha256"] = digest_cache.sha256(path) if digest_cache else file_sha256(path)
+    elif digest == "sampled":
+        validator["sampled_sha256"] = sampled_sha256(path)
+    elif digest:
+        raise Exception("Unknown cache digest %s" % digest)
+    return validator
+
+
+def content_etag(sha256):
+    """ Entity tag describing contents by their SHA-256 digest, lets clients
+    validate files they already have without having seen the LWR's ETag.
+    """
+    return "sha256-%s" % sha256
+
+
+def body_etag(body):
+    """ Entity tag for a (small, e.g. JSON) response body.
+
+    >>> body_etag(b'{"status": "complete"}') == body_etag(u'{"status": "complete"}')
+    True
+    """
+    if not isinstance(body, bytes):
+        body = body.encode("utf-8")
+    return "md5-%s" % hashlib.md5(body).hexdigest()
+
+
+def quote_etag(etag):
+    return '"%s"' % etag
+
+
+class HashingReader(object):
+    """ File-like object computing the SHA-256 digest and size of the data
+    read through it from ``input``.
+
+    >>> from io import BytesIO
+    >>> reader = HashingReader(BytesIO(b"Hello World!"))
+    >>> reader.read(5) == b"Hello"
+    True
+    >>> reader.read() == b" World!"
+    True
+    >>> reader.size
+    12
+    >>> reader.hexdigest() == hashlib.sha256(b"Hello World!").hexdigest()
+    True
+    """
+
+    def __init__(self, input):
+        self.input = input
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.input.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        close = getattr(self.input, "close", None)
+        if close:
+            close()
+
+
+class DigestCache(object):
+    """ Thread-safe cache of file SHA-256 digests keyed on path, recomputed
+    only if the file's size or modification time changes.
+    """
+
+    def __init__(self):
+        self.digests = {}
+        self.lock = Lock()
+
+    def sha256(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            cached = self.digests.get(path, None)
+        if cached and cached[0] == key:
+            return cached[1]
+        digest = file_sha256(path)
+        with self.lock:
+            self.digests[path] = (key, digest)
+        return digest
+
+
+class FileRecord(object):
+    """ Thread-safe set of file paths, each forgotten once the file's size or
+    modification time changes.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = Lock()
+
+    def add(self, path):
+        path = os.path.abspath(path)
+        key = _stat_key(path)
+        with self.lock:
+            self.stats[path] = key
+
+    def __contains__(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            key = self.stats.get(path, None)
+        return key is not None and os.path.exists(path) and key == _stat_key(path)
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime)
+
+
+def byte_ranges(size, count):
+    """ Split ``size`` bytes into (at most) ``count`` contiguous
+    (offset, length) ranges.
+
+    >>> byte_ranges(10, 3)
+    [(0, 4), (4, 4), (8, 2)]
+    >>> byte_ranges(2, 4)
+    [(0, 1), (1, 1)]
+    >>> byte_ranges(0, 4)
+    []
+    """
+    count = max(1, int(count))
+    chunk_size = (size + count - 1) // count
+    return [(offset, min(chunk_size, size - offset))
+            for offset in range(0, size, chunk_size or 1)]
+
+
+class RangeReader(object):
+    """ Read-only file-like view of ``length`` bytes of the file at ``path``
+    starting at ``offset``.
+
+    >>> from tempfile import NamedTemporaryFile
+    >>> f = NamedTemporaryFile(delete=False)
+    >>> f.write(b"Hello World!")
+    >>> f.close()
+    >>> reader = RangeReader(f.name, 6, 5)
+    >>> reader.read(3)
+    'Wor'
+    >>> reader.read()
+    'ld'
+    >>> reader.read()
+    ''
+    >>> reader.close()
+    >>> os.remove(f.name)
+    """
+
+    def __init__(self, path, offset, length):
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
 def filter_destination_params(destination_params, prefix):
     destination_params = destination_params or {}
     return dict([(key[len(prefix):], destination_params[key])
@@ -144,7 +368,115 @@ class PathHelper(object):
         return self.remote_join(new_base, *path_parts)
 
 
+class Future(object):
+    """ Minimal thread-safe future, ``concurrent.futures`` is not available
+    in the Python 2 standard library.
+
+    >>> f = chain(completed_future(lambda x: x + 1, 1), lambda x: x * 2)
+    >>> f.done()
+    True
+    >>> f.result()
+    4
+    >>> f = completed_future(int, "moo")
+    >>> isinstance(f.exception(), ValueError)
+    True
+    """
+
+    def __init__(self):
+        self._event = Event()
+        self._lock = Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        self.__wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self.__wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, result):
+        self._result = result
+        self.__complete()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self.__complete()
+
+    def __wait(self, timeout):
+        if not self._event.wait(timeout) and not self.done():
+            raise Exception("Timed out waiting for result.")
+
+    def __complete(self):
+        with self._lock:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+
+def completed_future(func, *args, **kwds):
+    """ Call func immediately, returning a completed Future with its result
+    (or the exception it raised).
+    """
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwds))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def chain(future, func):
+    """ Return a Future for the result of applying func to the result of
+    future.
+    """
+    chained = Future()
+
+    def on_done(completed):
+        exception = completed.exception()
+        if exception is not None:
+            chained.set_exception(exception)
+        else:
+            try:
+                chained.set_result(func(completed.result()))
+            except Exception as e:
+                chained.set_exception(e)
+
+    future.add_done_callback(on_done)
+    return chained
+
+
 class TransferEventManager(object):
+    """ Track transfers of files (by path), so threads can be notified when
+    the latest transfer of a path completes or fails.
+
+    >>> manager = TransferEventManager()
+    >>> manager.current_event("/data/1.dat") is None
+    True
+    >>> event_holder = manager.start_transfer("/data/1.dat")
+    >>> manager.current_event("/data/1.dat") is event_holder, event_holder.pending
+    (True, True)
+    >>> event_holder.fail()
+    >>> event_holder.release()
+    >>> event_holder.pending, event_holder.failed
+    (False, True)
+    """
 
     def __init__(self):
         self.events = WeakValueDictionary(dict())
@@ -161,6 +493,22 @@ class TransferEventManager(object):
             event_holder.event.clear()
         return event_holder
 
+    def start_transfer(self, path):
+        """ Register a new transfer of ``path``, returns the ``EventHolder``
+        to release once it completes. Holders are only tracked while
+        referenced (e.g. by the queued transfer).
+        """
+        event_holder = EventHolder(Event(), path, self)
+        with self.events_lock:
+            self.events[path] = event_holder
+        return event_holder
+
+    def current_event(self, path):
+        """ Holder for the latest transfer of ``path``, None if unknown.
+        """
+        with self.events_lock:
+            return self.events.get(path, None)
+
 
 class EventHolder(object):
 
@@ -170,6 +518,10 @@ class EventHolder(object):
         self.condition_manager = condition_manager
         self.failed = False
 
+    @property
+    def pending(self):
+        return not self.event.is_set()
+
     def release(self):
         self.event.set()
 
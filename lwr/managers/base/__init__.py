@@ -83,6 +83,7 @@ class BaseManager(ManagerInterface):
         self.persistence_directory = getattr(app, 'persistence_directory', None)
         self.lock_manager = locks.LockManager()
         self._setup_staging_directory(app.staging_directory)
+        self.staging_directory_layout = getattr(app, 'staging_directory_layout', None)
         self.id_assigner = get_id_assigner(kwds.get("assign_ids", None))
         self.__init_galaxy_system_properties(kwds)
         self.debug = str(kwds.get("debug", False)).lower() == "true"
@@ -153,7 +154,7 @@ class BaseManager(ManagerInterface):
         self.staging_directory = staging_directory
 
     def _job_directory(self, job_id):
-        return JobDirectory(self.staging_directory, job_id, self.lock_manager)
+        return JobDirectory(self.staging_directory, job_id, self.lock_manager, layout=self.staging_directory_layout)
 
     job_directory = _job_directory
 
@@ -202,12 +203,19 @@ class BaseManager(ManagerInterface):
 
 
 class JobDirectory(RemoteJobDirectory):
+    """ Job directory in the given ``layout`` (see
+    ``lwr.lwr_client.job_directory.job_directory_parts``). Jobs set up
+    before switching layout keep their existing (flat) directory.
+    """
 
-    def __init__(self, staging_directory, job_id, lock_manager=None):
-        super(JobDirectory, self).__init__(staging_directory, remote_id=job_id, remote_sep=sep)
+    def __init__(self, staging_directory, job_id, lock_manager=None, layout=None):
+        super(JobDirectory, self).__init__(staging_directory, remote_id=job_id, remote_sep=sep, layout=layout)
         self.lock_manager = lock_manager
         # Assert this job id isn't hacking path somehow.
         assert job_id == basename(job_id)
+        flat_job_directory = join(staging_directory, job_id)
+        if self.job_directory != flat_job_directory and not exists(self.job_directory) and exists(flat_job_directory):
+            self.job_directory = flat_job_directory
 
     def _job_file(self, name):
         return os.path.join(self.job_directory, name)
@@ -268,6 +276,14 @@ class JobDirectory(RemoteJobDirectory):
         return rmtree(self.path)
 
     def setup(self):
+        parent = os.path.dirname(self.job_directory)
+        if not exists(parent):
+            try:
+                makedirs(parent)
+            except OSError:
+                # Created concurrently.
+                if not isdir(parent):
+                    raise
         os.mkdir(self.job_directory)
 
     def make_directory(self, name):
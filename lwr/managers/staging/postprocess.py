@@ -56,6 +56,10 @@ class LwrServerOutputCollector(object):
         lwr_path = self.job_directory.calculate_path(name, output_type)
         action.write_from_path(lwr_path)
 
+    def flush(self, exception_tracker):
+        # Outputs are written out as they are collected.
+        pass
+
 
 def __lwr_outputs(job_directory):
     working_directory_contents = job_directory.working_directory_contents()
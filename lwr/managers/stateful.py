@@ -5,6 +5,9 @@ import threading
 
 from lwr.managers import ManagerProxy
 from lwr.managers import status
+from lwr.metrics import STAGING_DURATION
+from lwr.metrics import STAGING_FAILURES
+from lwr.metrics import STAGING_THREADS
 from .staging import preprocess
 from .staging import postprocess
 
@@ -33,13 +36,28 @@ class StatefulManagerProxy(ManagerProxy):
         min_polling_interval = manager_options.get("min_polling_interval", DEFAULT_MIN_POLLING_INTERVAL)
         self.min_polling_interval = datetime.timedelta(0, min_polling_interval)
         self.active_jobs = ActiveJobs(manager)
-        self.__state_change_callback = lambda status, job_id: None
-        self.__recover_active_jobs()
+        self.__state_change_callbacks = []
         self.__monitor = None
+        self.__recover_active_jobs()
 
     def set_state_change_callback(self, state_change_callback):
-        self.__state_change_callback = state_change_callback
-        self.__monitor = ManagerMonitor(self)
+        self.__state_change_callbacks = []
+        self.add_state_change_callback(state_change_callback)
+
+    def add_state_change_callback(self, state_change_callback):
+        """ Register callable to be passed (new_status, job_id) as jobs change
+        state - active jobs are monitored once any callback is registered.
+        """
+        self.__state_change_callbacks.append(state_change_callback)
+        if self.__monitor is None:
+            self.__monitor = ManagerMonitor(self)
+
+    def __state_change_callback(self, new_status, job_id):
+        for state_change_callback in self.__state_change_callbacks:
+            try:
+                state_change_callback(new_status, job_id)
+            except Exception:
+                log.exception("Failed to handle state change to %s for job %s" % (new_status, job_id))
 
     @property
     def name(self):
@@ -66,9 +84,10 @@ class StatefulManagerProxy(ManagerProxy):
                 self.active_jobs.activate_job(job_id)
             except Exception:
                 log.exception("Failed job preprocess for %s:", job_id)
+                STAGING_FAILURES.inc(manager=self.name, stage="preprocess")
                 self.__state_change_callback(status.FAILED, job_id)
 
-        new_thread_for_manager(self, "preprocess", do_preprocess, daemon=False)
+        new_thread_for_manager(self, "preprocess", self.__instrumented(do_preprocess, "preprocess"), daemon=False)
 
     def get_status(self, job_id):
         """ Compute status used proxied manager and handle state transitions
@@ -129,6 +148,8 @@ class StatefulManagerProxy(ManagerProxy):
                 log.exception("Failed to deactivate via proxied manager job %s" % job_id)
         if proxy_status == status.COMPLETE:
             self.__handle_postprocessing(job_id)
+        elif proxy_status == status.CANCELLED:
+            self.__state_change_callback(status.CANCELLED, job_id)
 
     def __handle_postprocessing(self, job_id):
         def do_postprocess():
@@ -137,9 +158,21 @@ class StatefulManagerProxy(ManagerProxy):
                 postprocess_success = postprocess(self._proxied_manager.job_directory(job_id))
             except Exception:
                 log.exception("Failed to postprocess results for job id %s" % job_id)
+            if not postprocess_success:
+                STAGING_FAILURES.inc(manager=self.name, stage="postprocess")
             final_status = status.COMPLETE if postprocess_success else status.FAILED
             self.__state_change_callback(final_status, job_id)
-        new_thread_for_manager(self, "postprocess", do_postprocess, daemon=False)
+        new_thread_for_manager(self, "postprocess", self.__instrumented(do_postprocess, "postprocess"), daemon=False)
+
+    def __instrumented(self, target, stage):
+        def instrumented_target():
+            STAGING_THREADS.inc(manager=self.name, stage=stage)
+            try:
+                with STAGING_DURATION.time(manager=self.name, stage=stage):
+                    target()
+            finally:
+                STAGING_THREADS.dec(manager=self.name, stage=stage)
+        return instrumented_target
 
     def shutdown(self):
         if self.__monitor:
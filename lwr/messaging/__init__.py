@@ -11,9 +11,18 @@ submodules of ``lwr.lwr_client``.
     :undoc-members:
     :show-inheritance:
 
+:mod:`lwr.messaging.status_feed` Module
+---------------------------------------
+
+.. automodule:: lwr.messaging.status_feed
+    :members:
+    :undoc-members:
+    :show-inheritance:
+
 """
 
 from ..messaging import bind_amqp
+from ..messaging import status_feed
 from six import itervalues
 
 
@@ -25,6 +34,15 @@ def bind_app(app, queue_id, connect_ssl=None):
     return queue_state
 
 
+def bind_app_to_status_feeds(app, max_updates=status_feed.DEFAULT_MAX_UPDATES):
+    feeds = {}
+    for name, manager in app.managers.items():
+        feed = status_feed.StatusFeed(max_updates=max_updates)
+        status_feed.bind_manager_to_feed(manager, feed)
+        feeds[name] = feed
+    return feeds
+
+
 class QueueState(object):
     """ Passed through to event loops, should be "non-zero" while queues should
     be active.
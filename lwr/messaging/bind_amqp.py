@@ -1,6 +1,8 @@
 from galaxy.util import asbool
 from lwr.lwr_client import amqp_exchange_factory
 from lwr import manager_endpoint_util
+from lwr.metrics import MESSAGES_CONSUMED
+from lwr.metrics import MESSAGES_PUBLISHED
 import functools
 import threading
 import logging
@@ -41,7 +43,7 @@ def bind_manager_to_queue(manager, queue_state, connection_string, conf):
     process_kill_messages = functools.partial(__process_kill_message, manager)
 
     def drain(callback, name):
-        __drain(name, queue_state, lwr_exchange, callback)
+        __drain(name, queue_state, lwr_exchange, __counted(callback, manager.name, name))
         log.info("Finished consuming %s queue - no more messages will be processed." % (name))
 
     if conf.get("message_queue_consume", True):
@@ -56,12 +58,13 @@ def bind_manager_to_queue(manager, queue_state, connection_string, conf):
             log.debug(message)
             payload = manager_endpoint_util.full_status(manager, new_status, job_id)
             lwr_exchange.publish("status_update", payload)
+            MESSAGES_PUBLISHED.inc(manager=manager.name, queue="status_update")
         except:
             log.exception("Failure to publish LWR state change.")
             raise
 
     if conf.get("message_queue_publish", True):
-        manager.set_state_change_callback(bind_on_status_change)
+        manager.add_state_change_callback(bind_on_status_change)
 
 
 def __start_consumer(name, exchange, target):
@@ -75,6 +78,13 @@ start_setup_consumer = functools.partial(__start_consumer, "setup")
 start_kill_consumer = functools.partial(__start_consumer, "kill")
 
 
+def __counted(callback, manager_name, queue_name):
+    def counted_callback(body, message):
+        MESSAGES_CONSUMED.inc(manager=manager_name, queue=queue_name)
+        return callback(body, message)
+    return counted_callback
+
+
 def __drain(name, queue_state, lwr_exchange, callback):
     lwr_exchange.consume(name, callback=callback, check=queue_state)
 
@@ -0,0 +1,104 @@
+""" In-process feed of job state changes served to HTTP clients by the
+``status_updates`` route - an alternative to polling ``check_complete`` for
+clients that do not use a message queue.
+
+Clients long-poll the feed. Each response carries a ``since`` token and the
+next request supplies that token and blocks until newer updates are
+published (or the timeout expires).
+"""
+from collections import deque
+import threading
+import time
+import uuid
+
+from lwr import manager_endpoint_util
+
+import logging
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_UPDATES = 1000
+DEFAULT_TIMEOUT = 30
+MAX_TIMEOUT = 120
+
+
+class StatusFeed(object):
+    """ Retains the most recent ``max_updates`` state changes of a manager.
+
+    >>> feed = StatusFeed(max_updates=2)
+    >>> start = feed.updates(timeout=0)
+    >>> start["updates"]
+    []
+    >>> feed.publish({"job_id": "1", "status": "running"})
+    >>> response = feed.updates(start["since"], timeout=0)
+    >>> [update["job_id"] for update in response["updates"]], response["missed"]
+    (['1'], False)
+    >>> feed.updates(response["since"], timeout=0)["updates"]
+    []
+    >>> for job_id in ["2", "3", "4"]:
+    ...     feed.publish({"job_id": job_id, "status": "running"})
+    >>> response = feed.updates(response["since"], timeout=0)
+    >>> [update["job_id"] for update in response["updates"]], response["missed"]
+    (['3', '4'], True)
+    >>> feed.updates("unknown-1", timeout=0)["missed"]
+    True
+    """
+
+    def __init__(self, max_updates=DEFAULT_MAX_UPDATES):
+        # Tokens embed this so tokens from before a restart are recognized.
+        self.instance_id = uuid.uuid4().hex
+        self.updates_deque = deque(maxlen=max_updates)
+        self.last_sequence = 0
+        self.condition = threading.Condition()
+
+    def publish(self, payload):
+        with self.condition:
+            self.last_sequence += 1
+            self.updates_deque.append((self.last_sequence, payload))
+            self.condition.notify_all()
+
+    def updates(self, since=None, timeout=DEFAULT_TIMEOUT):
+        """ Return updates published after ``since`` (a token from a previous
+        response), waiting up to ``timeout`` seconds for one if there are
+        none. If ``since`` is None no updates are returned, just a token to
+        start following the feed from.
+
+        ``missed`` is set in the response if updates after ``since`` are no
+        longer retained (or the token is from an earlier LWR process) - the
+        client should then check the status of its jobs directly.
+        """
+        timeout = min(max(float(timeout), 0), MAX_TIMEOUT)
+        with self.condition:
+            if since is None:
+                return self.__response([], False)
+            sequence = self.__parse_token(since)
+            missed = sequence is None
+            if missed:
+                sequence = 0
+            deadline = time.time() + timeout
+            while self.last_sequence <= sequence:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            updates = [payload for update_sequence, payload in self.updates_deque if update_sequence > sequence]
+            if self.updates_deque and self.updates_deque[0][0] > sequence + 1:
+                missed = True
+            return self.__response(updates, missed)
+
+    def __response(self, updates, missed):
+        since = "%s-%d" % (self.instance_id, self.last_sequence)
+        return dict(since=since, updates=updates, missed=missed)
+
+    def __parse_token(self, since):
+        instance_id, _, sequence = str(since).rpartition("-")
+        if instance_id != self.instance_id or not sequence.isdigit():
+            return None
+        return min(int(sequence), self.last_sequence)
+
+
+def bind_manager_to_feed(manager, feed):
+    def publish_status_change(new_status, job_id):
+        payload = manager_endpoint_util.full_status(manager, new_status, job_id)
+        feed.publish(payload)
+
+    manager.add_state_change_callback(publish_status_change)
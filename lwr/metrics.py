@@ -0,0 +1,257 @@
+"""
+Lightweight instrumentation of the LWR server - exported in the Prometheus
+text exposition format by the ``metrics`` route.
+
+Updating a metric just takes a (short, per metric) lock so instrumentation
+can be left enabled on hot paths.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def _items(self):
+        with self.lock:
+            return sorted((key, _copy(value)) for key, value in self.values.items())
+
+    def expose(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.description),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        lines.extend(self._sample_lines())
+        return "\n".join(lines)
+
+    def _sample_lines(self):
+        for key, value in self._items():
+            yield "%s%s %s" % (self.name, self._labels(key), _format(value))
+
+
+class Counter(Metric):
+    """
+
+    >>> counter = Counter("lwr_test_total", "Test counter.", labels=("route",))
+    >>> counter.inc(route="setup")
+    >>> counter.inc(2, route="setup")
+    >>> print(counter.expose())
+    # HELP lwr_test_total Test counter.
+    # TYPE lwr_test_total counter
+    lwr_test_total{route="setup"} 3
+    """
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+
+    >>> histogram = Histogram("lwr_test_seconds", "Test histogram.", buckets=(1, 5))
+    >>> histogram.observe(0.5)
+    >>> histogram.observe(3)
+    >>> print(histogram.expose())
+    # HELP lwr_test_seconds Test histogram.
+    # TYPE lwr_test_seconds histogram
+    lwr_test_seconds_bucket{le="1"} 1
+    lwr_test_seconds_bucket{le="5"} 2
+    lwr_test_seconds_bucket{le="+Inf"} 2
+    lwr_test_seconds_sum 3.5
+    lwr_test_seconds_count 2
+    """
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels=labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key, None)
+            if counts is None:
+                # Per bucket (non-cumulative) counts, then sum and count.
+                counts = self.values[key] = [0] * len(self.buckets) + [0, 0]
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def _sample_lines(self):
+        for key, counts in self._items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                yield "%s_bucket%s %d" % (self.name, self._labels(key, [("le", _format(bucket))]), cumulative)
+            yield "%s_bucket%s %d" % (self.name, self._labels(key, [("le", "+Inf")]), counts[-1])
+            yield "%s_sum%s %s" % (self.name, self._labels(key), _format(counts[-2]))
+            yield "%s_count%s %d" % (self.name, self._labels(key), counts[-1])
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels=labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels=labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels=labels, buckets=buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self, extra_metrics=[]):
+        """ Render all metrics (followed by ``extra_metrics``) in the
+        Prometheus text exposition format.
+        """
+        return "\n".join(metric.expose() for metric in self.metrics + list(extra_metrics)) + "\n"
+
+
+def manager_metrics(managers):
+    """ Build gauges describing current state of supplied job managers (a
+    dictionary keyed on manager name), computed each time metrics are
+    exposed.
+    """
+    active_jobs = Gauge("lwr_active_jobs", "Jobs not yet complete.", labels=("manager",))
+    queued_jobs = Gauge("lwr_queued_jobs", "Jobs waiting in a queued_python manager's work queue.", labels=("manager",))
+    for name, manager in managers.items():
+        manager_active_jobs = getattr(manager, "active_jobs", None)
+        if manager_active_jobs is not None:
+            active_jobs.set(len(manager_active_jobs.active_job_ids()), manager=name)
+        work_queue = getattr(getattr(manager, "_proxied_manager", manager), "work_queue", None)
+        if work_queue is not None:
+            queued_jobs.set(work_queue.qsize(), manager=name)
+    return [active_jobs, queued_jobs]
+
+
+def _copy(value):
+    return list(value) if isinstance(value, list) else value
+
+
+def _format(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "lwr_request_duration_seconds",
+    "Time spent handling web requests (excluding streaming file responses).",
+    labels=("route",),
+)
+UPLOADED_BYTES = REGISTRY.counter(
+    "lwr_uploaded_bytes_total",
+    "Bytes received in request bodies.",
+    labels=("route",),
+)
+DOWNLOADED_BYTES = REGISTRY.counter(
+    "lwr_downloaded_bytes_total",
+    "Bytes of files served (before any compression).",
+    labels=("route",),
+)
+STAGING_THREADS = REGISTRY.gauge(
+    "lwr_staging_threads",
+    "Job preprocessing and postprocessing threads currently running.",
+    labels=("manager", "stage"),
+)
+STAGING_DURATION = REGISTRY.histogram(
+    "lwr_staging_duration_seconds",
+    "Time spent preprocessing and postprocessing jobs.",
+    labels=("manager", "stage"),
+)
+STAGING_FAILURES = REGISTRY.counter(
+    "lwr_staging_failures_total",
+    "Jobs that failed preprocessing or postprocessing.",
+    labels=("manager", "stage"),
+)
+MESSAGES_PUBLISHED = REGISTRY.counter(
+    "lwr_amqp_messages_published_total",
+    "Messages published to the message queue.",
+    labels=("manager", "queue"),
+)
+MESSAGES_CONSUMED = REGISTRY.counter(
+    "lwr_amqp_messages_consumed_total",
+    "Messages consumed from the message queue.",
+    labels=("manager", "queue"),
+)
+FILE_CACHE_HITS = REGISTRY.counter(
+    "lwr_file_cache_hits_total",
+    "Files a client did not need to upload as they were already cached.",
+)
+FILE_CACHE_MISSES = REGISTRY.counter(
+    "lwr_file_cache_misses_total",
+    "Files a client was asked to upload into the cache.",
+)
+FILE_CACHE_STALE = REGISTRY.counter(
+    "lwr_file_cache_stale_total",
+    "Cached files found to no longer match their source, to be uploaded again.",
+)
+FILE_CACHE_EVICTIONS = REGISTRY.counter(
+    "lwr_file_cache_evictions_total",
+    "Least recently used files evicted to keep the cache within its size budget.",
+)
+FILE_CACHE_EVICTED_BYTES = REGISTRY.counter(
+    "lwr_file_cache_evicted_bytes_total",
+    "Bytes of files evicted from the cache.",
+)
+FILE_CACHE_BYTES = REGISTRY.gauge(
+    "lwr_file_cache_bytes",
+    "Bytes of files currently cached.",
+)
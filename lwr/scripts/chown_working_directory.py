@@ -1,10 +1,11 @@
 from os import system
-from os.path import join, abspath
+from os.path import abspath
 try:
     from ConfigParser import ConfigParser
 except ImportError:
     from configparser import ConfigParser
 from lwr.daemon import ArgumentParser
+from lwr.managers.base import JobDirectory
 
 DESCRIPTION = "Change ownership of a job working directory."
 # Switch this to true to tighten up security somewhat in production mode,
@@ -26,7 +27,10 @@ def main():
         config = ConfigParser()
         config.read(['server.ini'])
         staging_directory = abspath(config.get('app:main', 'staging_directory'))
-        job_directory = abspath(join(staging_directory, job_id))
+        layout = None
+        if config.has_option('app:main', 'staging_directory_layout'):
+            layout = config.get('app:main', 'staging_directory_layout')
+        job_directory = abspath(JobDirectory(staging_directory, job_id, layout=layout).path)
         assert job_directory.startswith(staging_directory)
     elif FORCE_PRODUCTION:
         raise Exception("In production mode, must specify a job_id instead of a working directory.")
@@ -7,36 +7,137 @@ from webob import Response
 from webob import exc
 
 import inspect
+import os
 from os.path import exists
 import re
+import time
 
 from json import dumps
 from six import Iterator
 
+from lwr.lwr_client.compression import available_encodings
+from lwr.lwr_client.compression import best_encoding
+from lwr.lwr_client.compression import compressor
+from lwr.lwr_client.compression import content_encoding
+from lwr.lwr_client.compression import DecompressingReader
+from lwr.lwr_client.compression import DecompressionLimitExceeded
+from lwr.lwr_client.util import body_etag
+from lwr.lwr_client.util import content_etag
+from lwr.lwr_client.util import DigestCache
+
+# Size of blocks files are served in (if the server doesn't provide
+# wsgi.file_wrapper), can be overridden by the application's file_chunk_size.
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+# Compressed request bodies may decode to at most this many times their size
+# (can be overridden by the application's max_upload_compression_ratio), just
+# above the most deflate can achieve.
+DEFAULT_MAX_COMPRESSION_RATIO = 1100
+# Python 2's re module supports at most 100 groups per pattern.
+MAX_ROUTE_GROUPS = 99
+
+# Digests of served files, computed for clients validating them by content.
+_digest_cache = DigestCache()
+
 
 class RoutingApp(object):
     """
     Abstract definition for a python web application.
+
+    Routes without variables are dispatched with a dictionary lookup, the
+    remaining routes are compiled into a single regular expression (first
+    matching route wins, as they were added).
+
+    >>> app = RoutingApp()
+    >>> app.add_route('/status', 'status_controller')
+    >>> app.add_route('/managers/{manager_name}/status', 'status_controller', job_id='1')
+    >>> app.add_route('/managers/{manager_name}/kill', 'kill_controller')
+    >>> app.find_route('/status')
+    ('status_controller', {})
+    >>> controller, args = app.find_route('/managers/default/status')
+    >>> controller, sorted(args.items())
+    ('status_controller', [('job_id', '1'), ('manager_name', 'default')])
+    >>> app.find_route('/managers/default/kill')
+    ('kill_controller', {'manager_name': 'default'})
+    >>> app.find_route('/kill') is None
+    True
     """
     def __init__(self):
         self.routes = []
+        self.exact_routes = {}
+        self.__routes_regexes = None
 
     def add_route(self, route, controller, **args):
         route_regex = self.__template_to_regex(route)
-        self.routes.append((route_regex, controller, args))
+        literal = route_regex.pattern == '^%s$' % re.escape(route)
+        # Earlier routes take precedence, so a literal route can only be
+        # looked up directly if no earlier pattern matches it.
+        shadowed = any(regex.match(route) for (regex, _, _) in self.routes)
+        if literal and not shadowed:
+            if route not in self.exact_routes:
+                self.exact_routes[route] = (controller, args)
+        else:
+            self.routes.append((route_regex, controller, args))
+            self.__routes_regexes = None
+
+    def find_route(self, path):
+        """ Return (controller, args) tuple for the route matching path, None
+        if no route matches.
+        """
+        exact_route = self.exact_routes.get(path, None)
+        if exact_route:
+            controller, args = exact_route
+            return controller, dict(args)
+        return self.__find_pattern_route(path)
 
     def __call__(self, environ, start_response):
         req = Request(environ)
         req.app = self
-        for route, controller, args in self.routes:
-            match = route.match(req.path_info)
-            if match:
-                request_args = dict(args)
-                route_args = match.groupdict()
-                request_args.update(route_args)
-                return controller(environ, start_response, **request_args)
+        route = self.find_route(req.path_info)
+        if route:
+            controller, request_args = route
+            return controller(environ, start_response, **request_args)
         return exc.HTTPNotFound()(environ, start_response)
 
+    def __find_pattern_route(self, path):
+        if self.__routes_regexes is None:
+            self.__routes_regexes = self.__compile_routes()
+        for routes_regex in self.__routes_regexes:
+            match = routes_regex.match(path)
+            if match:
+                break
+        else:
+            return None
+        index = int(match.lastgroup[len("_route"):])
+        _, controller, args = self.routes[index]
+        request_args = dict(args)
+        prefix = "_%d_" % index
+        for name, value in match.groupdict().items():
+            if name.startswith(prefix):
+                request_args[name[len(prefix):]] = value
+        return controller, request_args
+
+    def __compile_routes(self):
+        # Combine route patterns into alternations, group names are prefixed
+        # with the route index to keep them unique. Each route is wrapped in
+        # its own named group - the last group to close (i.e. lastgroup)
+        # identifies the matched route. Python limits the number of groups in
+        # a pattern so several patterns may be needed.
+        regexes = []
+        alternatives = []
+        groups = 0
+        for index, (route_regex, _, _) in enumerate(self.routes):
+            if alternatives and groups + route_regex.groups + 1 > MAX_ROUTE_GROUPS:
+                regexes.append(_alternation(alternatives))
+                alternatives = []
+                groups = 0
+            pattern = route_regex.pattern[1:-1]  # Strip ^ and $
+            pattern = re.sub(r'\(\?P<(\w+)>', r'(?P<_%d_\1>' % index, pattern)
+            alternatives.append('(?P<_route%d>%s)' % (index, pattern))
+            groups += route_regex.groups + 1
+        if alternatives:
+            regexes.append(_alternation(alternatives))
+        return regexes
+
     def __template_to_regex(self, template):
         var_regex = re.compile(r'''
             \{          # The exact character "{"
@@ -58,6 +159,23 @@ class RoutingApp(object):
         return re.compile(regex)
 
 
+def _alternation(patterns):
+    return re.compile('^(?:%s)$' % '|'.join(patterns))
+
+
+_func_args_cache = {}
+
+
+def func_args(func):
+    """ Names of the arguments of ``func`` (cached, introspection is slow).
+    """
+    try:
+        return _func_args_cache[func]
+    except KeyError:
+        args = _func_args_cache[func] = inspect.getargspec(func).args
+        return args
+
+
 def build_func_args(func, *arg_dicts):
     args = {}
 
@@ -66,20 +184,26 @@ def build_func_args(func, *arg_dicts):
             if func_arg not in args and func_arg in arg_values:
                 args[func_arg] = arg_values[func_arg]
 
-    func_args = inspect.getargspec(func).args
     for arg_dict in arg_dicts:
-        add_args(func_args, arg_dict)
+        add_args(func_args(func), arg_dict)
 
     return args
 
 
 class Controller(object):
     """
-    Wraps python functions into controller methods.
+    Wraps python functions into controller methods. If ``conditional`` is
+    set, JSON responses carry an ``ETag`` describing their body and requests
+    with a matching ``If-None-Match`` header are answered with
+    ``304 Not Modified``. If ``pass_app_args`` is set, the function's
+    ``app_args`` argument receives the application arguments (see
+    ``_app_args``) so it may dispatch to other controllers.
     """
 
-    def __init__(self, response_type='OK'):
+    def __init__(self, response_type='OK', conditional=False, pass_app_args=False):
         self.response_type = response_type
+        self.conditional = conditional
+        self.pass_app_args = pass_app_args
 
     def __get_client_address(self, environ):
         """
@@ -102,34 +226,88 @@ class Controller(object):
         return access_response
 
     def __build_args(self, func, args, req, environ):
-        args = build_func_args(func, args, req.GET, self._app_args(args, req))
-        func_args = inspect.getargspec(func).args
+        app_args = self._app_args(args, req)
+        args = build_func_args(func, args, req.GET, app_args)
 
-        for func_arg in func_args:
-            if func_arg == "ip":
-                args["ip"] = self.__get_client_address(environ)
+        if self.pass_app_args:
+            args["app_args"] = app_args
+
+        if self.needs_ip:
+            args["ip"] = self.__get_client_address(environ)
+
+        if self.needs_body:
+            args['body'] = self.__request_body(req)
 
-        if 'body' in func_args:
-            args['body'] = req.body_file
+        if self.needs_content_length:
+            args['content_length'] = self.__request_content_length(req)
 
         return args
 
+    def __request_body(self, req):
+        encoding = content_encoding(req.headers.get("Content-Encoding", None))
+        if encoding is None:
+            return req.body_file
+        if encoding not in available_encodings():
+            # Advertise supported encodings, so the client can fall back.
+            raise exc.HTTPUnsupportedMediaType(
+                "Unsupported Content-Encoding %s" % encoding,
+                headers=[("Accept-Encoding", ", ".join(available_encodings()))],
+            )
+        max_ratio = getattr(req.app, "max_upload_compression_ratio", None) or DEFAULT_MAX_COMPRESSION_RATIO
+        return DecompressingReader(req.body_file, encoding, max_ratio=max_ratio)
+
+    def __request_content_length(self, req):
+        # Size of the (decoded) body, if known.
+        if content_encoding(req.headers.get("Content-Encoding", None)) is not None:
+            return None
+        return req.content_length
+
+    def __response_encoding(self, req):
+        # Compressed responses cannot be served as byte ranges.
+        if "Range" in req.headers:
+            return None
+        return best_encoding(req.headers.get("Accept-Encoding", None))
+
     def __execute_request(self, func, args, req, environ):
-        args = self.__build_args(func, args, req, environ)
         try:
+            args = self.__build_args(func, args, req, environ)
             result = func(**args)
         except exc.HTTPException as e:
             result = e
+        except DecompressionLimitExceeded as e:
+            result = exc.HTTPRequestEntityTooLarge(str(e))
         return result
 
-    def __build_response(self, result):
-        if self.response_type == 'file':
-            resp = file_response(result)
+    def __build_response(self, result, req):
+        if isinstance(result, exc.HTTPException):
+            resp = result
+        elif self.response_type == 'text':
+            resp = Response(body=self.body(result), content_type='text/plain')
+        elif self.response_type == 'file':
+            chunk_size = getattr(req.app, "file_chunk_size", None) or DEFAULT_CHUNK_SIZE
+            # Byte ranges are served by FileIterator.app_iter_range, only hand
+            # complete files to the server's (sendfile capable) file_wrapper.
+            file_wrapper = None if req.range else req.environ.get("wsgi.file_wrapper", None)
+            # Clients that already have a copy of the file validate it by its
+            # digest, other clients get (cheaper) file metadata based ETags.
+            content_validated = "sha256-" in req.headers.get("If-None-Match", "")
+            resp = file_response(result, encoding=self.__response_encoding(req), chunk_size=chunk_size,
+                                 file_wrapper=file_wrapper, content_validated=content_validated)
+        elif self.response_type == 'stream':
+            resp = stream_response(result, encoding=self.__response_encoding(req))
+        elif self.conditional:
+            body = self.body(result)
+            resp = Response(body=body, conditional_response=True)
+            resp.etag = body_etag(body)
         else:
             resp = Response(body=self.body(result))
         return resp
 
     def __call__(self, func):
+        self.needs_ip = "ip" in func_args(func)
+        self.needs_body = "body" in func_args(func)
+        self.needs_content_length = "content_length" in func_args(func)
+
         def controller_replacement(environ, start_response, **args):
             req = Request(environ)
 
@@ -137,8 +315,10 @@ class Controller(object):
             if access_response:
                 return access_response
 
+            start = time.time()
             result = self.__execute_request(func, args, req, environ)
-            resp = self.__build_response(result)
+            resp = self.__build_response(result, req)
+            self._request_completed(req, func, result, resp, time.time() - start)
 
             return resp(environ, start_response)
 
@@ -153,31 +333,149 @@ class Controller(object):
         body = 'OK'
         if self.response_type == 'json':
             body = dumps(result)
+        elif self.response_type == 'text':
+            body = result
         return body
 
+    def _request_completed(self, req, func, result, resp, elapsed):
+        """ Called with the response built for each request (and the time
+        taken to build it), override to instrument requests.
+        """
+
     def _prepare_controller_args(self, req, args):
         pass
 
 
-def file_response(path):
-    resp = Response()
-    if exists(path):
-        resp.app_iter = FileIterator(path)
-    else:
+def file_response(path, encoding=None, chunk_size=DEFAULT_CHUNK_SIZE, file_wrapper=None, content_validated=False):
+    """ Build a response streaming the contents of the file at ``path`` in
+    blocks of ``chunk_size`` bytes. The response is conditional, so WebOb will
+    answer ``Range`` requests with ``206 Partial Content`` (using
+    ``FileIterator.app_iter_range``) and ``If-Modified-Since`` or
+    ``If-None-Match`` requests with ``304 Not Modified``. If ``encoding`` is
+    set the contents are instead compressed on the fly.
+
+    The ``ETag`` is derived from the file's size, modification time and inode
+    unless ``content_validated`` is set, in which case it is the content's
+    digest (see ``lwr.lwr_client.util.content_etag``).
+
+    ``file_wrapper`` may be set to the server's ``wsgi.file_wrapper`` to let
+    it send the file itself (e.g. using sendfile).
+    """
+    if not exists(path):
         raise exc.HTTPNotFound("No file found with path %s." % path)
+    resp = Response(conditional_response=True)
+    stat = os.stat(path)
+    resp.last_modified = stat.st_mtime
+    if content_validated:
+        # Describes the decoded contents, whatever the transfer encoding.
+        resp.etag = content_etag(_digest_cache.sha256(path))
+    else:
+        resp.etag = "%x-%x-%x" % (stat.st_size, int(stat.st_mtime), stat.st_ino)
+        if encoding:
+            resp.etag = "%s-%s" % (resp.etag, encoding)
+    if encoding:
+        resp.app_iter = CompressingFileIterator(path, encoding, chunk_size=chunk_size)
+        resp.content_encoding = encoding
+    else:
+        if file_wrapper:
+            resp.app_iter = file_wrapper(open(path, 'rb'), chunk_size)
+        else:
+            resp.app_iter = FileIterator(path, chunk_size=chunk_size)
+        resp.content_length = stat.st_size
+        resp.accept_ranges = "bytes"
+    return resp
+
+
+def stream_response(chunks, encoding=None):
+    """ Build a response streaming ``chunks`` (an iterable of bytes),
+    compressing them on the fly if ``encoding`` is set.
+    """
+    resp = Response(content_type='application/octet-stream')
+    if encoding:
+        resp.app_iter = CompressingIterator(chunks, encoding)
+        resp.content_encoding = encoding
+    else:
+        resp.app_iter = chunks
     return resp
 
 
 class FileIterator(Iterator):
 
-    def __init__(self, path):
+    def __init__(self, path, start=None, stop=None, chunk_size=DEFAULT_CHUNK_SIZE):
         self.input = open(path, 'rb')
+        self.chunk_size = chunk_size
+        if start:
+            self.input.seek(start)
+        # Number of bytes remaining to be read, None to read until EOF.
+        self.remaining = None if stop is None else stop - (start or 0)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        buffer = self.input.read(1024)
-        if(buffer == ""):
+        size = self.chunk_size
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        buffer = self.input.read(size) if size > 0 else b""
+        if not buffer:
+            self.close()
             raise StopIteration
+        if self.remaining is not None:
+            self.remaining -= len(buffer)
         return buffer
+
+    def app_iter_range(self, start, stop):
+        """ Used by WebOb to serve byte ranges of the file.
+        """
+        path = self.input.name
+        self.close()
+        return FileIterator(path, start=start, stop=stop, chunk_size=self.chunk_size)
+
+    def close(self):
+        self.input.close()
+
+
+class CompressingFileIterator(FileIterator):
+
+    def __init__(self, path, encoding, chunk_size=DEFAULT_CHUNK_SIZE):
+        super(CompressingFileIterator, self).__init__(path, chunk_size=chunk_size)
+        self.compressor = compressor(encoding)
+        self.flushed = False
+
+    def __next__(self):
+        while not self.flushed:
+            try:
+                data = self.compressor.compress(FileIterator.__next__(self))
+            except StopIteration:
+                data = self.compressor.flush()
+                self.flushed = True
+            if data:
+                return data
+        raise StopIteration
+
+
+class CompressingIterator(Iterator):
+
+    def __init__(self, chunks, encoding):
+        self.chunks = iter(chunks)
+        self.compressor = compressor(encoding)
+        self.flushed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.flushed:
+            try:
+                data = self.compressor.compress(next(self.chunks))
+            except StopIteration:
+                data = self.compressor.flush()
+                self.flushed = True
+            if data:
+                return data
+        raise StopIteration
+
+    def close(self):
+        close = getattr(self.chunks, "close", None)
+        if close:
+            close()
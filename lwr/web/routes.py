@@ -1,14 +1,29 @@
 import os
+import re
+from base64 import b64decode
+from io import BytesIO
 from webob import exc
+from json import dumps
 from json import loads
 
 from galaxy.util import (
     copy_to_path,
+    copy_to_path_range,
     copy_to_temp,
 )
 from lwr.lwr_client.job_directory import verify_is_in_directory
+from lwr.lwr_client.util import body_etag
+from lwr.lwr_client.util import file_sha256
+from lwr.lwr_client.archive import archive_name
+from lwr.lwr_client.archive import extract_members
+from lwr.lwr_client.archive import tar_stream
+from lwr.lwr_client.util import HashingReader
 from lwr.web.framework import Controller
+from lwr.web.framework import build_func_args
 from lwr.manager_factory import DEFAULT_MANAGER_NAME
+from lwr.managers import status
+from lwr import metrics as lwr_metrics
+from lwr.messaging.status_feed import DEFAULT_TIMEOUT as DEFAULT_STATUS_FEED_TIMEOUT
 from lwr.manager_endpoint_util import (
     submit_job,
     setup_job,
@@ -38,8 +53,26 @@ class LwrController(Controller):
         app_args['manager'] = managers[manager_name]
         app_args['file_cache'] = getattr(app, 'file_cache', None)
         app_args['object_store'] = getattr(app, 'object_store', None)
+        app_args['preallocate_uploads'] = getattr(app, 'preallocate_uploads', False)
+        app_args['managers'] = managers
+        app_args['status_feed'] = getattr(app, 'status_feeds', {}).get(manager_name, None)
         return app_args
 
+    def _request_completed(self, req, func, result, resp, elapsed):
+        route = func.__name__
+        lwr_metrics.REQUEST_DURATION.observe(elapsed, route=route)
+        if self.needs_body and req.content_length:
+            lwr_metrics.UPLOADED_BYTES.inc(req.content_length, route=route)
+        if self.response_type == 'file' and resp.status_int == 200:
+            lwr_metrics.DOWNLOADED_BYTES.inc(_served_bytes(req, resp, result), route=route)
+
+
+@LwrController(response_type='text')
+def metrics(managers):
+    """ Returns server metrics in the Prometheus text exposition format.
+    """
+    return lwr_metrics.REGISTRY.expose(lwr_metrics.manager_metrics(managers))
+
 
 @LwrController(response_type='json')
 def setup(manager, job_id, tool_id=None, tool_version=None):
@@ -76,10 +109,56 @@ def launch(manager, job_id, command_line, params='{}', dependencies_description=
     submit_job(manager, submit_config)
 
 
-@LwrController(response_type='json')
+@LwrController(response_type='json', conditional=True)
 def check_complete(manager, job_id):
-    status = manager.get_status(job_id)
-    return full_status(manager, status, job_id)
+    job_status = manager.get_status(job_id)
+    return full_status(manager, job_status, job_id)
+
+
+@LwrController(response_type='json')
+def check_complete_many(manager, body):
+    """ Check the status of many jobs, posted as a JSON list of job ids.
+    Returns a dictionary keyed on job id - values are the check_complete
+    response for jobs that are complete or cancelled, just {status: <status>}
+    for other jobs and {error: <message>} for jobs that could not be checked.
+
+    Jobs may instead be posted as a JSON object mapping each job id to the
+    etag of the last value returned for it (or null). Values then include
+    their etag, or are just {unchanged: true} if that etag still matches.
+    """
+    job_etags = loads(body.read())
+    conditional = isinstance(job_etags, dict)
+    statuses = {}
+    for job_id in job_etags:
+        try:
+            job_status = manager.get_status(job_id)
+            if job_status in [status.COMPLETE, status.CANCELLED]:
+                statuses[job_id] = full_status(manager, job_status, job_id)
+            else:
+                statuses[job_id] = {"status": job_status}
+        except Exception as e:
+            log.exception("Failed to check status of job %s" % job_id)
+            statuses[job_id] = {"error": str(e)}
+            continue
+        if conditional:
+            etag = body_etag(dumps(statuses[job_id], sort_keys=True))
+            if etag == job_etags[job_id]:
+                statuses[job_id] = {"unchanged": True}
+            else:
+                statuses[job_id]["etag"] = etag
+    return statuses
+
+
+@LwrController(response_type='json')
+def status_updates(status_feed, since=None, timeout=None):
+    """ Long-poll the state changes of jobs - see
+    :mod:`lwr.messaging.status_feed`.
+    """
+    if status_feed is None:
+        raise Exception("Status feed is not enabled for this LWR manager.")
+    if timeout is None:
+        timeout = DEFAULT_STATUS_FEED_TIMEOUT
+    return status_feed.updates(since, timeout=float(timeout))
 
 
 @LwrController()
@@ -90,76 +169,144 @@ def kill(manager, job_id):
 # Following routes allow older clients to talk to new LWR, should be considered
 # deprecated in favor of generic upload_file route.
 @LwrController(response_type='json')
-def upload_tool_file(manager, file_cache, job_id, name, body, cache_token=None):
+def upload_tool_file(manager, file_cache, job_id, name, body, cache_token=None, content_length=None, preallocate_uploads=False):
     path = manager.job_directory(job_id).calculate_path(name, 'tool')
     return _handle_upload(
         file_cache,
         path,
         body,
-        cache_token=cache_token
+        cache_token=cache_token,
+        content_length=content_length,
+        preallocate=preallocate_uploads,
     )
 
 
 @LwrController(response_type='json')
-def upload_input(manager, file_cache, job_id, name, body, cache_token=None):
+def upload_input(manager, file_cache, job_id, name, body, cache_token=None, sha256=None, content_length=None, preallocate_uploads=False):
     path = manager.job_directory(job_id).calculate_path(name, 'input')
     return _handle_upload(
         file_cache,
         path,
         body,
-        cache_token=cache_token
+        cache_token=cache_token,
+        sha256=sha256,
+        content_length=content_length,
+        preallocate=preallocate_uploads,
     )
 
 
 @LwrController(response_type='json')
-def upload_extra_input(manager, file_cache, job_id, name, body, cache_token=None):
+def upload_extra_input(manager, file_cache, job_id, name, body, cache_token=None, sha256=None, content_length=None, preallocate_uploads=False):
     path = manager.job_directory(job_id).calculate_path(name, 'input')
     return _handle_upload(
         file_cache,
         path,
         body,
-        cache_token=cache_token
+        cache_token=cache_token,
+        sha256=sha256,
+        content_length=content_length,
+        preallocate=preallocate_uploads,
     )
 
 
 @LwrController(response_type='json')
-def upload_config_file(manager, file_cache, job_id, name, body, cache_token=None):
+def upload_extra_inputs_archive(manager, job_id, body):
+    """ Extract a tar archive of input extra files (e.g. the contents of
+    dataset_N_files directories) - members are named as for
+    upload_extra_input and must be regular files within the job's inputs
+    directory. Returns a list of {path, size, sha256} for the files created,
+    in archive order.
+    """
+    job_directory = manager.job_directory(job_id)
+
+    def store(name, contents):
+        path = job_directory.calculate_path(name, 'input')
+        source = HashingReader(contents)
+        copy_to_path(source, path)
+        return _upload_response(path, source)
+
+    return extract_members(body, store)
+
+
+@LwrController(response_type='json')
+def upload_config_file(manager, file_cache, job_id, name, body, cache_token=None, content_length=None, preallocate_uploads=False):
     path = manager.job_directory(job_id).calculate_path(name, 'config')
     return _handle_upload(
         file_cache,
         path,
         body,
         cache_token=cache_token,
+        content_length=content_length,
+        preallocate=preallocate_uploads,
     )
 
 
 @LwrController(response_type='json')
-def upload_working_directory_file(manager, file_cache, job_id, name, body, cache_token=None):
+def upload_working_directory_file(manager, file_cache, job_id, name, body, cache_token=None, content_length=None, preallocate_uploads=False):
     path = manager.job_directory(job_id).calculate_path(name, 'workdir')
     return _handle_upload(
         file_cache,
         path,
         body,
         cache_token=cache_token,
+        content_length=content_length,
+        preallocate=preallocate_uploads,
     )
 
 
 @LwrController(response_type='json')
-def upload_unstructured_file(manager, file_cache, job_id, name, body, cache_token=None):
+def upload_unstructured_file(manager, file_cache, job_id, name, body, cache_token=None, content_length=None, preallocate_uploads=False):
     path = manager.job_directory(job_id).calculate_path(name, 'unstructured')
     return _handle_upload(
         file_cache,
         path,
         body,
         cache_token=cache_token,
+        content_length=content_length,
+        preallocate=preallocate_uploads,
     )
 
 
 @LwrController(response_type='json')
-def upload_file(manager, input_type, file_cache, job_id, name, body, cache_token=None):
+def upload_file(manager, input_type, file_cache, job_id, name, body, cache_token=None, sha256=None, content_length=None, preallocate_uploads=False):
     # Input type should be one of input, config, workdir, tool, or unstructured.
     path = manager.job_directory(job_id).calculate_path(name, input_type)
-    return _handle_upload(file_cache, path, body, cache_token=cache_token)
+    return _handle_upload(file_cache, path, body, cache_token=cache_token, sha256=sha256,
+                          content_length=content_length, preallocate=preallocate_uploads)
+
+
+@LwrController(response_type='json')
+def link_stored_input(manager, file_cache, job_id, name, input_type, sha256):
+    """ Returns {linked: <bool>, path: <path>} - if linked is true, contents
+    with the supplied SHA-256 digest were already stored and have been placed
+    at path so the file need not be uploaded. Otherwise the client should
+    upload the file (passing sha256 so it is stored for future jobs).
+    """
+    path = manager.job_directory(job_id).calculate_path(name, input_type)
+    linked = file_cache is not None and file_cache.link_blob(sha256, path)
+    return {"linked": linked, "path": path}
+
+
+@LwrController(response_type='json')
+def upload_file_chunk(manager, input_type, job_id, name, body, offset, size):
+    """ Write one byte range of a file being uploaded in parallel chunks,
+    size is the size of the complete file. Follow up with
+    complete_chunked_upload once all chunks have been sent.
+    """
+    path = manager.job_directory(job_id).calculate_path(name, input_type)
+    copy_to_path_range(body, path, int(offset), int(size))
+    return {"path": path}
+
+
+@LwrController(response_type='json')
+def complete_chunked_upload(manager, input_type, job_id, name, size):
+    """ Returns {path: <path>, size: <size>, sha256: <digest>} for client to
+    verify the reassembled upload against.
+    """
+    path = manager.job_directory(job_id).calculate_path(name, input_type)
+    with open(path, 'r+b') as f:
+        f.truncate(int(size))
+    return _file_info(path, checksum=True)
 
 
 @LwrController(response_type='json')
@@ -173,6 +320,27 @@ def download_output(manager, job_id, name, output_type="direct"):
     return _output_path(manager, job_id, name, output_type)
 
 
+@LwrController(response_type='stream')
+def download_outputs_archive(manager, job_id, body):
+    """ Stream a tar archive of many outputs at once. Outputs are posted as
+    JSON - {direct: [<name>, ...], work_dir: [<name>, ...], work_dir_pattern:
+    <regex>} (all optional) - where working directory files matching
+    work_dir_pattern are included in addition to those named. Members are
+    named <output_type>/<name>, outputs that do not exist are left out.
+    """
+    request = loads(body.read())
+    members = []
+    for output_type in ["direct", "work_dir"]:
+        names = list(request.get(output_type, []))
+        if output_type == "work_dir" and request.get("work_dir_pattern", None):
+            pattern = re.compile(request["work_dir_pattern"])
+            working_directory_contents = manager.job_directory(job_id).working_directory_contents()
+            names.extend(name for name in working_directory_contents if pattern.match(name) and name not in names)
+        for name in names:
+            members.append((archive_name(output_type, name), _output_path(manager, job_id, name, output_type)))
+    return tar_stream(members)
+
+
 @LwrController(response_type='json')
 def output_path(manager, job_id, name, output_type="direct"):
     # output_type should be one of...
@@ -181,6 +349,22 @@ def output_path(manager, job_id, name, output_type="direct"):
     return {"path": _output_path(manager, job_id, name, output_type)}
 
 
+@LwrController(response_type='json')
+def output_info(manager, job_id, name, output_type="direct", checksum=False):
+    """ Returns {path: <path>, size: <size>} (and sha256: <digest> if
+    checksum is set) so clients can plan and verify ranged downloads.
+    """
+    path = _output_path(manager, job_id, name, output_type)
+    return _file_info(path, checksum=str(checksum).lower() == "true")
+
+
+def _file_info(path, checksum=False):
+    info = {"path": path, "size": os.path.getsize(path)}
+    if checksum:
+        info["sha256"] = file_sha256(path)
+    return info
+
+
 def _output_path(manager, job_id, name, output_type):
     """
     """
@@ -192,6 +376,49 @@ def _output_path(manager, job_id, name, output_type):
     return path
 
 
+# Routes that may be executed in a batch - the small file uploads the client
+# sends inline (see Client._raw_execute_batch).
+BATCH_COMMANDS = dict((controller.__name__, controller) for controller in [
+    upload_tool_file,
+    upload_input,
+    upload_extra_input,
+    upload_config_file,
+    upload_working_directory_file,
+    upload_unstructured_file,
+    upload_file,
+])
+
+
+@LwrController(response_type='json', pass_app_args=True)
+def batch(app_args, ip, body):
+    """ Execute a list of sub-commands, posted as JSON, in one request. Each
+    sub-command is {command: <route>, args: {...}, body: <base64 body>}
+    (body optional) and is dispatched to the corresponding route (one of
+    BATCH_COMMANDS) with this request's manager - sub-command args cannot
+    override the application's arguments. Returns, in order, {ok:
+    true, result: <result>} or {ok: false, error: <message>} for each
+    sub-command.
+    """
+    return [_execute_batch_command(command, app_args, ip) for command in loads(body.read())]
+
+
+def _execute_batch_command(command, app_args, ip):
+    name = command.get("command", None)
+    try:
+        if name not in BATCH_COMMANDS:
+            raise Exception("Command %s cannot be executed in a batch" % name)
+        controller = BATCH_COMMANDS[name]
+        body = b64decode(command.get("body", None) or "")
+        request_args = dict(ip=ip, body=BytesIO(body), content_length=len(body))
+        func = controller.func
+        args = build_func_args(func, app_args, request_args, command.get("args", {}))
+        result = func(**args)
+        return {"ok": True, "result": result}
+    except Exception as e:
+        log.exception("Failed to execute batched command %s" % name)
+        return {"ok": False, "error": str(e)}
+
+
 @LwrController(response_type='json')
 def file_available(file_cache, ip, path):
     """ Returns {token: <token>, ready: <bool>}
@@ -200,18 +427,22 @@ def file_available(file_cache, ip, path):
 
 
 @LwrController(response_type='json')
-def cache_required(file_cache, ip, path):
+def cache_required(file_cache, ip, path, size=None, mtime=None, sha256=None, sampled_sha256=None):
     """ Returns bool indicating whether this client should
     execute cache_insert. Either way client should be follow up
-    with file_available.
+    with file_available. If the source file is described (by size, mtime
+    and optionally a digest) and the cached copy no longer matches it,
+    "stale" is returned and the client should execute cache_insert again.
     """
-    return file_cache.cache_required(ip, path)
+    validator = _source_validator(size, mtime, sha256, sampled_sha256)
+    return file_cache.cache_required(ip, path, validator=validator)
 
 
 @LwrController(response_type='json')
-def cache_insert(file_cache, ip, path, body):
+def cache_insert(file_cache, ip, path, body, size=None, mtime=None, sha256=None, sampled_sha256=None):
     temp_path = copy_to_temp(body)
-    file_cache.cache_file(temp_path, ip, path)
+    validator = _source_validator(size, mtime, sha256, sampled_sha256)
+    file_cache.cache_file(temp_path, ip, path, validator=validator)
 
 
 # TODO: coerce booleans and None values into correct types - simplejson may
@@ -290,11 +521,46 @@ class LwrDataset(object):
         self.object_store_id = None
 
 
-def _handle_upload(file_cache, path, body, cache_token=None):
-    source = body
+def _handle_upload(file_cache, path, body, cache_token=None, sha256=None, content_length=None, preallocate=False):
+    """ Stream body (or cached file) into path, hashing it on the way so the
+    response can include the size and SHA-256 digest of the stored file for
+    the client to verify against.
+    """
+    source = HashingReader(body)
+    if sha256 and file_cache is not None and not cache_token:
+        temp_path = copy_to_temp(source, dir=file_cache.blob_directory)
+        file_cache.store_blob(temp_path, sha256, link_path=path, actual_digest=source.hexdigest())
+        return _upload_response(path, source)
     if cache_token:
-        cached_file = file_cache.destination(cache_token)
-        source = open(cached_file, 'rb')
-        log.info("Copying cached file %s to %s" % (cached_file, path))
-    copy_to_path(source, path)
-    return {"path": path}
+        # Not evicted from the cache while being copied.
+        with file_cache.in_use(cache_token) as cached_file:
+            # The (empty) request body says nothing about the cached file.
+            preallocate_size = os.path.getsize(cached_file) if preallocate else None
+            source = HashingReader(open(cached_file, 'rb'))
+            log.info("Copying cached file %s to %s" % (cached_file, path))
+            copy_to_path(source, path, preallocate_size=preallocate_size)
+        return _upload_response(path, source)
+    preallocate_size = content_length if preallocate else None
+    copy_to_path(source, path, preallocate_size=preallocate_size)
+    return _upload_response(path, source)
+
+
+def _served_bytes(req, resp, path):
+    if req.if_modified_since and resp.last_modified and resp.last_modified <= req.if_modified_since:
+        return 0  # Not Modified
+    if resp.etag and resp.etag in req.if_none_match:
+        return 0  # Not Modified
+    size = os.path.getsize(path)
+    if req.range:
+        content_range = req.range.content_range(size)
+        return content_range.stop - content_range.start if content_range else 0
+    return size
+
+
+def _source_validator(size, mtime, sha256, sampled_sha256):
+    validator = dict(size=size, mtime=mtime, sha256=sha256, sampled_sha256=sampled_sha256)
+    return dict((key, value) for key, value in validator.items() if value is not None)
+
+
+def _upload_response(path, source):
+    return {"path": path, "size": source.size, "sha256": source.hexdigest()}
@@ -1,7 +1,12 @@
+import base64
+import hashlib
 import os
 import json
 import urllib
 import time
+import tarfile
+from io import BytesIO
+from wsgiref.util import FileWrapper
 
 
 def test_standard_requests():
@@ -25,6 +30,8 @@ def test_standard_requests():
             upload_input_response = app.post(url, "Test Contents")
             upload_input_config = json.loads(upload_input_response.body)
             staged_input_path = upload_input_config["path"]
+            assert upload_input_config["size"] == 13
+            assert upload_input_config["sha256"] == hashlib.sha256(b"Test Contents").hexdigest()
             staged_input = open(staged_input_path, "r")
             try:
                 assert staged_input.read() == "Test Contents"
@@ -33,6 +40,50 @@ def test_standard_requests():
         test_upload("input")
         test_upload("tool_file")
 
+        batch_commands = [
+            {"command": "upload_config_file", "args": {"job_id": job_id, "name": "batched"}, "body": base64.b64encode(b"Batched Contents")},
+            {"command": "upload_file", "args": {"job_id": job_id, "name": "batched_input", "input_type": "input"},
+             "body": base64.b64encode(b"Batched Input")},
+            # Sub-command args cannot replace application arguments.
+            {"command": "upload_config_file", "args": {"job_id": job_id, "name": "overriding", "manager": "bogus"},
+             "body": base64.b64encode(b"Overriding")},
+            {"command": "download_output", "args": {"job_id": job_id, "name": "batched"}},
+            {"command": "check_complete_many", "args": {}, "body": base64.b64encode(json.dumps([job_id]))},
+            {"command": "batch", "args": {}, "body": base64.b64encode(b"[]")},
+        ]
+        batch_response = json.loads(app.post("/batch", json.dumps(batch_commands)).body)
+        assert batch_response[0]["ok"]
+        batched_path = batch_response[0]["result"]["path"]
+        assert open(batched_path, "r").read() == "Batched Contents"
+        assert batch_response[1]["ok"]
+        assert batch_response[1]["result"]["size"] == 13
+        assert open(batch_response[1]["result"]["path"], "r").read() == "Batched Input"
+        assert batch_response[2]["ok"], batch_response[2]
+        assert open(batch_response[2]["result"]["path"], "r").read() == "Overriding"
+        # Only the small upload routes may be batched.
+        assert [response["ok"] for response in batch_response[3:]] == [False, False, False]
+
+        # Chunks may arrive in any order.
+        chunk_url = "/upload_file_chunk?job_id=%s&name=chunked&input_type=input&size=12&offset=%d"
+        app.post(chunk_url % (job_id, 6), "World!")
+        app.post(chunk_url % (job_id, 0), "Hello ")
+        complete_url = "/complete_chunked_upload?job_id=%s&name=chunked&input_type=input&size=12" % job_id
+        complete_config = json.loads(app.get(complete_url).body)
+        assert complete_config["size"] == 12
+        assert complete_config["sha256"] == hashlib.sha256(b"Hello World!").hexdigest()
+        assert open(complete_config["path"], "r").read() == "Hello World!"
+
+        extra_inputs = BytesIO()
+        extra_inputs_tar = tarfile.open(fileobj=extra_inputs, mode="w")
+        extra_info = tarfile.TarInfo("dataset_1_files/index/1.txt")
+        extra_info.size = 5
+        extra_inputs_tar.addfile(extra_info, BytesIO(b"Extra"))
+        extra_inputs_tar.close()
+        extra_response = app.post("/upload_extra_inputs_archive?job_id=%s" % job_id, extra_inputs.getvalue())
+        extra_config = json.loads(extra_response.body)
+        assert extra_config[0]["path"].endswith(os.path.join("inputs", "dataset_1_files", "index", "1.txt"))
+        assert open(extra_config[0]["path"], "r").read() == "Extra"
+
         test_output = open(os.path.join(outputs_directory, "test_output"), "w")
         try:
             test_output.write("Hello World!")
@@ -41,6 +92,52 @@ def test_standard_requests():
         download_response = app.get("/download_output?job_id=%s&name=test_output" % job_id)
         assert download_response.body == "Hello World!"
 
+        with open(os.path.join(setup_config["working_directory"], "galaxy.json"), "w") as galaxy_json:
+            galaxy_json.write("{}")
+        archive_request = json.dumps({"direct": ["test_output", "missing"], "work_dir_pattern": "galaxy.json|metadata_.*"})
+        archive_response = app.post("/download_outputs_archive?job_id=%s" % job_id, archive_request)
+        archive = tarfile.open(fileobj=BytesIO(archive_response.body))
+        assert archive.getnames() == ["direct/test_output", "work_dir/galaxy.json"]
+        assert archive.extractfile("direct/test_output").read() == "Hello World!"
+
+        info_url = "/output_info?job_id=%s&name=test_output&checksum=true" % job_id
+        output_info = json.loads(app.get(info_url).body)
+        assert output_info["size"] == 12
+        assert output_info["sha256"] == hashlib.sha256(b"Hello World!").hexdigest()
+
+        wrapped_files = []
+
+        def file_wrapper(filelike, block_size):
+            wrapped_files.append(filelike)
+            return FileWrapper(filelike, block_size)
+        wrapped_environ = {"wsgi.file_wrapper": file_wrapper}
+        wrapped_response = app.get("/download_output?job_id=%s&name=test_output" % job_id, extra_environ=wrapped_environ)
+        assert wrapped_response.body == "Hello World!"
+        assert len(wrapped_files) == 1
+        assert wrapped_response.headers["Content-Length"] == "12"
+        assert wrapped_response.headers["Last-Modified"]
+
+        not_modified_headers = {"If-Modified-Since": wrapped_response.headers["Last-Modified"]}
+        not_modified_response = app.get("/download_output?job_id=%s&name=test_output" % job_id, headers=not_modified_headers)
+        assert not_modified_response.status_int == 304
+
+        etag_headers = {"If-None-Match": wrapped_response.headers["ETag"]}
+        etag_response = app.get("/download_output?job_id=%s&name=test_output" % job_id, headers=etag_headers)
+        assert etag_response.status_int == 304
+        content_etag_headers = {"If-None-Match": '"sha256-%s"' % hashlib.sha256(b"Hello World!").hexdigest()}
+        content_etag_response = app.get("/download_output?job_id=%s&name=test_output" % job_id, headers=content_etag_headers)
+        assert content_etag_response.status_int == 304
+        stale_etag_headers = {"If-None-Match": '"sha256-%s"' % hashlib.sha256(b"Hello!").hexdigest()}
+        stale_etag_response = app.get("/download_output?job_id=%s&name=test_output" % job_id, headers=stale_etag_headers)
+        assert stale_etag_response.body == "Hello World!"
+
+        range_response = app.get("/download_output?job_id=%s&name=test_output" % job_id, headers={"Range": "bytes=6-"}, extra_environ=wrapped_environ)
+        assert range_response.status_int == 206
+        assert range_response.body == "World!"
+        assert range_response.headers["Content-Range"] == "bytes 6-11/12"
+        # Byte ranges aren't served through the file wrapper.
+        assert len(wrapped_files) == 1
+
         try:
             app.get("/download_output?job_id=%s&name=test_output2" % job_id)
             assert False  # Should throw exception
@@ -61,6 +158,16 @@ def test_standard_requests():
         assert check_config['returncode'] == 0
         assert check_config['stdout'] == "test_out"
         assert check_config['stderr'] == ""
+        not_modified_check_response = app.get("/check_complete?job_id=%s" % job_id, headers={"If-None-Match": check_response.headers["ETag"]})
+        assert not_modified_check_response.status_int == 304
+
+        check_many_response = app.post("/check_complete_many", json.dumps([job_id]))
+        check_many = json.loads(check_many_response.body)
+        assert check_many[job_id]['stdout'] == "test_out"
+        conditional_check_many_response = app.post("/check_complete_many", json.dumps({job_id: None}))
+        etag = json.loads(conditional_check_many_response.body)[job_id]["etag"]
+        unchanged_check_many_response = app.post("/check_complete_many", json.dumps({job_id: etag}))
+        assert json.loads(unchanged_check_many_response.body) == {job_id: {"unchanged": True}}
 
         kill_response = app.get("/kill?job_id=%s" % job_id)
         assert kill_response.body == 'OK'
@@ -68,3 +175,40 @@ def test_standard_requests():
         clean_response = app.get("/clean?job_id=%s" % job_id)
         assert clean_response.body == 'OK'
         assert os.listdir(staging_directory) == []
+
+        metrics_response = app.get("/metrics")
+        assert metrics_response.content_type == "text/plain"
+        metrics = metrics_response.body
+        assert 'lwr_request_duration_seconds_count{route="setup"} ' in metrics
+        assert 'lwr_uploaded_bytes_total{route="upload_input"}' in metrics
+        assert 'lwr_downloaded_bytes_total{route="download_output"}' in metrics
+        assert 'lwr_staging_duration_seconds_count{manager="_default_",stage="preprocess"}' in metrics
+        assert 'lwr_active_jobs{manager="_default_"} 0' in metrics
+
+
+def test_compressed_uploads():
+    import gzip
+    from .test_utils import test_lwr_app
+
+    with test_lwr_app(app_conf={"max_upload_compression_ratio": "100"}) as app:
+        job_id = json.loads(app.get("/setup?job_id=12346").body)["job_id"]
+        url = "/upload_input?job_id=%s&name=input1" % job_id
+
+        def gzipped(contents):
+            compressed = BytesIO()
+            gzip_file = gzip.GzipFile(fileobj=compressed, mode="wb")
+            gzip_file.write(contents)
+            gzip_file.close()
+            return compressed.getvalue()
+
+        upload_config = json.loads(app.post(url, gzipped(b"Test Contents"), headers={"Content-Encoding": "gzip"}).body)
+        assert open(upload_config["path"], "rb").read() == b"Test Contents"
+
+        # Unsupported encodings are rejected, advertising those supported.
+        unsupported_response = app.post(url, b"Test Contents", headers={"Content-Encoding": "br"}, status=415)
+        assert "gzip" in unsupported_response.headers["Accept-Encoding"]
+
+        # Bodies decompressing to more than max_upload_compression_ratio
+        # times their size are rejected before being written out in full.
+        bomb = gzipped(b"\0" * (16 * 1024 * 1024))
+        app.post(url, bomb, headers={"Content-Encoding": "gzip"}, status=413)
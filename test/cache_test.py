@@ -1,22 +1,29 @@
-from os import remove
-from os.path import exists
+from hashlib import sha256
+from os import remove, stat
+from os.path import exists, join
 from tempfile import mkdtemp, NamedTemporaryFile
 from .test_utils import TestCase
 
+from lwr import metrics
 from lwr.cache import Cache
 from shutil import rmtree
+from time import sleep
+import threading
 
 
 class CacheTest(TestCase):
 
+    persistence_backend = None
+
     def setUp(self):
         self.temp_dir = mkdtemp()
         self.temp_file = NamedTemporaryFile(delete=False)
         self.temp_file.write(b"Hello World!")
         self.temp_file.close()
-        self.cache = Cache(self.temp_dir)
+        self.cache = Cache(self.temp_dir, persistence_backend=self.persistence_backend)
 
     def tearDown(self):
+        self.cache.close()
         rmtree(self.temp_dir)
         if exists(self.temp_file.name):
             remove(self.temp_file.name)
@@ -28,9 +35,211 @@ class CacheTest(TestCase):
         assert cache_response_1
         assert not cache_response_2
 
+    def test_stale_when_source_changes(self):
+        cache = self.cache
+        validator = dict(size="12", mtime="1.0")
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat", validator) is True
+        cache.cache_file(self.temp_file.name, "127.0.0.2", "/galaxy/dataset10001.dat", validator)
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat", validator) is False
+        changed = dict(size="12", mtime="2.0")
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat", changed) == "stale"
+        # Stale copy is no longer handed out.
+        assert not cache.file_available("127.0.0.2", "/galaxy/dataset10001.dat")["ready"]
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat", changed) is False
+
+    def test_revalidated_by_digest(self):
+        cache = self.cache
+        validator = dict(size="12", mtime="1.0", sha256="abc")
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat", validator) is True
+        cache.cache_file(self.temp_file.name, "127.0.0.2", "/galaxy/dataset10001.dat", validator)
+        touched = dict(size="12", mtime="2.0", sha256="abc")
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat", touched) is False
+        assert cache.file_available("127.0.0.2", "/galaxy/dataset10001.dat")["ready"]
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat", dict(touched, sha256="def")) == "stale"
+
     def test_making_file_available(self):
         cache = self.cache
         assert cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat")
         assert not cache.file_available("127.0.0.2", "/galaxy/dataset10001.dat")["ready"]
         cache.cache_file(self.temp_file.name, "127.0.0.2", "/galaxy/dataset10001.dat")
         assert cache.file_available("127.0.0.2", "/galaxy/dataset10001.dat")["ready"]
+
+    def test_evicts_least_recently_used(self):
+        cache = Cache(self.temp_dir, persistence_backend=self.persistence_backend, max_size=24, reap_interval=3600)
+        for path in ["/galaxy/dataset1.dat", "/galaxy/dataset2.dat"]:
+            assert cache.cache_required("127.0.0.2", path)
+            self.__cache_hello(cache, path)
+        hits = metrics.FILE_CACHE_HITS.values.get((), 0)
+        # Use dataset1.dat, so dataset2.dat is least recently used.
+        assert not cache.cache_required("127.0.0.2", "/galaxy/dataset1.dat")
+        assert metrics.FILE_CACHE_HITS.values[()] == hits + 1
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset3.dat")
+        evictions = metrics.FILE_CACHE_EVICTIONS.values.get((), 0)
+        self.__cache_hello(cache, "/galaxy/dataset3.dat")
+        # May already have been evicted by the (woken) background thread.
+        cache.evict()
+        assert metrics.FILE_CACHE_EVICTIONS.values[()] == evictions + 1
+        assert cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")["ready"]
+        assert not cache.file_available("127.0.0.2", "/galaxy/dataset2.dat")["ready"]
+        # Evicted files must be uploaded again.
+        assert cache.cache_required("127.0.0.2", "/galaxy/dataset2.dat")
+        cache.close()
+
+    def test_does_not_evict_files_in_use(self):
+        cache = Cache(self.temp_dir, persistence_backend=self.persistence_backend, max_size=12, reap_interval=3600)
+        cache.cache_required("127.0.0.2", "/galaxy/dataset1.dat")
+        self.__cache_hello(cache, "/galaxy/dataset1.dat")
+        token = cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")["token"]
+        with cache.in_use(token) as path:
+            cache.cache_required("127.0.0.2", "/galaxy/dataset2.dat")
+            evictions = metrics.FILE_CACHE_EVICTIONS.values.get((), 0)
+            self.__cache_hello(cache, "/galaxy/dataset2.dat")
+            cache.evict()
+            assert metrics.FILE_CACHE_EVICTIONS.values[()] == evictions + 1
+            assert open(path, "rb").read() == b"Hello World!"
+        assert not cache.file_available("127.0.0.2", "/galaxy/dataset2.dat")["ready"]
+        cache.close()
+
+    def test_does_not_evict_recent_hits(self):
+        cache = Cache(self.temp_dir, persistence_backend=self.persistence_backend, max_size=12, reap_interval=3600)
+        cache.cache_required("127.0.0.2", "/galaxy/dataset1.dat")
+        self.__cache_hello(cache, "/galaxy/dataset1.dat")
+        # Client is told dataset1.dat is cached, and will upload it by token.
+        assert not cache.cache_required("127.0.0.2", "/galaxy/dataset1.dat")
+        cache.cache_required("127.0.0.2", "/galaxy/dataset2.dat")
+        self.__cache_hello(cache, "/galaxy/dataset2.dat")
+        cache.evict()
+        assert cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")["ready"]
+        assert not cache.file_available("127.0.0.2", "/galaxy/dataset2.dat")["ready"]
+        # Once the pin expires, dataset1.dat may be evicted again.
+        cache.pinned = dict((token, 0) for token in cache.pinned)
+        cache.cache_required("127.0.0.2", "/galaxy/dataset3.dat")
+        self.__cache_hello(cache, "/galaxy/dataset3.dat")
+        cache.evict()
+        assert not cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")["ready"]
+        cache.close()
+
+    def test_blob_store_links_contents(self):
+        cache = self.cache
+        digest = sha256(b"Hello World!").hexdigest()
+        assert not cache.has_blob(digest)
+        job_path_1 = join(self.temp_dir, "job1_input")
+        assert not cache.link_blob(digest, job_path_1)
+        upload_path = self.__upload_to_blob_directory()
+        cache.store_blob(upload_path, digest, link_path=job_path_1)
+        assert cache.has_blob(digest)
+        job_path_2 = join(self.temp_dir, "job2_input")
+        assert cache.link_blob(digest, job_path_2)
+        assert open(job_path_2, "rb").read() == b"Hello World!"
+        assert stat(job_path_2).st_nlink == 3
+
+    def test_blob_store_verifies_digest(self):
+        digest = sha256(b"Hello Other World!").hexdigest()
+        upload_path = self.__upload_to_blob_directory()
+        exception_raised = False
+        try:
+            self.cache.store_blob(upload_path, digest)
+        except Exception:
+            exception_raised = True
+        assert exception_raised
+        assert not self.cache.has_blob(digest)
+
+    def test_blob_garbage_collection(self):
+        cache = self.cache
+        digest = sha256(b"Hello World!").hexdigest()
+        job_path = join(self.temp_dir, "job1_input")
+        cache.store_blob(self.__upload_to_blob_directory(), digest, link_path=job_path)
+        assert cache.collect_garbage() == 0
+        remove(job_path)
+        # Just unlinked, may be about to be linked into another job.
+        assert cache.collect_garbage() == 0
+        assert cache.link_blob(digest, job_path)
+        remove(job_path)
+        cache.blob_grace_seconds = 0
+        assert cache.collect_garbage() == 1
+        assert not cache.has_blob(digest)
+
+    def test_blob_garbage_collected_in_background(self):
+        self.cache.close()
+        cache = Cache(self.temp_dir, persistence_backend=self.persistence_backend, blob_grace_seconds=0, blob_collection_interval=0.1)
+        try:
+            digest = sha256(b"Hello World!").hexdigest()
+            job_path = join(self.temp_dir, "job1_input")
+            cache.store_blob(self.__upload_to_blob_directory(), digest, link_path=job_path)
+            remove(job_path)
+            for i in range(50):
+                if not cache.has_blob(digest):
+                    break
+                sleep(.1)
+            assert not cache.has_blob(digest)
+        finally:
+            cache.close()
+
+    def __cache_hello(self, cache, path):
+        temp_path = join(self.temp_dir, "upload")
+        open(temp_path, "wb").write(b"Hello World!")
+        cache.cache_file(temp_path, "127.0.0.2", path)
+
+    def __upload_to_blob_directory(self):
+        path = join(self.cache.blob_directory, "upload")
+        open(path, "wb").write(b"Hello World!")
+        return path
+
+
+class HashedCacheTest(CacheTest):
+
+    def setUp(self):
+        super(HashedCacheTest, self).setUp()
+        self.cache.close()
+        self.cache = Cache(self.temp_dir, layout="hashed")
+
+    def test_migrates_flat_layout(self):
+        self.cache.close()
+        flat_cache = Cache(self.temp_dir)
+        flat_cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat")
+        flat_cache.cache_file(self.temp_file.name, "127.0.0.2", "/galaxy/dataset10001.dat")
+        flat_cache.close()
+        hashed_cache = Cache(self.temp_dir, layout="hashed")
+        available = hashed_cache.file_available("127.0.0.2", "/galaxy/dataset10001.dat")
+        assert available["ready"]
+        token = available["token"]
+        assert hashed_cache.destination(token) == join(self.temp_dir, token[0:2], token)
+        assert not exists(join(self.temp_dir, token))
+        hashed_cache.close()
+
+
+class SqliteCacheTest(CacheTest):
+    persistence_backend = "sqlite"
+
+    def test_inserted_only_once_concurrently(self):
+        # Another cache on the same database, e.g. in another LWR process.
+        other_cache = Cache(self.temp_dir, persistence_backend="sqlite")
+        paths = ["/galaxy/dataset%d.dat" % i for i in range(100)]
+        results = []
+        start = threading.Event()
+
+        def check(cache):
+            start.wait()
+            for path in paths:
+                results.append((path, cache.cache_required("127.0.0.2", path)))
+
+        threads = [threading.Thread(target=check, args=(cache,)) for cache in [self.cache, other_cache] * 4]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        other_cache.close()
+        for path in paths:
+            assert [required for result_path, required in results if result_path == path].count(True) == 1
+
+    def test_migrates_shelf(self):
+        self.cache.close()
+        shelf_cache = Cache(self.temp_dir, persistence_backend="shelve")
+        assert shelf_cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat")
+        shelf_cache.close()
+        remove(join(self.temp_dir, "cache_shelf.sqlite"))
+        sqlite_cache = Cache(self.temp_dir, persistence_backend="sqlite")
+        assert not sqlite_cache.cache_required("127.0.0.2", "/galaxy/dataset10001.dat")
+        assert sqlite_cache.cache_required("127.0.0.2", "/galaxy/dataset10002.dat")
+        sqlite_cache.close()
@@ -11,9 +11,11 @@ from io import open
 
 from lwr.lwr_client import submit_job
 from lwr.lwr_client import finish_job
+from lwr.lwr_client import TransferMetrics
 from lwr.lwr_client import LwrOutputs
 from lwr.lwr_client import ClientOutputs
 from lwr.lwr_client import build_client_manager
+from lwr.lwr_client import check_complete_many
 from lwr.lwr_client import ClientJobDescription
 from galaxy.tools.deps.dependencies import DependenciesDescription
 from galaxy.tools.deps.requirements import ToolRequirement
@@ -148,7 +150,7 @@ def run(options):
             temp_output_workdir_destination2
         ]
         client, client_manager = __client(temp_directory, options)
-        waiter = Waiter(client, client_manager)
+        waiter = Waiter(client, client_manager, status_listener=getattr(options, "status_listener", False))
         client_outputs = ClientOutputs(
             working_directory=temp_work_dir,
             work_dir_outputs=[
@@ -168,10 +170,12 @@ def run(options):
             working_directory=temp_work_dir,
             **__extra_job_description_kwargs(options)
         )
-        submit_job(client, job_description)
+        transfer_metrics = TransferMetrics()
+        submit_job(client, job_description, transfer_metrics=transfer_metrics)
         result_status = waiter.wait()
 
-        __finish(options, client, client_outputs, result_status)
+        __finish(options, client, client_outputs, result_status, transfer_metrics)
+        __assert_transfer_metrics(transfer_metrics)
         __assert_contents(temp_output_path, EXPECTED_OUTPUT, result_status)
         __assert_contents(temp_output2_path, cmd_text, result_status)
         __assert_contents(os.path.join(temp_work_dir, "galaxy.json"), b"GALAXY_JSON", result_status)
@@ -201,10 +205,11 @@ def run(options):
 
 class Waiter(object):
 
-    def __init__(self, client, client_manager):
+    def __init__(self, client, client_manager, status_listener=False):
         self.client = client
         self.client_manager = client_manager
-        self.async = hasattr(client_manager, 'ensure_has_status_update_callback')
+        self.status_listener = status_listener
+        self.async = status_listener or hasattr(client_manager, 'ensure_has_status_update_callback')
         self.__setup_callback()
 
     def __setup_callback(self):
@@ -212,18 +217,24 @@ class Waiter(object):
             self.event = threading.Event()
 
             def on_update(message):
-                if message["status"] in ["complete", "cancelled"]:
+                if message["job_id"] == self.client.job_id and message["status"] in ["complete", "cancelled"]:
                     self.final_status = message
                     self.event.set()
 
-            self.client_manager.ensure_has_status_update_callback(on_update)
+            if self.status_listener:
+                listener = self.client_manager.ensure_has_status_listener(self.client.destination_params, on_update)
+                assert listener.started.wait(5)
+            else:
+                self.client_manager.ensure_has_status_update_callback(on_update)
 
     def wait(self):
         final_status = None
         if not self.async:
             i = 0
             while i < 5:
-                complete_response = self.client.raw_check_complete()
+                complete_response = check_complete_many([self.client])[0]
+                if isinstance(complete_response, Exception):
+                    raise complete_response
                 if complete_response["status"] in ["complete", "cancelled"]:
                     final_status = complete_response
                     break
@@ -293,6 +304,13 @@ def __client(temp_directory, options):
         client_options["jobs_directory"] = getattr(options, "jobs_directory")
     if hasattr(options, "files_endpoint"):
         client_options["files_endpoint"] = getattr(options, "files_endpoint")
+    simple_client_options = ['jobs_directory_layout', 'deduplicate_inputs', 'batch_upload_threshold', 'compression',
+                             'verify_uploads', 'archive_outputs', 'archive_extra_inputs', 'cache_digest']
+    for client_option in simple_client_options:
+        if getattr(options, client_option, None):
+            client_options[client_option] = getattr(options, client_option)
+    if getattr(options, "chunk_threshold", None) is not None:
+        client_options["chunk_threshold"] = options.chunk_threshold
     user = getattr(options, 'user', None)
     if user:
         client_options["submit_user"] = user
@@ -303,7 +321,8 @@ def __client(temp_directory, options):
 
 def __client_manager(options):
     manager_args = {}
-    simple_client_manager_options = ['cache', 'job_manager', 'file_cache']
+    simple_client_manager_options = ['cache', 'job_manager', 'file_cache', 'async_requests',
+                                     'schedule_transfers', 'max_transfers_per_destination', 'transfer_bandwidth']
     for client_manager_option in simple_client_manager_options:
         if getattr(options, client_manager_option, None):
             manager_args[client_manager_option] = getattr(options, client_manager_option)
@@ -340,7 +359,7 @@ def __extra_job_description_kwargs(options):
     return dict(dependencies_description=dependencies_description, env=env)
 
 
-def __finish(options, client, client_outputs, result_status):
+def __finish(options, client, client_outputs, result_status, transfer_metrics):
     lwr_outputs = LwrOutputs.from_status_response(result_status)
     cleanup_job = 'always'
     if not getattr(options, 'cleanup', True):
@@ -351,14 +370,34 @@ def __finish(options, client, client_outputs, result_status):
         cleanup_job=cleanup_job,  # Default should 'always' if overridden via options.
         client_outputs=client_outputs,
         lwr_outputs=lwr_outputs,
+        transfer_metrics=transfer_metrics,
     )
-    failed = finish_job(**finish_args)
+    if getattr(options, "refinish", False):
+        # Finish the job twice (as when retrying a failed finish) - final
+        # status and outputs already fetched should just be revalidated.
+        __assert_finished(finish_job(**dict(finish_args, cleanup_job='never')), result_status)
+        assert client.full_status() == client.full_status()
+        output_path = client_outputs.output_files[0]
+        os.utime(output_path, (0, 0))
+        __assert_finished(finish_job(**finish_args), result_status)
+        assert os.path.getmtime(output_path) == 0
+    else:
+        __assert_finished(finish_job(**finish_args), result_status)
+
+
+def __assert_finished(failed, result_status):
     if failed:
         failed_message_template = "Failed to complete job correctly, final status %s, finish exceptions %s."
         failed_message = failed_message_template % (result_status, failed)
         assert False, failed_message
 
 
+def __assert_transfer_metrics(transfer_metrics):
+    summary = transfer_metrics.summary()
+    assert summary["failures"] == 0, summary
+    assert summary["files"] == sum(group["files"] for group in summary["groups"]), summary
+
+
 def main():
     """ Exercises a running lwr server application with the lwr client. """
     parser = optparse.OptionParser()
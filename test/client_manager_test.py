@@ -1,6 +1,10 @@
 from os import environ
+import threading
+import time
 
 from lwr.lwr_client.manager import ClientManager
+from lwr.lwr_client.manager import ClientCacher
+from lwr.lwr_client.staging.metrics import cache_wait_time
 
 
 def test_environment_variables_config():
@@ -27,5 +31,59 @@ def test_kwds_config():
     assert not __produces_caching_client(client_manager)
 
 
+def test_cacher_notifies_on_transfer():
+    client_cacher = ClientCacher(transfer_threads=1, cache_probe_max_delay=60)
+    client = MockCachingClient(insert_delay=.1)
+    start = time.time()
+    start_cache_wait = cache_wait_time()
+    event_holder = client_cacher.queue_transfer(client, "/data/1.dat")
+    assert client_cacher.wait_until_available(client, "/data/1.dat", event_holder) == "token-/data/1.dat"
+    # Woken by the transfer rather than the (long) probe delay.
+    assert time.time() - start < 30
+    assert cache_wait_time() > start_cache_wait
+
+
+def test_cacher_transfer_failure():
+    client_cacher = ClientCacher(transfer_threads=1)
+    client = MockCachingClient(fail=True)
+    event_holder = client_cacher.queue_transfer(client, "/data/1.dat")
+    try:
+        client_cacher.wait_until_available(client, "/data/1.dat", event_holder)
+        assert False
+    except Exception as e:
+        assert "Failed to transfer" in str(e)
+
+
+def test_cacher_probes_other_processes_inserts():
+    client_cacher = ClientCacher(transfer_threads=1, cache_probe_initial_delay=.01, cache_probe_max_delay=.04)
+    client = MockCachingClient()
+    # Insert made elsewhere (e.g. another Galaxy process).
+    timer = threading.Timer(.2, client.cache_insert, ["/data/1.dat"])
+    timer.start()
+    assert client_cacher.wait_until_available(client, "/data/1.dat") == "token-/data/1.dat"
+    assert client.available_checks > 3
+    timer.join()
+
+
+class MockCachingClient(object):
+
+    def __init__(self, insert_delay=0, fail=False):
+        self.insert_delay = insert_delay
+        self.fail = fail
+        self.inserted = set()
+        self.available_checks = 0
+
+    def cache_insert(self, path):
+        time.sleep(self.insert_delay)
+        if self.fail:
+            raise Exception("Insert failed.")
+        self.inserted.add(path)
+
+    def file_available(self, path):
+        self.available_checks += 1
+        ready = path in self.inserted
+        return {"ready": ready, "token": "token-%s" % path if ready else None}
+
+
 def __produces_caching_client(client_manager):
     return client_manager.client_class.__name__.find('Caching') > 0
@@ -5,6 +5,9 @@ from .test_utils import TempDirectoryTestCase
 from .test_common import write_config
 from lwr.lwr_client import submit_job, ClientJobDescription
 from lwr.lwr_client import ClientOutputs
+from lwr.lwr_client import TransferMetrics
+from lwr.lwr_client.action_mapper import PrefixPathMapper
+from lwr.lwr_client.staging.up import JobInputs
 from galaxy.tools.deps.dependencies import DependenciesDescription
 from galaxy.tools.deps.requirements import ToolRequirement
 
@@ -93,6 +96,26 @@ class TestStager(TempDirectoryTestCase):
         assert uploaded_file1[1] == "unstructured"
         self.assertEquals(uploaded_file1[0], local_unstructured_file)
 
+    def test_unstructured_rewrite_shared_prefix(self):
+        self.client_job_description.rewrite_paths = True
+        data_directory = os.path.join(self.temp_directory, "data")
+        # Shares data_directory's path as a prefix, but isn't below it.
+        sibling_directory = os.path.join(self.temp_directory, "database")
+        os.makedirs(data_directory)
+        os.makedirs(sibling_directory)
+        self.client.set_action_map_config(dict(paths=[
+            dict(path=data_directory, path_types="*any*")
+        ]))
+        local_unstructured_file = os.path.join(data_directory, "A_RANDOM_FILE")
+        open(local_unstructured_file, "wb").write(b"Hello World!")
+        sibling_file = os.path.join(sibling_directory, "OTHER_FILE")
+        open(sibling_file, "wb").write(b"Hello World!")
+        self.client_job_description.command_line = "foo.exe %s,%s" % (local_unstructured_file, sibling_file)
+        self.client.expect_put_paths(["/lwr/staging/1/other/A_RANDOM_FILE"])
+        self.client.expect_command_line("foo.exe /lwr/staging/1/other/A_RANDOM_FILE,%s" % sibling_file)
+        self._submit()
+        self.assertEquals([put_file[0] for put_file in self.client.put_files], [local_unstructured_file])
+
     def test_submit_no_rewrite(self):
         # Expect no rewrite of paths
         command_line_template = "run_test.exe --input1=%s --input2=%s"
@@ -114,6 +137,37 @@ class TestStager(TempDirectoryTestCase):
         self._submit()
         self._assert_inputs_uploaded()
 
+    def test_submit_rewrite_batched(self):
+        self.client = BatchMockClient(self.temp_directory, self.tool)
+        self.test_submit_rewrite()
+        assert self.client.batches == 1
+
+    def test_submit_batch_failure(self):
+        self.client = BatchMockClient(self.temp_directory, self.tool)
+        self.client.fail_paths = [self.input2]
+        self.client_job_description.rewrite_paths = True
+        self.client_job_description.command_line = "run_test.exe %s %s" % (self.input1, self.input2)
+        exception_raised = False
+        try:
+            self._submit()
+        except Exception as e:
+            exception_raised = True
+            assert self.input2 in str(e)
+        assert exception_raised
+
+    def test_submit_transfer_metrics(self):
+        self.client = BatchMockClient(self.temp_directory, self.tool)
+        recorded = []
+        transfer_metrics = TransferMetrics(callbacks=[recorded.append])
+        self._submit(transfer_metrics=transfer_metrics)
+        self.assertEquals([record.path for record in recorded], [self.input1, self.input2])
+        summary = transfer_metrics.summary()
+        assert summary["files"] == 2
+        assert summary["bytes"] == 10
+        assert summary["failures"] == 0
+        group = summary["groups"][0]
+        assert (group["direction"], group["path_type"], group["action_type"]) == ("upload", "input", "transfer")
+
     def _assert_inputs_uploaded(self):
         # Expect both files staged
         uploaded_file1 = self.client.put_files[0]
@@ -123,8 +177,23 @@ class TestStager(TempDirectoryTestCase):
         assert uploaded_file2[1] == "input"
         assert uploaded_file2[0] == self.input2
 
-    def _submit(self):
-        return submit_job(self.client, self.client_job_description, self.job_config)
+    def _submit(self, transfer_metrics=None):
+        return submit_job(self.client, self.client_job_description, self.job_config, transfer_metrics=transfer_metrics)
+
+
+def test_find_referenced_subfiles():
+    inputs = JobInputs(u"run /a/b/tool.py /a/bc/other.py /a/b/ /a/b+c.d[1]/x.txt /a/b+cxd[1]/y.txt", [])
+    assert inputs.find_referenced_subfiles("/a/b") == [u"/a/b/tool.py"]
+    # Paths are matched literally, not as patterns.
+    assert inputs.find_referenced_subfiles("/a/b+c.d[1]") == [u"/a/b+c.d[1]/x.txt"]
+    assert inputs.find_referenced_subfiles("/a/missing") == []
+
+
+def test_find_prefix_references():
+    inputs = JobInputs(u"cat /data/x,/data2/y '/data/z' /data/", [])
+    references = inputs.find_prefix_references([u"/data/", u"/data2/"], PrefixPathMapper.path_pattern)
+    assert sorted(references[u"/data/"]) == [u"/data/x", u"/data/z"]
+    assert references[u"/data2/"] == [u"/data2/y"]
 
 
 class MockClient(object):
@@ -168,3 +237,22 @@ class MockClient(object):
     def put_file(self, path, type, name, contents):
         self.put_files.append((path, type, name, contents))
         return {"path": self.put_paths.popleft()}
+
+
+class BatchMockClient(MockClient):
+
+    def __init__(self, temp_directory, tool):
+        super(BatchMockClient, self).__init__(temp_directory, tool)
+        self.batches = 0
+        self.fail_paths = []
+
+    def batch_put_files(self, put_requests):
+        self.batches += 1
+        responses = []
+        for put_request in put_requests:
+            path = put_request["path"]
+            response = self.put_file(path, put_request["input_type"], put_request["name"], put_request["contents"])
+            if path in self.fail_paths:
+                response = Exception("Failed to transfer %s" % path)
+            responses.append(response)
+        return responses
@@ -1,11 +1,16 @@
 from collections import deque
 import tempfile
+from hashlib import sha256
 import os
 
+from json import dumps
+
 from six import text_type, binary_type
 
 from lwr.lwr_client.client import JobClient
+from lwr.lwr_client.client import check_complete_many
 from lwr.lwr_client.manager import HttpLwrInterface
+from lwr.lwr_client.interface import LwrInteface
 from lwr.lwr_client.transport import Urllib2Transport
 from lwr.lwr_client.decorators import retry, MAX_RETRY_COUNT
 
@@ -232,3 +237,94 @@ def test_clean():
     client.expect_open(request_checker, b'OK')
     client.clean()
     request_checker.assert_called()
+
+
+class FakeInterface(LwrInteface):
+    """ Records executed commands, raising the next of ``failures[command]``
+    (if any remain) instead of returning ``responses[command]``.
+    """
+
+    def __init__(self, responses, failures={}):
+        self.responses = responses
+        self.failures = dict((command, list(exceptions)) for command, exceptions in failures.items())
+        self.executed = []
+        self.requests = []
+
+    def execute(self, command, args={}, data=None, input_path=None, output_path=None, resume=False, byte_range=None, compression=None, etag=None):
+        self.executed.append(command)
+        self.requests.append(dict(data=data, output_path=output_path, resume=resume, etag=etag))
+        failures = self.failures.get(command, [])
+        if failures:
+            raise failures.pop(0)
+        return self.responses[command]
+
+
+def test_batch_put_files_uploads_when_link_fails():
+    (temp_fileno, temp_file_path) = tempfile.mkstemp()
+    os.write(temp_fileno, b"Hello World!")
+    os.close(temp_fileno)
+    try:
+        interface = FakeInterface(
+            responses={"upload_extra_input": '{"path": "/lwr/inputs/dataset_1.dat"}'},
+            failures={"link_stored_input": [Exception("Connection reset")] * 2},
+        )
+        client = JobClient({"deduplicate_inputs": "true"}, "543", interface)
+        results = client.batch_put_files([dict(path=temp_file_path, input_type="input", name="dataset_1.dat")])
+        assert results == [{"path": "/lwr/inputs/dataset_1.dat"}], results
+        assert interface.executed == ["link_stored_input", "upload_extra_input"]
+        # Likewise for individual uploads.
+        assert client.put_file(temp_file_path, "input", name="dataset_1.dat") == {"path": "/lwr/inputs/dataset_1.dat"}
+    finally:
+        os.remove(temp_file_path)
+
+
+def test_batch_put_files_retries_failed_uploads():
+    (temp_fileno, temp_file_path) = tempfile.mkstemp()
+    os.write(temp_fileno, b"Hello World!")
+    os.close(temp_fileno)
+    try:
+        interface = FakeInterface(
+            responses={"upload_extra_input": '{"path": "/lwr/inputs/dataset_1.dat"}'},
+            failures={"upload_extra_input": [Exception("Connection reset")] * 2},
+        )
+        client = JobClient({}, "543", interface)
+        results = client.batch_put_files([dict(path=temp_file_path, input_type="input", name="dataset_1.dat")])
+        assert results == [{"path": "/lwr/inputs/dataset_1.dat"}], results
+        assert interface.executed == ["upload_extra_input"] * 3
+    finally:
+        os.remove(temp_file_path)
+
+
+def test_fetch_output_resumes_partial_downloads():
+    (temp_fileno, temp_file_path) = tempfile.mkstemp()
+    os.write(temp_fileno, b"Hello")
+    os.close(temp_fileno)
+    try:
+        interface = FakeInterface(responses={"download_output": None})
+        client = JobClient({}, "543", interface)
+        # Not known to be complete, so resumed rather than revalidated.
+        client.fetch_output(temp_file_path, "out.dat", None, "transfer", "output")
+        assert interface.requests[-1] == dict(data=None, output_path=temp_file_path, resume=True, etag=None)
+        # Downloaded in full, so only resent if changed.
+        client.fetch_output(temp_file_path, "out.dat", None, "transfer", "output")
+        request = interface.requests[-1]
+        assert not request["resume"]
+        assert request["etag"] == '"sha256-%s"' % sha256(b"Hello").hexdigest(), request
+        # Modified since, so no longer known to be complete.
+        open(temp_file_path, "ab").write(b" World!")
+        os.utime(temp_file_path, (0, 0))
+        client.batch_fetch_outputs([dict(path=temp_file_path, name="out.dat", working_directory=None, action_type="transfer", output_type="output")])
+        assert interface.requests[-1] == dict(data=None, output_path=temp_file_path, resume=True, etag=None)
+    finally:
+        os.remove(temp_file_path)
+
+
+def test_check_complete_many_reuses_unchanged_statuses():
+    interface = FakeInterface(responses={})
+    client = JobClient({}, "543", interface)
+    complete = {"status": "complete", "stdout": "Hello", "complete": "true"}
+    interface.responses["check_complete_many"] = dumps({"543": dict(complete, etag="md5-1")})
+    assert check_complete_many([client]) == [complete]
+    interface.responses["check_complete_many"] = dumps({"543": {"unchanged": True}})
+    assert check_complete_many([client]) == [complete]
+    assert interface.requests[-1]["data"] == dumps({"543": "md5-1"})
@@ -2,6 +2,15 @@ from lwr.lwr_client.transport.standard import Urllib2Transport
 from lwr.lwr_client.transport.curl import PycurlTransport
 from lwr.lwr_client.transport import get_transport
 from tempfile import NamedTemporaryFile
+import os
+
+from webtest import TestApp
+
+from .test_utils import files_server
+from .test_utils import server_for_test_app
+from .test_utils import temp_directory
+from .test_utils import JobFilesApp
+from .test_utils import skipUnlessModule
 
 
 def test_urllib_transports():
@@ -12,6 +21,209 @@ def test_pycurl_transport():
     _test_transport(PycurlTransport())
 
 
+@skipUnlessModule("pycurl")
+def test_pycurl_transport_reuses_handles():
+    with files_server() as (server, directory):
+        path = os.path.join(directory, "moo")
+        open(path, "wb").write(b"cow")
+        url = u"%s?path=%s" % (server.application_url, path)
+        transport = PycurlTransport(pool_size=1)
+        assert transport.curl_pool.idle_count(url) == 0
+        assert transport.execute(url) == b"cow"
+        assert transport.curl_pool.idle_count(url) == 1
+        with transport.curl_pool.curl(url) as c:
+            assert transport.curl_pool.idle_count(url) == 0
+            with transport.curl_pool.curl(url) as c2:
+                assert c is not c2
+        # Only pool_size idle handles are kept around.
+        assert transport.curl_pool.idle_count(url) == 1
+        assert transport.execute(url) == b"cow"
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_transport_reuses_handles_after_http_errors():
+    with files_server() as (server, directory):
+        url = u"%s?path=%s" % (server.application_url, os.path.join(directory, "missing"))
+        transport = PycurlTransport(pool_size=1)
+        try:
+            transport.execute(url)
+            assert False, "Expected missing file download to fail."
+        except Exception as e:
+            assert e.status_code >= 400
+        assert transport.curl_pool.idle_count(url) == 1
+        # Transport errors discard the handle.
+        unreachable_url = u"http://127.0.0.1:1/?path=moo"
+        raised_exception = False
+        try:
+            transport.execute(unreachable_url)
+        except Exception:
+            raised_exception = True
+        assert raised_exception
+        assert transport.curl_pool.idle_count(unreachable_url) == 0
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_execute_many():
+    _test_execute_many(PycurlTransport())
+
+
+def test_urllib_execute_many():
+    _test_execute_many(Urllib2Transport())
+
+
+def _test_execute_many(transport):
+    with files_server() as (server, directory):
+        requests = []
+        for i in range(5):
+            path = os.path.join(directory, "file%d" % i)
+            open(path, "wb").write(b"contents%d" % i)
+            url = u"%s?path=%s" % (server.application_url, path)
+            requests.append(dict(url=url, output_path=os.path.join(directory, "download%d" % i)))
+        requests.append(dict(url=u"%s?path=%s" % (server.application_url, path)))
+        missing_path = os.path.join(directory, "missing")
+        requests.append(dict(url=u"%s?path=%s" % (server.application_url, missing_path)))
+        results = transport.execute_many(requests, max_in_flight=2)
+        assert len(results) == 7
+        for i in range(5):
+            assert not isinstance(results[i], Exception)
+            assert open(os.path.join(directory, "download%d" % i), "rb").read() == b"contents%d" % i
+        assert results[5] == b"contents4"
+        assert isinstance(results[6], Exception)
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_execute_many_releases_handle_on_setup_failure():
+    with files_server() as (server, directory):
+        url = u"%s?path=%s" % (server.application_url, os.path.join(directory, "moo"))
+        transport = PycurlTransport()
+        released = []
+        release = transport.curl_pool.release
+
+        def record_release(url, c, reuse=True):
+            released.append(reuse)
+            release(url, c, reuse=reuse)
+        transport.curl_pool.release = record_release
+        results = transport.execute_many([dict(url=url, input_path=os.path.join(directory, "missing"))])
+        assert isinstance(results[0], Exception)
+        assert released == [False]
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_execute_async():
+    with files_server() as (server, directory):
+        transport = PycurlTransport()
+        try:
+            futures = []
+            for i in range(5):
+                path = os.path.join(directory, "file%d" % i)
+                open(path, "wb").write(b"contents%d" % i)
+                url = u"%s?path=%s" % (server.application_url, path)
+                futures.append(transport.execute_async(url))
+            missing_path = os.path.join(directory, "missing")
+            missing_future = transport.execute_async(u"%s?path=%s" % (server.application_url, missing_path))
+            for i, future in enumerate(futures):
+                assert future.result(timeout=30) == b"contents%d" % i
+            assert missing_future.exception(timeout=30) is not None
+        finally:
+            transport.shutdown()
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_resume():
+    _test_resume(PycurlTransport())
+
+
+def test_urllib_resume():
+    _test_resume(Urllib2Transport())
+
+
+def _test_resume(transport):
+    with files_server() as (server, directory):
+        path = os.path.join(directory, "remote")
+        open(path, "wb").write(b"Hello World!")
+        url = u"%s?path=%s" % (server.application_url, path)
+        output_path = os.path.join(directory, "local")
+        # Resume partial download.
+        open(output_path, "wb").write(b"Hello")
+        transport.execute(url, output_path=output_path, resume=True)
+        assert open(output_path, "rb").read() == b"Hello World!"
+        # Already complete, server responds with 416.
+        transport.execute(url, output_path=output_path, resume=True)
+        assert open(output_path, "rb").read() == b"Hello World!"
+        # Without resume, file is replaced.
+        open(output_path, "wb").write(b"Hello")
+        transport.execute(url, output_path=output_path)
+        assert open(output_path, "rb").read() == b"Hello World!"
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_resume_after_error():
+    _test_resume_after_error(PycurlTransport())
+
+
+def test_urllib_resume_after_error():
+    _test_resume_after_error(Urllib2Transport())
+
+
+def _test_resume_after_error(transport):
+    with temp_directory() as directory:
+        contents = os.urandom(64 * 1024)
+        path = os.path.join(directory, "remote")
+        open(path, "wb").write(contents)
+        output_path = os.path.join(directory, "local")
+        app = TestApp(FailingOnceApp(JobFilesApp(directory)))
+        with server_for_test_app(app) as server:
+            url = u"%s?path=%s" % (server.application_url, path)
+            try:
+                transport.execute(url, output_path=output_path, resume=True)
+                assert False
+            except Exception:
+                pass
+            # Retry, the error body must not have been kept.
+            transport.execute(url, output_path=output_path, resume=True)
+        assert open(output_path, "rb").read() == contents
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_conditional_error_keeps_output():
+    _test_conditional_error_keeps_output(PycurlTransport())
+
+
+def test_urllib_conditional_error_keeps_output():
+    _test_conditional_error_keeps_output(Urllib2Transport())
+
+
+def _test_conditional_error_keeps_output(transport):
+    with temp_directory() as directory:
+        path = os.path.join(directory, "remote")
+        open(path, "wb").write(b"Hello World!")
+        output_path = os.path.join(directory, "local")
+        open(output_path, "wb").write(b"Hello Galaxy!")
+        app = TestApp(FailingOnceApp(JobFilesApp(directory)))
+        with server_for_test_app(app) as server:
+            url = u"%s?path=%s" % (server.application_url, path)
+            try:
+                transport.execute(url, output_path=output_path, etag='"moo"')
+                assert False
+            except Exception:
+                pass
+        assert open(output_path, "rb").read() == b"Hello Galaxy!"
+
+
+class FailingOnceApp(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.failed = False
+
+    def __call__(self, environ, start_response):
+        if not self.failed:
+            self.failed = True
+            start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+            return [b"Internal error occurred."]
+        return self.app(environ, start_response)
+
+
 def _test_transport(transport):
     # Testing simple get
     response = transport.execute(u"http://www.google.com", data=None)
@@ -31,6 +243,8 @@ def test_get_transport():
     assert type(get_transport(None, FakeOsModule("0"))) == Urllib2Transport
     assert type(get_transport('urllib', FakeOsModule("TRUE"))) == Urllib2Transport
     assert type(get_transport('curl', FakeOsModule("TRUE"))) == PycurlTransport
+    curl_transport = get_transport('curl', FakeOsModule("TRUE"), transport_params={"pool_size": "7"})
+    assert curl_transport.curl_pool.pool_size == 7
 
 
 class FakeOsModule(object):
@@ -40,3 +254,60 @@ class FakeOsModule(object):
 
     def getenv(self, key, default):
         return self.env_val
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_upload_encoding_fallback():
+    _test_upload_encoding_fallback(PycurlTransport())
+
+
+def test_urllib_upload_encoding_fallback():
+    _test_upload_encoding_fallback(Urllib2Transport())
+
+
+def _test_upload_encoding_fallback(transport):
+    with temp_directory() as directory:
+        input_path = os.path.join(directory, "input")
+        contents = os.urandom(1024) * 64
+        open(input_path, "wb").write(contents)
+        app = UncompressedUploadApp()
+        with server_for_test_app(TestApp(app)) as server:
+            url = u"%s/upload" % server.application_url
+            transport.execute(url, input_path=input_path, compression="gzip")
+            assert app.rejected == 1
+            assert app.body == contents
+            # Server is known to only accept uploads uncompressed now.
+            transport.execute(url, input_path=input_path, compression="gzip")
+            assert app.rejected == 1
+
+
+@skipUnlessModule("pycurl")
+def test_pycurl_execute_many_upload_encoding_fallback():
+    with temp_directory() as directory:
+        input_path = os.path.join(directory, "input")
+        open(input_path, "wb").write(b"Hello World!" * 1024)
+        app = UncompressedUploadApp()
+        with server_for_test_app(TestApp(app)) as server:
+            url = u"%s/upload" % server.application_url
+            requests = [dict(url=url, input_path=input_path, compression="gzip") for i in range(3)]
+            results = PycurlTransport().execute_many(requests, max_in_flight=2)
+            assert not [result for result in results if isinstance(result, Exception)]
+            assert app.rejected >= 1
+            assert app.body == b"Hello World!" * 1024
+
+
+class UncompressedUploadApp(object):
+
+    def __init__(self):
+        self.rejected = 0
+        self.body = None
+
+    def __call__(self, environ, start_response):
+        if environ.get("HTTP_CONTENT_ENCODING", None):
+            self.rejected += 1
+            start_response("415 Unsupported Media Type", [("Content-Type", "text/plain"), ("Accept-Encoding", "identity")])
+            return [b"Unsupported Content-Encoding."]
+        length = int(environ.get("CONTENT_LENGTH", None) or 0)
+        self.body = environ["wsgi.input"].read(length)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"OK"]
@@ -3,6 +3,7 @@ from os import makedirs, system
 from six import next, itervalues
 from six.moves import configparser
 from .test_utils import TempDirectoryTestCase, skipUnlessExecutable, skipUnlessModule
+from .test_utils import skip
 
 from .test_utils import test_lwr_app
 from .test_utils import test_lwr_server
@@ -54,6 +55,7 @@ class BaseIntegrationTest(TempDirectoryTestCase):
         if kwds.get("local_setup", False):
             staging_directory = app.staging_directory
             options["jobs_directory"] = staging_directory
+            options["jobs_directory_layout"] = app.staging_directory_layout
 
     def __setup_job_properties(self, app_conf, job_conf_props):
         if job_conf_props:
@@ -99,6 +101,10 @@ class IntegrationTests(BaseIntegrationTest):
     def test_integration_local_setup(self):
         self._run(private_token=None, default_file_action="remote_copy", local_setup=True, **self.default_kwargs)
 
+    def test_integration_local_setup_hashed_layout(self):
+        self._run(app_conf=dict(staging_directory_layout="hashed"), private_token=None, default_file_action="remote_copy", local_setup=True,
+                  **self.default_kwargs)
+
     @skipUnlessModule("pycurl")
     @skipUnlessModule("kombu")
     def test_message_queue(self):
@@ -120,6 +126,15 @@ class IntegrationTests(BaseIntegrationTest):
     def test_integration_cached(self):
         self._run(private_token=None, cache=True, **self.default_kwargs)
 
+    def test_integration_cached_digest(self):
+        self._run(private_token=None, cache=True, cache_digest="sampled", **self.default_kwargs)
+
+    def test_integration_scheduled(self):
+        self._run(private_token=None, schedule_transfers=True, max_transfers_per_destination=1, **self.default_kwargs)
+
+    def test_integration_cached_scheduled(self):
+        self._run(private_token=None, cache=True, schedule_transfers=True, transfer_bandwidth=100 * 1024 * 1024, **self.default_kwargs)
+
     def test_integration_default(self):
         self._run(private_token=None, **self.default_kwargs)
 
@@ -127,6 +142,53 @@ class IntegrationTests(BaseIntegrationTest):
     def test_integration_curl(self):
         self._run(private_token=None, transport="curl", **self.default_kwargs)
 
+    def test_integration_chunked(self):
+        self._run(private_token=None, chunk_threshold=1, **self.default_kwargs)
+
+    @skipUnlessModule("pycurl")
+    def test_integration_chunked_curl(self):
+        self._run(private_token=None, chunk_threshold=1, transport="curl", **self.default_kwargs)
+
+    @skipUnlessModule("pycurl")
+    def test_integration_async_requests(self):
+        self._run(private_token=None, async_requests=True, transport="curl", **self.default_kwargs)
+
+    def test_integration_compressed(self):
+        self._run(private_token=None, compression="gzip", **self.default_kwargs)
+
+    @skipUnlessModule("pycurl")
+    def test_integration_compressed_curl(self):
+        self._run(private_token=None, compression="gzip", transport="curl", **self.default_kwargs)
+
+    def test_integration_batch_uploads(self):
+        self._run(private_token=None, batch_upload_threshold=1024 * 1024, **self.default_kwargs)
+
+    def test_integration_verified_uploads(self):
+        self._run(app_conf=dict(preallocate_uploads=True), private_token=None, verify_uploads=True, compression="gzip", **self.default_kwargs)
+
+    def test_integration_archive_outputs(self):
+        self._run(private_token=None, archive_outputs=True, **self.default_kwargs)
+
+    @skipUnlessModule("pycurl")
+    def test_integration_archive_outputs_compressed_curl(self):
+        self._run(private_token=None, archive_outputs=True, compression="gzip", transport="curl", **self.default_kwargs)
+
+    def test_integration_archive_extra_inputs(self):
+        self._run(private_token=None, archive_extra_inputs=True, verify_uploads=True, compression="gzip", **self.default_kwargs)
+
+    def test_integration_refinish(self):
+        self._run(private_token=None, refinish=True, **self.default_kwargs)
+
+    @skipUnlessModule("pycurl")
+    def test_integration_refinish_curl(self):
+        self._run(private_token=None, refinish=True, transport="curl", **self.default_kwargs)
+
+    def test_integration_status_listener(self):
+        self._run(app_conf=dict(status_feed=True), private_token=None, status_listener=True, **self.default_kwargs)
+
+    def test_integration_deduplicated_inputs(self):
+        self._run(private_token=None, deduplicate_inputs=True, **self.default_kwargs)
+
     def test_integration_token(self):
         self._run(app_conf={"private_key": "testtoken"}, private_token="testtoken", **self.default_kwargs)
 
@@ -149,6 +211,10 @@ class IntegrationTests(BaseIntegrationTest):
 class DirectIntegrationTests(IntegrationTests):
     default_kwargs = dict(direct_interface=True, test_requirement=False)
 
+    @skip("Status feed is only served over HTTP.")
+    def test_integration_status_listener(self):
+        pass
+
     @skipUnlessModule("pycurl")
     def test_integration_remote_transfer(self):
         self._run(
@@ -1,5 +1,6 @@
 from .test_utils import TempDirectoryTestCase
 from lwr.managers.base import JobDirectory
+from lwr.lwr_client.job_directory import RemoteJobDirectory
 import os
 
 TEST_JOB_ID = "1234"
@@ -17,6 +18,20 @@ class JobDirectoryTestCase(TempDirectoryTestCase):
         self.job_directory.setup()
         assert os.path.exists(expected_path)
 
+    def test_setup_hashed(self):
+        job_directory = JobDirectory(self.temp_directory, TEST_JOB_ID, layout="hashed")
+        expected_path = os.path.join(self.temp_directory, "001", TEST_JOB_ID)
+        job_directory.setup()
+        assert os.path.exists(expected_path)
+        remote_job_directory = RemoteJobDirectory(self.temp_directory, TEST_JOB_ID, os.sep, layout="hashed")
+        assert remote_job_directory.path == job_directory.path == expected_path
+
+    def test_hashed_finds_flat_job(self):
+        # Jobs setup before switching to the hashed layout are still found.
+        self.job_directory.setup()
+        job_directory = JobDirectory(self.temp_directory, TEST_JOB_ID, layout="hashed")
+        assert job_directory.path == os.path.join(self.temp_directory, TEST_JOB_ID)
+
     def test_metadata(self):
         self.prep()
         assert not self.job_directory.has_metadata("MooCow")
@@ -1,6 +1,13 @@
+from io import BytesIO
+from os.path import getsize
 from os.path import join
 
+from galaxy import util as galaxy_util
+from galaxy.util import copy_to_path as galaxy_copy_to_path
+from lwr.cache import Cache
+from lwr.web import routes
 from lwr.web.routes import _output_path
+from .test_utils import temp_directory
 from .test_utils import test_manager
 
 
@@ -22,3 +29,44 @@ def test_output_path_security():
         except:
             raised_exception = True
         assert raised_exception
+
+
+def test_cached_upload_preallocates_cached_file_size():
+    with temp_directory() as directory:
+        source_path = join(directory, "source")
+        open(source_path, "wb").write(b"Hello World!")
+        cache = Cache(directory)
+        preallocate_sizes = []
+
+        def copy_to_path(source, path, preallocate_size=None):
+            preallocate_sizes.append(preallocate_size)
+            galaxy_copy_to_path(source, path, preallocate_size=preallocate_size)
+
+        original_copy_to_path = routes.copy_to_path
+        routes.copy_to_path = copy_to_path
+        try:
+            cache.cache_required("127.0.0.2", "/galaxy/dataset1.dat")
+            cache.cache_file(source_path, "127.0.0.2", "/galaxy/dataset1.dat")
+            token = cache.file_available("127.0.0.2", "/galaxy/dataset1.dat")["token"]
+            path = join(directory, "input1")
+            response = routes._handle_upload(cache, path, BytesIO(b""), cache_token=token, content_length=0, preallocate=True)
+        finally:
+            routes.copy_to_path = original_copy_to_path
+            cache.close()
+        assert preallocate_sizes == [12]
+        assert response["size"] == 12
+        assert open(path, "rb").read() == b"Hello World!"
+
+
+def test_copy_to_path_preallocates():
+    with temp_directory() as directory:
+        path = join(directory, "preallocated")
+        output = open(path, "wb")
+        try:
+            galaxy_util._preallocate(output, 1024 * 1024)
+        finally:
+            output.close()
+        assert getsize(path) == 1024 * 1024
+        # Trimmed to the copied contents.
+        galaxy_copy_to_path(BytesIO(b"Hello World!"), path, preallocate_size=1024 * 1024)
+        assert open(path, "rb").read() == b"Hello World!"
@@ -0,0 +1,85 @@
+import threading
+import time
+
+from lwr.lwr_client.scheduler import TransferScheduler
+
+
+def test_small_transfers_first():
+    scheduler = TransferScheduler(threads=1)
+    started = []
+    blocker = __block(scheduler)
+    try:
+        futures = [
+            scheduler.submit(started.append, ("large",), size=200 * 1024 * 1024),
+            scheduler.submit(started.append, ("large_priority",), size=200 * 1024 * 1024, priority=-1),
+            scheduler.submit(started.append, ("small",), size=1024),
+        ]
+        assert scheduler.statistics()["queued"] == 3
+    finally:
+        blocker.set()
+    for future in futures:
+        future.result(5)
+    assert started == ["large_priority", "small", "large"]
+    scheduler.shutdown()
+
+
+def test_max_per_destination():
+    scheduler = TransferScheduler(threads=3, max_per_destination=1)
+    lock = threading.Lock()
+    active = {}
+    max_active = {}
+
+    def transfer(destination):
+        with lock:
+            active[destination] = active.get(destination, 0) + 1
+            max_active[destination] = max(max_active.get(destination, 0), active[destination])
+        time.sleep(.05)
+        with lock:
+            active[destination] -= 1
+
+    futures = []
+    for i in range(4):
+        for destination in ["http://lwr1/", "http://lwr2/"]:
+            futures.append(scheduler.submit(transfer, (destination,), destination=destination))
+    for future in futures:
+        future.result(5)
+    assert max_active == {"http://lwr1/": 1, "http://lwr2/": 1}
+    statistics = scheduler.statistics()
+    assert statistics["completed"] == 8
+    assert statistics["max_wait_time"] > 0
+    scheduler.shutdown()
+
+
+def test_failures_and_bandwidth():
+    scheduler = TransferScheduler(threads=1, bandwidth=1000, burst=100)
+
+    def fail():
+        raise Exception("Failed transfer.")
+
+    assert "Failed transfer" in str(scheduler.submit(fail).exception(5))
+    # 100 bytes available, the next 100 take .1 seconds to accumulate.
+    start = time.time()
+    scheduler.submit(lambda: None, size=200).result(5)
+    assert time.time() - start >= .09
+    statistics = scheduler.statistics()
+    assert statistics["failed"] == 1
+    assert statistics["throttled_time"] > 0
+    scheduler.shutdown()
+    try:
+        scheduler.submit(lambda: None)
+        assert False
+    except Exception as e:
+        assert "shutdown" in str(e)
+
+
+def __block(scheduler):
+    blocker = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        blocker.wait(5)
+
+    scheduler.submit(block)
+    started.wait(5)
+    return blocker